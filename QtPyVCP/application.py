@@ -23,6 +23,10 @@ from QtPyVCP.widgets.form_widgets.main_window import VCPMainWindow
 class VCPApplication(QApplication):
 
     def __init__(self, opts, vcp_file=None):
+        # forks, so it has to be done before Qt or anything else starts threads
+        from QtPyVCP.lib import parallel_preview
+        parallel_preview.startHelper()
+
         super(VCPApplication, self).__init__(opts.command_line_args or [])
 
         qApp = QApplication.instance()
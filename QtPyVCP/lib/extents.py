@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Vectorized extents of a program toolpath, of the whole program, of each
+#   operation and tool, and the centroid of the moves of a line.
+
+import bisect
+
+from QtPyVCP.lib import toolpath
+from QtPyVCP.lib.toolpath import numpy
+
+STORES = ('traverse', 'feed', 'arcfeed')
+
+
+class ToolpathExtents(object):
+    """Computes bounds from the segment arrays of a program with numpy.
+
+    The segments of an operation are the ones added between its tool change
+    and the next, so the bounds of all the operations are found with one
+    `reduceat` pass over each store. Results are cached, the stores must not
+    change once the engine has been made. Requires numpy.
+
+    Args:
+        stores (dict): the 'traverse', 'feed' and 'arcfeed' SegmentStores.
+        operations (list, optional): the toolpath.Operations of the program,
+            in program order.
+    """
+
+    def __init__(self, stores, operations=()):
+        self.stores = stores
+        operations = list(operations)
+        # the moves before the first tool change are done with the tool
+        # that was loaded when the program started
+        if not operations or tuple(operations[0][2:]) != (0, 0, 0):
+            operations.insert(0, toolpath.Operation(0, None, 0, 0, 0))
+        self.operations = operations
+        self._extents = None
+        self._operation_extents = None
+
+    def extents(self):
+        """Returns the toolpath.Extents of the whole program."""
+        if self._extents is None:
+            self._extents = toolpath.Extents(*toolpath.calc_extents(
+                self.stores[name] for name in STORES))
+        return self._extents
+
+    def operationExtents(self, index=None):
+        """Returns the extents of an operation.
+
+        Args:
+            index (int, optional): the operation, all of them if None.
+
+        Returns:
+            toolpath.Extents | list: the extents, or None for an operation
+                without moves.
+        """
+        if self._operation_extents is None:
+            self._operation_extents = self._calcOperationExtents()
+        if index is None:
+            return self._operation_extents
+        if not 0 <= index < len(self.operations):
+            return None
+        return self._operation_extents[index]
+
+    def toolExtents(self, tool):
+        """Returns the extents of all the operations of a tool, or None."""
+        result = None
+        for operation, extents in zip(self.operations, self.operationExtents()):
+            if operation.tool != tool or extents is None:
+                continue
+            result = extents if result is None else toolpath.merge_extents(result, extents)
+        return None if result is None else toolpath.Extents(*result)
+
+    def tools(self):
+        """Returns the tools used, in the order they are first loaded."""
+        tools = []
+        for operation in self.operations:
+            if operation.tool not in tools:
+                tools.append(operation.tool)
+        return tools
+
+    def operationAt(self, lineno):
+        """Returns the index of the operation a line moves in, or None."""
+        for i, name in enumerate(STORES):
+            rows = self.stores[name].linesSegments(lineno)
+            if len(rows):
+                starts = [operation[2 + i] for operation in self.operations]
+                return bisect.bisect_right(starts, int(rows[0])) - 1
+        return None
+
+    def lineCentroid(self, lineno, points=()):
+        """Returns the mean XYZ of the segment ends of a line.
+
+        Args:
+            lineno (int): the line number.
+            points (list, optional): more XYZ points of the line to include,
+                such as dwells.
+
+        Returns:
+            tuple: the centroid, or None if the line has no moves.
+        """
+        total = numpy.zeros(3)
+        count = 0
+        for name in STORES:
+            store = self.stores[name]
+            rows = store.linesSegments(lineno)
+            if not len(rows):
+                continue
+            a = store.arrays()
+            total += a.start[rows, :3].sum(0) + a.end[rows, :3].sum(0)
+            count += 2 * len(rows)
+        for point in points:
+            total += point[:3]
+            count += 1
+        if not count:
+            return None
+        return tuple((total / count).tolist())
+
+    def _calcOperationExtents(self):
+        count = len(self.operations)
+        bounds = [numpy.full((count, 3), 9e99), numpy.full((count, 3), -9e99),
+                  numpy.full((count, 3), 9e99), numpy.full((count, 3), -9e99)]
+        for i, name in enumerate(STORES):
+            a = self.stores[name].arrays()
+            starts = numpy.array([operation[2 + i] for operation in self.operations], numpy.intp)
+            _reduceRanges(a, starts, bounds)
+
+        result = []
+        for i in range(count):
+            if bounds[0][i, 0] > bounds[1][i, 0]:
+                result.append(None)
+            else:
+                result.append(toolpath.Extents(*[b[i].tolist() for b in bounds]))
+        return result
+
+
+def _reduceRanges(a, starts, bounds):
+    """Merges the extents of the rows from each start to the next into
+    `bounds`, the (min, max, min_tlo, max_tlo) arrays of the ranges."""
+    n = len(a.lineno)
+    if not n:
+        return
+    starts = numpy.minimum(starts, n)
+    stops = numpy.append(starts[1:], n)
+    ranges = numpy.flatnonzero(starts < stops)
+    if not len(ranges):
+        return
+    first = starts[ranges]
+
+    lo = numpy.minimum(a.start[:, :3], a.end[:, :3])
+    hi = numpy.maximum(a.start[:, :3], a.end[:, :3])
+    for bound, values, reduce_ in ((0, lo, numpy.minimum), (1, hi, numpy.maximum)):
+        bounds[bound][ranges] = reduce_(bounds[bound][ranges], reduce_.reduceat(values, first))
+        values += a.tlo
+        bounds[bound + 2][ranges] = reduce_(bounds[bound + 2][ranges], reduce_.reduceat(values, first))
@@ -26,6 +26,14 @@ import gcode
 import os
 import re
 
+from QtPyVCP.lib import toolpath
+from QtPyVCP.lib import extents
+from QtPyVCP.lib import spatial_index
+from QtPyVCP.lib import vbo_renderer
+
+from QtPyVCP.utilities import logger
+LOG = logger.getLogger(__name__)
+
 def minmax(*args):
     return min(*args), max(*args)
 
@@ -79,14 +87,20 @@ limiticon = array.array('B',
 class GLCanon(Translated, ArcsToSegmentsMixin):
     lineno = -1
     def __init__(self, colors, geometry, is_foam=0):
-        # traverse list - [line number, [start position], [end position], [tlo x, tlo y, tlo z]]
-        self.traverse = []; self.traverse_append = self.traverse.append
-        # feed list - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
-        self.feed = []; self.feed_append = self.feed.append
-        # arcfeed list - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
-        self.arcfeed = []; self.arcfeed_append = self.arcfeed.append
+        # traverse store - [line number, [start position], [end position], [tlo x, tlo y, tlo z]]
+        self.traverse = toolpath.SegmentStore(has_feed=False)
+        # feed store - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
+        self.feed = toolpath.SegmentStore()
+        # arcfeed store - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
+        self.arcfeed = toolpath.SegmentStore()
         # dwell list - [line number, color, pos x, pos y, pos z, plane]
         self.dwells = []; self.dwells_append = self.dwells.append
+        # line number -> dwells on that line, see build_line_index()
+        self.dwell_index = None
+        # tool changes - toolpath.Operation, see change_tool()
+        self.operations = []
+        self._extents_engine = None
+        self._spatial_index = None
         self.choice = None
         self.feedrate = 1
         self.lo = (0,) * 9
@@ -165,6 +179,11 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         self.lineno = self.state.sequence_number
 
     def draw_lines(self, lines, for_selection, j=0, geometry=None):
+        if isinstance(lines, toolpath.SegmentStore):
+            # only one chunk of the store is converted to tuples at a time
+            for chunk in lines.iterchunks():
+                linuxcnc.draw_lines(geometry or self.geometry, chunk, for_selection)
+            return
         return linuxcnc.draw_lines(geometry or self.geometry, lines, for_selection)
 
     def colored_lines(self, color, lines, for_selection, j=0):
@@ -189,8 +208,27 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
     def draw_dwells(self, dwells, alpha, for_selection, j0=0):
         return linuxcnc.draw_dwells(self.geometry, dwells, alpha, for_selection, self.is_lathe)
 
+    def extents_engine(self):
+        """Returns the extents.ToolpathExtents of the program, or None if
+        numpy is not available. Must not be used while interpreting."""
+        if toolpath.numpy is None:
+            return None
+        if self._extents_engine is None:
+            stores = dict(traverse=self.traverse, feed=self.feed, arcfeed=self.arcfeed)
+            self._extents_engine = extents.ToolpathExtents(stores, self.operations)
+        return self._extents_engine
+
     def calc_extents(self):
-        self.min_extents, self.max_extents, self.min_extents_notool, self.max_extents_notool = gcode.calc_extents(self.arcfeed, self.feed, self.traverse)
+        stores = (self.arcfeed, self.feed, self.traverse)
+        self._extents_engine = None
+        if toolpath.numpy is not None:
+            extents = self.extents_engine().extents()
+        else:
+            extents = gcode.calc_extents([], [], [])
+            for store in stores:
+                for chunk in store.iterchunks():
+                    extents = toolpath.merge_extents(extents, gcode.calc_extents(chunk))
+        self.min_extents, self.max_extents, self.min_extents_notool, self.max_extents_notool = extents
         if self.is_foam:
             min_z = min(self.foam_z, self.foam_w)
             max_z = max(self.foam_z, self.foam_w)
@@ -200,6 +238,37 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
                 self.min_extents_notool[0], self.min_extents_notool[1], min_z
             self.max_extents_notool = \
                 self.max_extents_notool[0], self.max_extents_notool[1], max_z
+    def build_line_index(self):
+        """Indexes the segments by line number, so highlighting a line does
+        not have to search through the whole program."""
+        for store in (self.traverse, self.arcfeed, self.feed):
+            store.buildLineIndex()
+        self.dwell_index = {}
+        for dwell in self.dwells:
+            self.dwell_index.setdefault(dwell[0], []).append(dwell)
+
+    def build_spatial_index(self):
+        """Builds the spatial_index.SegmentGrid used by nearest_line(), if
+        numpy is available."""
+        if toolpath.numpy is None:
+            return None
+        stores = dict(traverse=self.traverse, feed=self.feed, arcfeed=self.arcfeed)
+        self._spatial_index = spatial_index.SegmentGrid(stores)
+        return self._spatial_index
+
+    def nearest_line(self, xyz, rapids=True):
+        """Returns the line of the move nearest to a XYZ point, or None.
+
+        Args:
+            xyz (sequence): the point, in the units of the segments.
+            rapids (bool, optional): whether traverse moves can be found.
+        """
+        index = self._spatial_index or self.build_spatial_index()
+        if index is None:
+            return None
+        nearest = index.nearest(xyz, rapids)
+        return nearest and nearest[0]
+
     def tool_offset(self, xo, yo, zo, ao, bo, co, uo, vo, wo):
         self.first_move = True
         x, y, z, a, b, c, u, v, w = self.lo
@@ -221,12 +290,19 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
 
     def change_tool(self, arg):
         self.first_move = True
+        self.operations.append(toolpath.Operation(
+            self.lineno, self.tool_in_spindle(arg),
+            len(self.traverse), len(self.feed), len(self.arcfeed)))
+
+    # the tool number recorded for a tool change
+    def tool_in_spindle(self, pocket):
+        return pocket
 
     def straight_traverse(self, x,y,z, a,b,c, u, v, w):
         if self.suppress > 0: return
         l = self.rotate_and_translate(x,y,z,a,b,c,u,v,w)
         if not self.first_move:
-                self.traverse_append((self.lineno, self.lo, l, [self.xo, self.yo, self.zo]))
+                self.traverse.append(self.lineno, self.lo, l, 0, (self.xo, self.yo, self.zo))
         self.lo = l
 
     def rigid_tap(self, x, y, z):
@@ -235,9 +311,9 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         l = self.rotate_and_translate(x,y,z,0,0,0,0,0,0)[:3]
         l += [self.lo[3], self.lo[4], self.lo[5],
                self.lo[6], self.lo[7], self.lo[8]]
-        self.feed_append((self.lineno, self.lo, l, self.feedrate, [self.xo, self.yo, self.zo]))
+        self.feed.append(self.lineno, self.lo, l, self.feedrate, (self.xo, self.yo, self.zo))
         # self.dwells_append((self.lineno, self.colors['dwell'], x + self.offset_x, y + self.offset_y, z + self.offset_z, 0))
-        self.feed_append((self.lineno, l, self.lo, self.feedrate, [self.xo, self.yo, self.zo]))
+        self.feed.append(self.lineno, l, self.lo, self.feedrate, (self.xo, self.yo, self.zo))
 
     def arc_feed(self, *args):
         if self.suppress > 0: return
@@ -250,21 +326,13 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
 
     def straight_arcsegments(self, segs):
         self.first_move = False
-        lo = self.lo
-        lineno = self.lineno
-        feedrate = self.feedrate
-        to = [self.xo, self.yo, self.zo]
-        append = self.arcfeed_append
-        for l in segs:
-            append((lineno, lo, l, feedrate, to))
-            lo = l
-        self.lo = lo
+        self.lo = self.arcfeed.extend(self.lineno, self.lo, segs, self.feedrate, (self.xo, self.yo, self.zo))
 
     def straight_feed(self, x,y,z, a,b,c, u, v, w):
         if self.suppress > 0: return
         self.first_move = False
         l = self.rotate_and_translate(x,y,z,a,b,c,u,v,w)
-        self.feed_append((self.lineno, self.lo, l, self.feedrate, [self.xo, self.yo, self.zo]))
+        self.feed.append(self.lineno, self.lo, l, self.feedrate, (self.xo, self.yo, self.zo))
         self.lo = l
     straight_probe = straight_feed
 
@@ -280,37 +348,41 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         self.dwells_append((self.lineno, color, self.lo[0], self.lo[1], self.lo[2], self.state.plane/10-17))
 
 
-    def highlight(self, lineno, geometry):
+    # if `segments` is False only the dwells are drawn, the segments are
+    # drawn by the VBO renderer
+    def highlight(self, lineno, geometry, segments=True):
         glLineWidth(3)
         c = self.colors['selected']
         glColor3f(*c)
         glBegin(GL_LINES)
+        engine = self.extents_engine()
         coords = []
-        for line in self.traverse:
-            if line[0] != lineno: continue
-            linuxcnc.line9(geometry, line[1], line[2])
-            coords.append(line[1][:3])
-            coords.append(line[2][:3])
-        for line in self.arcfeed:
-            if line[0] != lineno: continue
-            linuxcnc.line9(geometry, line[1], line[2])
-            coords.append(line[1][:3])
-            coords.append(line[2][:3])
-        for line in self.feed:
-            if line[0] != lineno: continue
-            linuxcnc.line9(geometry, line[1], line[2])
-            coords.append(line[1][:3])
-            coords.append(line[2][:3])
+        for store in (self.traverse, self.arcfeed, self.feed):
+            if engine is not None and not segments:
+                break
+            for start, end in store.segmentsForLine(lineno):
+                if segments:
+                    linuxcnc.line9(geometry, start, end)
+                if engine is None:
+                    coords.append(start[:3])
+                    coords.append(end[:3])
         glEnd()
-        for line in self.dwells:
-            if line[0] != lineno: continue
+        if self.dwell_index is None:
+            self.build_line_index()
+        dwells = []
+        for line in self.dwell_index.get(lineno, ()):
             self.draw_dwells([(line[0], c) + line[2:]], 2, 0)
-            coords.append(line[2:5])
+            dwells.append(line[2:5])
         glLineWidth(1)
-        if coords:
-            x = reduce(lambda x,y:x+y, [c[0] for c in coords]) / len(coords)
-            y = reduce(lambda x,y:x+y, [c[1] for c in coords]) / len(coords)
-            z = reduce(lambda x,y:x+y, [c[2] for c in coords]) / len(coords)
+        if engine is not None:
+            centroid = engine.lineCentroid(lineno, dwells)
+        else:
+            coords.extend(dwells)
+            centroid = None
+            if coords:
+                centroid = [sum(c[i] for c in coords) / len(coords) for i in range(3)]
+        if centroid is not None:
+            x, y, z = centroid
         else:
             x = (self.min_extents[0] + self.max_extents[0])/2
             y = (self.min_extents[1] + self.max_extents[1])/2
@@ -416,6 +488,13 @@ class GlCanonDraw:
         self.lp = lp
         self.canon = g
         self._dlists = {}
+        self._renderer = None
+        self._renderer_canon = None
+        self._vbo_supported = None
+        # extents of the part of a program streamed in so far, or None
+        self._stream_extents = None
+        # extents shown instead of the program's, see zoom_to_extents()
+        self._zoom_extents = None
         self.select_buffer_size = 100
         self.cached_tool = -1
         self.initialised = 0
@@ -476,6 +555,22 @@ class GlCanonDraw:
 
     def select(self, x, y):
         if self.canon is None: return
+        renderer = self.toolpath_renderer()
+        if renderer is not None:
+            # pick with an off-screen color-ID pass, GL_SELECT makes software
+            # GL walk the whole program
+            layers = ['feed', 'arcfeed']
+            if self.get_show_rapids():
+                layers.insert(0, 'rapids')
+            vport = glGetIntegerv(GL_VIEWPORT)
+            try:
+                line = renderer.pick(x, vport[3]-y, layers, self.draw_pick_dwells)
+            except vbo_renderer.PickError:
+                pass
+            else:
+                self.set_highlight_line(line)
+                return
+
         pmatrix = glGetDoublev(GL_PROJECTION_MATRIX)
         glMatrixMode(GL_PROJECTION)
         glPushMatrix()
@@ -491,9 +586,17 @@ class GlCanonDraw:
             glInitNames()
             glPushName(0)
 
-            if self.get_show_rapids():
-                glCallList(self.dlist('select_rapids', gen=self.make_selection_list))
-            glCallList(self.dlist('select_norapids', gen=self.make_selection_list))
+            renderer = self.toolpath_renderer()
+            if renderer is not None:
+                layers = ['feed', 'arcfeed']
+                if self.get_show_rapids():
+                    layers.insert(0, 'rapids')
+                renderer.drawSelection(layers)
+                self.canon.draw_dwells(self.canon.dwells, 1, 1)
+            else:
+                if self.get_show_rapids():
+                    glCallList(self.dlist('select_rapids', gen=self.make_selection_list))
+                glCallList(self.dlist('select_norapids', gen=self.make_selection_list))
 
             try:
                 buffer = list(glRenderMode(GL_RENDER))
@@ -512,6 +615,32 @@ class GlCanonDraw:
         glPopMatrix()
         glMatrixMode(GL_MODELVIEW)
 
+    def select_tool_line(self):
+        """Highlights the program line nearest to the tool, e.g. to find
+        where to run a program from after it was stopped.
+
+        Returns:
+            int: the line number, or None.
+        """
+        if self.canon is None:
+            return None
+        pos = self.lp.last(self.get_show_live_plot())
+        if pos is None:
+            return None
+        line = self.canon.nearest_line(self.to_internal_units(pos[:3]), self.get_show_rapids())
+        if line is not None:
+            self.set_highlight_line(line)
+        return line
+
+    # draws the dwells in the color ID of their line, see select()
+    def draw_pick_dwells(self):
+        dwells = self.canon.dwells
+        if not dwells:
+            return
+        colors = vbo_renderer.pick_colors([dwell[0] for dwell in dwells])[:, :3] / 255.
+        self.canon.draw_dwells([(dwell[0], tuple(color)) + tuple(dwell[2:])
+                                for dwell, color in zip(dwells, colors.tolist())], 1, 0)
+
     def dlist(self, name, n=1, gen=lambda n: None):
         if name not in self._dlists:
             base = glGenLists(n)
@@ -527,6 +656,129 @@ class GlCanonDraw:
     def __del__(self):
         for base, count in self._dlists.values():
             glDeleteLists(base, count)
+        if self._renderer is not None:
+            self._renderer.release()
+
+    def can_stream_preview(self):
+        """Returns True if a program can be drawn while it is loading.
+
+        Before the GL context has been checked for VBO support the batches
+        are streamed, stream_preview_batch() drops them if it has none.
+        """
+        return self._vbo_supported is not False and not self.is_foam()
+
+    def vbo_supported(self):
+        """Returns True if the program can be drawn from vertex buffer
+        objects. Must be called with the GL context current."""
+        if self._vbo_supported is None:
+            self._vbo_supported = vbo_renderer.supported()
+            if not self._vbo_supported:
+                LOG.info("VBOs not supported, drawing the program from display lists")
+        return self._vbo_supported
+
+    def stream_preview_batch(self, batch):
+        """Adds a batch of segments of a program that is still loading.
+
+        The current program is dropped with the first batch, and the full
+        program replaces the streamed layers once it has been loaded.
+        Must be called with the GL context current.
+
+        Args:
+            batch (dict): the toolpath.Segments of the 'rapids', 'feed' and
+                'arcfeed' layers, the running 'extents', and 'restart' if
+                the batches streamed so far have to be dropped.
+        """
+        if not self.vbo_supported():
+            return
+        if self._stream_extents is None or batch.get('restart'):
+            self.canon = None
+            self.stale_dlist('program_dwells')
+            if self._renderer is None:
+                self._renderer = vbo_renderer.ToolpathRenderer()
+            self._renderer.clear()
+            self._renderer_canon = None
+            self.add_toolpath_layers(self._renderer)
+        self._stream_extents = toolpath.Extents(*batch['extents'])
+
+        geometry = self.get_geometry()
+        for name, color in (('rapids', 'traverse'), ('feed', 'straight_feed'), ('arcfeed', 'arc_feed')):
+            a = batch[name]
+            if not len(a.lineno):
+                continue
+            vertices, seg = toolpath.project_lines(a.start, a.end, geometry)
+            rgba = self.colors[color] + (self.colors.get(color + '_alpha', 1/3.),)
+            self._renderer.appendData(name, vertices, rgba, a.lineno[seg])
+
+    def end_preview_stream(self):
+        self._stream_extents = None
+
+    def toolpath_renderer(self):
+        """Returns the VBO renderer of the program toolpath.
+
+        Returns None if vertex buffer objects can not be used, then the
+        program is drawn from display lists. Must be called with the GL
+        context current.
+        """
+        if self._stream_extents is not None:
+            return self._renderer
+        if self.canon is None or self.is_foam():
+            return None
+        if not self.vbo_supported():
+            return None
+        if self._renderer is None:
+            self._renderer = vbo_renderer.ToolpathRenderer()
+        if self._renderer_canon is not self.canon:
+            self.make_toolpath_layers()
+        return self._renderer
+
+    def add_toolpath_layers(self, renderer):
+        renderer.addLayer('rapids', stipple=True)
+        renderer.addLayer('feed')
+        renderer.addLayer('arcfeed')
+        renderer.addLayer('highlight', width=3)
+
+    def make_toolpath_layers(self):
+        renderer = self._renderer
+        canon = self.canon
+        geometry = self.get_geometry()
+        self.add_toolpath_layers(renderer)
+        size = math.sqrt(sum((b - a) ** 2 for a, b in zip(canon.min_extents, canon.max_extents)))
+        for name, store, color in (('rapids', canon.traverse, 'traverse'),
+                                   ('feed', canon.feed, 'straight_feed'),
+                                   ('arcfeed', canon.arcfeed, 'arc_feed')):
+            a = store.arrays()
+            vertices, seg = toolpath.project_lines(a.start, a.end, geometry)
+            rgba = self.colors[color] + (self.colors.get(color + '_alpha', 1/3.),)
+            # simplified versions are drawn when zoomed out, the full
+            # detail is only uploaded once zoomed in close enough
+            levels = toolpath.lod_levels(vertices, size) if len(vertices) and size < 1e99 else None
+            renderer.setData(name, vertices, rgba, a.lineno[seg], levels)
+        renderer.clear('highlight')
+        self._renderer_canon = canon
+
+    def pixel_size(self):
+        """Returns the size of a pixel at the center of the view in program
+        units, used to choose the level of detail to draw."""
+        w = max(self.winfo_width(), 1)
+        h = max(self.winfo_height(), 1)
+        distance = self.get_zoom_distance()
+        if self.perspective:
+            return 2 * abs(distance) * math.tan(math.radians(self.fovy) / 2) / h
+        return 2 * abs(distance or 1) ** .55555 / w
+
+    def make_highlight_layer(self, line):
+        geometry = self.get_geometry()
+        vertices = []
+        for store in (self.canon.traverse, self.canon.arcfeed, self.canon.feed):
+            rows = store.linesSegments(line)
+            if len(rows):
+                a = store.arrays()
+                vertices.append(toolpath.project_lines(a.start[rows], a.end[rows], geometry)[0])
+        if vertices:
+            self._renderer.setData('highlight', toolpath.numpy.concatenate(vertices),
+                                   self.colors['selected'] + (1,))
+        else:
+            self._renderer.clear('highlight')
 
     def update_highlight_variable(self,line):
         self.highlight_line = line
@@ -548,6 +800,9 @@ class GlCanonDraw:
                 x = (x+u)/2
                 y = (y+v)/2
                 z = (self.get_foam_z() + self.get_foam_w())/2
+            elif self.toolpath_renderer() is not None:
+                x, y, z = self.canon.highlight(line, self.get_geometry(), segments=False)
+                self.make_highlight_layer(line)
             else:
                 x, y, z = self.canon.highlight(line, self.get_geometry())
         elif self.canon is not None:
@@ -557,6 +812,8 @@ class GlCanonDraw:
         else:
             x, y, z = 0.0, 0.0, 0.0
         glEndList()
+        if line is None and self._renderer is not None:
+            self._renderer.clear('highlight')
         self.set_centerpoint(x, y, z)
 
     @with_context_swap
@@ -625,7 +882,7 @@ class GlCanonDraw:
 
     def show_extents(self):
         s = self.stat
-        g = self.canon
+        g = self.canon or self._stream_extents
 
         if g is None: return
 
@@ -1077,9 +1334,16 @@ class GlCanonDraw:
                 glEnable(GL_BLEND)
                 glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
-            if self.get_show_rapids():
-                glCallList(self.dlist('program_rapids', gen=self.make_main_list))
-            glCallList(self.dlist('program_norapids', gen=self.make_main_list))
+            renderer = self.toolpath_renderer()
+            if renderer is not None:
+                # toggling a layer does not need anything to be recompiled
+                renderer.setLayerVisible('rapids', self.get_show_rapids())
+                renderer.draw(tolerance=self.pixel_size())
+                glCallList(self.dlist('program_dwells', gen=self.make_dwell_list))
+            else:
+                if self.get_show_rapids():
+                    glCallList(self.dlist('program_rapids', gen=self.make_main_list))
+                glCallList(self.dlist('program_norapids', gen=self.make_main_list))
             glCallList(self.dlist('highlight'))
 
             if self.get_program_alpha():
@@ -1783,8 +2047,56 @@ class GlCanonDraw:
         glEnable(GL_CULL_FACE)
         glDepthFunc(GL_LESS)
 
+    def zoom_to_extents(self, min_extents, max_extents):
+        """Sets the current view to show a box instead of the program."""
+        self._zoom_extents = (min_extents, max_extents)
+        try:
+            self.set_current_view()
+        finally:
+            self._zoom_extents = None
+
+    def zoom_to_operation(self, index):
+        """Sets the current view to show one operation of the program.
+
+        Args:
+            index (int): the operation, 0 for the moves before the first tool
+                change, 1 for the moves after it and so on.
+
+        Returns:
+            bool: False if the operation has no moves or numpy is missing.
+        """
+        engine = self.canon and self.canon.extents_engine()
+        bounds = engine and engine.operationExtents(index)
+        if not bounds:
+            return False
+        self.zoom_to_extents(bounds.min_extents, bounds.max_extents)
+        return True
+
+    def zoom_to_tool(self, tool):
+        """Sets the current view to show all the moves of a tool.
+
+        Returns:
+            bool: False if the tool has no moves or numpy is missing.
+        """
+        engine = self.canon and self.canon.extents_engine()
+        bounds = engine and engine.toolExtents(tool)
+        if not bounds:
+            return False
+        self.zoom_to_extents(bounds.min_extents, bounds.max_extents)
+        return True
+
+    def program_operations(self):
+        """Returns the toolpath.Operations of the program, the first one is
+        for the moves before the first tool change."""
+        engine = self.canon and self.canon.extents_engine()
+        return engine.operations if engine else []
+
     def extents_info(self):
-        if self.canon:
+        if self._zoom_extents is not None:
+            min_extents, max_extents = self._zoom_extents
+            mid = [(a+b)/2 for a, b in zip(max_extents, min_extents)]
+            size = [(a-b) for a, b in zip(max_extents, min_extents)]
+        elif self.canon:
             mid = [(a+b)/2 for a, b in zip(self.canon.max_extents, self.canon.min_extents)]
             size = [(a-b) for a, b in zip(self.canon.max_extents, self.canon.min_extents)]
         else:
@@ -1802,6 +2114,14 @@ class GlCanonDraw:
         if self.canon: self.canon.draw(1, True)
         glEndList()
 
+    def make_dwell_list(self, n):
+        glNewList(n, GL_COMPILE)
+        if self.canon:
+            glLineWidth(2)
+            self.canon.draw_dwells(self.canon.dwells, self.colors.get('dwell_alpha', 1/3.), 0)
+            glLineWidth(1)
+        glEndList()
+
     def make_main_list(self, unused=None):
         program = self.dlist('program_norapids')
         rapids = self.dlist('program_rapids')
@@ -1814,16 +2134,34 @@ class GlCanonDraw:
         glEndList()
 
     def load_preview(self, f, canon, *args):
-        result, seq = gcode.parse(f, canon, *args)
+        result, seq = self.parse_preview(f, canon, *args)
+        self.preview_loaded(canon, result)
+        return result, seq
+
+    # does not touch any GL state, so can be run in a worker thread
+    def parse_preview(self, f, canon, *args):
+        result, seq = self.interpret_preview(f, canon, *args)
 
         if result <= gcode.MIN_ERROR:
             canon.calc_extents()
+            canon.build_line_index()
+            canon.build_spatial_index()
+
+        return result, seq
+
+    # runs the interpreter, returns the result and the last sequence
+    # number like gcode.parse
+    def interpret_preview(self, f, canon, *args):
+        return gcode.parse(f, canon, *args)
+
+    # must be called with the GL context current
+    def preview_loaded(self, canon, result):
+        if result <= gcode.MIN_ERROR:
             self.stale_dlist('program_rapids')
             self.stale_dlist('program_norapids')
             self.stale_dlist('select_rapids')
             self.stale_dlist('select_norapids')
-
-        return result, seq
+            self.stale_dlist('program_dwells')
 
     def from_internal_units(self, pos, unit=None):
         if unit is None:
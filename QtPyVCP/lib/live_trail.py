@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Bounded store of the live tool trail, a replacement for the unbounded
+#   linuxcnc.positionlogger that thins old history to stay under a set
+#   number of points.
+
+import time
+import threading
+
+from QtPyVCP.lib import toolpath
+from QtPyVCP.lib.toolpath import numpy
+
+try:
+    from OpenGL import GL
+except ImportError:
+    GL = None
+
+# the default max number of points, each takes 16 bytes
+DEFAULT_MAX_POINTS = 250000
+# samples closer than this to the line through their neighbours are dropped,
+# in machine units
+COLLINEAR_TOLERANCE = 1e-4
+# samples are kept in a list until this many are added to the arrays
+FLUSH_POINTS = 256
+# the newest part of the trail that is never thinned
+RECENT_FRACTION = .25
+# thinning makes room until the trail is at most this full
+THIN_FRACTION = .75
+# the times the thinning tolerance is doubled before old points are dropped
+MAX_THIN_PASSES = 24
+# simplify() keeps every MAX_SPAN-th point, which bounds how deep it splits
+# a long curve such as a helix
+MAX_SPAN = 1024
+
+
+class LiveTrail(object):
+    """Records the tool position for the live plot, in a bounded buffer.
+
+    Has the interface of `linuxcnc.positionlogger`. A sample that continues
+    the straight line of the two before it replaces the last one instead of
+    being added. When the buffer is full, the part older than the newest
+    RECENT_FRACTION is simplified with `simplify()`, with a tolerance that
+    doubles until the trail fits in THIN_FRACTION of the buffer, so the
+    oldest history is the most thinned. If that is not enough the oldest
+    points are dropped, like in a ring buffer. Requires numpy.
+
+    Args:
+        stat (linuxcnc.stat): a stat object used only by the logger thread.
+        colors (list): the RGBA colors of jog, traverse, feed, arc, tool
+            change and probing moves, as 0-255 ints.
+        geometry (str): the [DISPLAY] GEOMETRY of the machine.
+        max_points (int, optional): the max number of points of the trail.
+    """
+
+    def __init__(self, stat, colors, geometry, max_points=DEFAULT_MAX_POINTS):
+        self.stat = stat
+        self.colors = numpy.array(colors, numpy.uint8)
+        self.geometry = geometry
+        self.max_points = max(int(max_points), 4 * FLUSH_POINTS)
+        # the tolerance of the last thinning pass, in machine units
+        self.tolerance = COLLINEAR_TOLERANCE
+
+        self._lock = threading.Lock()
+        self._vertices = numpy.zeros((self.max_points, 3), numpy.float32)
+        self._rgba = numpy.zeros((self.max_points, 4), numpy.uint8)
+        self._count = 0
+        self._generation = 0
+        self._exit = False
+        self._paused = False
+        self._current = None
+        self.clear()
+
+    def start(self, interval):
+        """Samples the position every `interval` seconds until `stop()`."""
+        self._exit = False
+        while not self._exit:
+            if not self._paused:
+                self._sample()
+            time.sleep(interval)
+
+    def stop(self):
+        self._exit = True
+
+    def pause(self):
+        """Stops sampling until `resume()`, e.g. while the plot is hidden."""
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._count = 0
+            self._pending = []
+            self._pending_colors = []
+            self.tolerance = COLLINEAR_TOLERANCE
+            # the last two points of the trail, as (xyz, other axes, color)
+            self._prev = None
+            self._prev2 = None
+
+    def add(self, position, color=0):
+        """Adds a sample to the trail.
+
+        Args:
+            position (sequence): the XYZABCUVW position, in machine units.
+            color (int): the index of the color of the move.
+        """
+        position = tuple(position)
+        if not 0 <= color < len(self.colors):
+            color = 0
+        self._current = position
+        point = (position[:3], position[3:], color)
+
+        with self._lock:
+            prev = self._prev
+            if prev is not None and prev[1:] == point[1:]:
+                if _distance(prev[0], point[0]) <= COLLINEAR_TOLERANCE:
+                    return
+                if self._prev2 is not None and self._prev2[1:] == point[1:] and \
+                        _isCollinear(self._prev2[0], prev[0], point[0]):
+                    self._replaceLast(position)
+                    self._prev = point
+                    return
+
+            self._pending.append(position)
+            self._pending_colors.append(color)
+            self._prev2 = prev
+            self._prev = point
+            flush = len(self._pending) >= FLUSH_POINTS
+        if flush:
+            self._flush()
+
+    def last(self, flag=True):
+        """Returns the XYZ and ABC of the latest sample, or None.
+
+        The XYZ is mapped by the machine geometry, in machine units.
+        """
+        position = self._current
+        if position is None:
+            return None
+        xyz = toolpath.vertex9(numpy.array([position], numpy.float64), self.geometry)[0]
+        return tuple(xyz.tolist()) + tuple(position[3:6])
+
+    def points(self):
+        """Returns copies of the (n, 3) vertices and (n, 4) colors of the
+        trail."""
+        with self._lock:
+            vertices, rgba = self._pendingArrays()
+            return (numpy.concatenate((self._vertices[:self._count], vertices)),
+                    numpy.concatenate((self._rgba[:self._count], rgba)))
+
+    def call(self):
+        """Draws the trail as a line strip, in machine units."""
+        if GL is None:
+            return
+        with self._lock:
+            count = self._count
+            vertices, rgba = self._pendingArrays()
+            if count and len(vertices):
+                # connect the pending samples to the trail
+                vertices = numpy.concatenate((self._vertices[count - 1:count], vertices))
+                rgba = numpy.concatenate((self._rgba[count - 1:count], rgba))
+            if count + len(vertices) < 2:
+                return
+
+            GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+            try:
+                GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+                GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+                for v, c, n in ((self._vertices, self._rgba, count),
+                                (vertices, rgba, len(vertices))):
+                    if n < 2:
+                        continue
+                    GL.glVertexPointer(3, GL.GL_FLOAT, 0, v)
+                    GL.glColorPointer(4, GL.GL_UNSIGNED_BYTE, 0, c)
+                    GL.glDrawArrays(GL.GL_LINE_STRIP, 0, n)
+            finally:
+                GL.glPopClientAttrib()
+
+    def _sample(self):
+        s = self.stat
+        s.poll()
+        position = [p - t for p, t in zip(s.actual_position, s.tool_offset)]
+        self.add(position, s.motion_type)
+
+    def _pendingArrays(self):
+        if not self._pending:
+            return numpy.zeros((0, 3), numpy.float32), numpy.zeros((0, 4), numpy.uint8)
+        positions = numpy.array(self._pending, numpy.float64)
+        vertices = toolpath.vertex9(positions, self.geometry).astype(numpy.float32)
+        return vertices, self.colors[self._pending_colors]
+
+    def _replaceLast(self, position):
+        if self._pending:
+            self._pending[-1] = position
+        elif self._count:
+            xyz = toolpath.vertex9(numpy.array([position], numpy.float64), self.geometry)
+            self._vertices[self._count - 1] = xyz[0]
+
+    def _flush(self):
+        # thinning takes a while, so the old points are simplified without
+        # holding the lock, they only change in this thread
+        with self._lock:
+            generation = self._generation
+            count = self._count
+            thin = count + len(self._pending) > self.max_points
+        if thin:
+            recent = min(int(self.max_points * RECENT_FRACTION), count)
+            kept = self._thinOld(count - recent, int(self.max_points * THIN_FRACTION) - recent)
+
+        with self._lock:
+            if thin and generation == self._generation:
+                n = len(kept)
+                old = count - recent
+                self._vertices[:n] = self._vertices[kept]
+                self._rgba[:n] = self._rgba[kept]
+                self._vertices[n:n + recent] = self._vertices[old:count]
+                self._rgba[n:n + recent] = self._rgba[old:count]
+                self._count = n + recent
+
+            vertices, rgba = self._pendingArrays()
+            self._pending = []
+            self._pending_colors = []
+            # a flush is never more than the free space left by thinning
+            n = min(len(vertices), self.max_points - self._count)
+            self._vertices[self._count:self._count + n] = vertices[len(vertices) - n:]
+            self._rgba[self._count:self._count + n] = rgba[len(rgba) - n:]
+            self._count += n
+
+    def _thinOld(self, old, target):
+        """Returns the indices of the first `old` points to keep, at most
+        `target` of them."""
+        vertices = self._vertices[:old]
+        rgba = self._rgba[:old]
+        # keep the points where the color of the trail changes
+        breaks = numpy.flatnonzero((rgba[1:] != rgba[:-1]).any(1)) + 1
+        # start a bit finer than the last pass, the old part is already
+        # thinned at that tolerance
+        self.tolerance = max(self.tolerance / 4, COLLINEAR_TOLERANCE)
+        for _ in range(MAX_THIN_PASSES):
+            keep = simplify(vertices, self.tolerance, breaks)
+            if keep.sum() <= target:
+                break
+            self.tolerance *= 2
+
+        kept = numpy.flatnonzero(keep)
+        # drop the oldest points if simplifying was not enough
+        return kept[max(len(kept) - target, 0):]
+
+
+def simplify(points, tolerance, breaks=()):
+    """Douglas-Peucker simplification of a polyline.
+
+    All the spans of one subdivision level are split in one vectorized pass,
+    so it takes as many passes as the recursion would be deep. Every
+    MAX_SPAN-th point is kept to bound that depth.
+
+    Args:
+        points (ndarray): (n, 3) points of the polyline.
+        tolerance (float): the max distance of a dropped point from the
+            simplified line.
+        breaks (sequence, optional): indices of points that must be kept.
+
+    Returns:
+        ndarray: the (n,) bool mask of the points to keep.
+    """
+    n = len(points)
+    keep = numpy.zeros(n, bool)
+    if not n:
+        return keep
+    points = numpy.asarray(points, numpy.float64)
+    keep[::MAX_SPAN] = True
+    keep[n - 1] = True
+    keep[numpy.asarray(breaks, numpy.intp)] = True
+
+    kept = numpy.flatnonzero(keep)
+    starts = kept[:-1]
+    ends = kept[1:]
+    while True:
+        spans = ends - starts > 1
+        starts = starts[spans]
+        ends = ends[spans]
+        if not len(starts):
+            return keep
+
+        # the points strictly inside each span
+        lengths = ends - starts - 1
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+        owner = numpy.repeat(numpy.arange(len(starts)), lengths)
+        inside = numpy.arange(lengths.sum()) - offsets[owner] + starts[owner] + 1
+
+        a = points[starts][owner]
+        direction = points[ends][owner] - a
+        length = (direction ** 2).sum(1)
+        t = ((points[inside] - a) * direction).sum(1) / numpy.where(length > 0, length, 1)
+        t = numpy.clip(t, 0, 1)
+        distance = ((a + direction * t[:, numpy.newaxis] - points[inside]) ** 2).sum(1)
+
+        # the farthest point of each span, split where it is out of tolerance
+        farthest = numpy.maximum.reduceat(distance, offsets)
+        split = farthest > tolerance ** 2
+        first = numpy.flatnonzero(distance == farthest[owner])
+        # every span has inside points, so there is a first one of each
+        _, index = numpy.unique(owner[first], return_index=True)
+        middles = inside[first[index]][split]
+        keep[middles] = True
+        starts, ends = (numpy.concatenate((starts[split], middles)),
+                        numpy.concatenate((middles, ends[split])))
+
+
+def _distance(a, b):
+    return sum((x - y) ** 2 for x, y in zip(a, b)) ** .5
+
+
+def _isCollinear(a, b, c):
+    """Whether b is within COLLINEAR_TOLERANCE of the line a-c and between
+    a and c."""
+    ab = [y - x for x, y in zip(a, b)]
+    bc = [y - x for x, y in zip(b, c)]
+    if sum(x * y for x, y in zip(ab, bc)) < 0:
+        return False
+    ac = [x + y for x, y in zip(ab, bc)]
+    length = sum(x * x for x in ac)
+    if not length:
+        return True
+    cross = (ab[1] * ac[2] - ab[2] * ac[1],
+             ab[2] * ac[0] - ab[0] * ac[2],
+             ab[0] * ac[1] - ab[1] * ac[0])
+    return sum(x * x for x in cross) / length <= COLLINEAR_TOLERANCE ** 2
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Interprets big G-code programs for the preview with several processes.
+#
+#   The program is split at tool changes and top level subroutine calls.
+#   The interpreter state at each split is worked out by scanning the
+#   program, without interpreting it, and written as a preamble in front
+#   of the chunk of the program that follows. Each chunk is interpreted by
+#   a worker process with its own canon, and the segments are merged back
+#   in program order with their original line numbers. The scanning is
+#   done by program_scanner. The workers are forked from a helper process
+#   that is started before the application has any threads, see
+#   startHelper().
+#
+#   Programs the scanner can not follow, e.g. with parameters, incremental
+#   moves, cutter compensation or calls to subroutines in other files, are
+#   left to the usual sequential interpretation.
+
+import os
+import array
+import atexit
+import shutil
+import signal
+import tempfile
+import threading
+import traceback
+import multiprocessing
+
+import gcode
+import linuxcnc
+
+from QtPyVCP.lib import toolpath
+from QtPyVCP.lib import preview_cache
+from QtPyVCP.lib import program_scanner
+from QtPyVCP.lib.toolpath import numpy
+
+from QtPyVCP.utilities import logger
+LOG = logger.getLogger(__name__)
+
+# programs with fewer lines are always interpreted in one go
+MIN_PROGRAM_LINES = 100000
+
+
+class _Context(object):
+    """What the worker processes need, inherited when they are forked."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+_context = None
+
+
+def _initWorker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _scanBlock(block):
+    """Scans a block of the program, in a worker process."""
+    ctx = _context
+    return program_scanner.scanBlock(ctx.filename, block, ctx.subroutines, ctx.scanner,
+                                     ctx.percent)
+
+
+def _writeChunk(ctx, chunk, path):
+    """Writes the program file of a chunk.
+
+    The file has the subroutine definitions, the preamble and the chunk.
+
+    Returns:
+        tuple: the original line number of each line of the file, 0 for the
+            preamble, and the first line of the chunk.
+    """
+    linemap = array.array('i', [0])
+
+    def copy(fh, out, start_byte, end_byte, first_line, last_line):
+        fh.seek(start_byte)
+        data = fh.read(end_byte - start_byte)
+        if data and not data.endswith('\n'):
+            data += '\n'
+        out.write(data)
+        linemap.extend(xrange(first_line, last_line + 1))
+
+    with open(ctx.filename, 'rb') as fh, open(path, 'wb') as out:
+        for sub in ctx.subroutines:
+            copy(fh, out, sub.start_byte, sub.end_byte, sub.first_line, sub.last_line)
+        for line in chunk.preamble:
+            out.write(line + '\n')
+            linemap.append(0)
+
+        body_start = len(linemap)
+        lineno, pos = chunk.start_line, chunk.start_byte
+        if lineno == 1 and ctx.percent:
+            fh.seek(0)
+            pos += len(fh.readline())
+            lineno += 1
+        for sub in ctx.subroutines:
+            if sub.last_line < lineno or sub.first_line >= chunk.end_line:
+                continue
+            copy(fh, out, pos, sub.start_byte, lineno, sub.first_line - 1)
+            lineno, pos = sub.last_line + 1, sub.end_byte
+        if lineno < chunk.end_line:
+            copy(fh, out, pos, chunk.end_byte, lineno, chunk.end_line - 1)
+        out.write('M2\n')
+        linemap.append(0)
+    return linemap, body_start
+
+
+def _parseChunk(chunk):
+    """Interprets a chunk of the program, in a worker process.
+
+    The segments are saved in a directory named after the chunk index, see
+    preview_cache.save_canon().
+
+    Returns:
+        tuple: the chunk index, the interpreter result and the last
+            original line number, 0 if it is not in the program.
+    """
+    ctx = _context
+    path = os.path.join(ctx.tmpdir, str(chunk.index))
+    os.mkdir(path)
+    filename = os.path.join(path, 'chunk.ngc')
+    linemap, body_start = _writeChunk(ctx, chunk, filename)
+
+    canon = ctx.make_canon()
+    canon.parameter_file = os.path.join(path, os.path.basename(ctx.parameter_file))
+    shutil.copy(ctx.parameter_file, canon.parameter_file)
+
+    if chunk.first_move is not None:
+        # the preamble moves set up the position, but whether the next
+        # rapid is drawn depends on the moves before the split
+        next_line = canon.next_line
+
+        def first_line(st):
+            if st.sequence_number >= body_start:
+                canon.first_move = chunk.first_move
+                canon.next_line = next_line
+            next_line(st)
+
+        canon.next_line = first_line
+
+    # sequence numbers are line numbers, counted from 1
+    result, seq = gcode.parse(filename, canon, ctx.unitcode, ctx.initcode)
+
+    lines = numpy.frombuffer(linemap, numpy.int32)
+    # the number of segments kept before each segment of a store
+    kept = {}
+    for name in preview_cache.STORES:
+        store = getattr(canon, name)
+        a = store.arrays()
+        mapped = numpy.where(a.lineno < len(lines), lines[numpy.clip(a.lineno, 0, len(lines) - 1)], 0)
+        keep = mapped > 0
+        if chunk.index == 0:
+            # moves of the startup code
+            keep |= a.lineno == 0
+        kept[name] = numpy.concatenate(([0], numpy.cumsum(keep)))
+        store.setArrays(toolpath.Segments(
+            mapped[keep], a.start[keep], a.end[keep],
+            None if a.feed is None else a.feed[keep], a.tlo[keep]))
+
+    dwells = []
+    for dwell in canon.dwells:
+        lineno = lines[dwell[0]] if 0 < dwell[0] < len(lines) else 0
+        if lineno or (chunk.index == 0 and dwell[0] == 0):
+            dwells.append((int(lineno),) + tuple(dwell[1:]))
+    canon.dwells = dwells
+
+    # the tool change of a preamble continues the operation of the chunk
+    # before, the line numbers and segment counts are mapped like the moves
+    operations = []
+    for operation in canon.operations:
+        lineno = lines[operation.lineno] if 0 < operation.lineno < len(lines) else 0
+        if lineno or chunk.index == 0:
+            operations.append(operation._replace(lineno=int(lineno), **dict(
+                (name, int(kept[name][getattr(operation, name)])) for name in kept)))
+    canon.operations = operations
+
+    preview_cache.save_canon(path, canon, index=False)
+    seq = int(lines[seq]) if 0 <= seq < len(lines) else 0
+    return chunk.index, result, seq
+
+
+def _concatSegments(parts):
+    columns = zip(*parts)
+    return toolpath.Segments(*[None if column[0] is None else numpy.concatenate(column)
+                               for column in columns])
+
+
+
+
+class _Aborted(Exception):
+    """The program being interpreted by the helper is no longer wanted."""
+
+
+class _Exit(Exception):
+    """The helper has to exit."""
+
+
+def _checkAbort(conn, stop, parent_pid):
+    if stop.is_set() or os.getppid() != parent_pid:
+        raise _Exit()
+    if conn.poll():
+        conn.recv()
+        raise _Aborted()
+
+
+def _runJob(conn, stop, parent_pid, job):
+    """Interprets a program in chunks, in the helper process.
+
+    Sends ('sequential', reason) if the program can not be split, or
+    ('chunks', chunks, lines) and then ('chunk', index, result, seq) for
+    each chunk as it is done, in program order.
+    """
+    global _context
+    filename, processes = job['filename'], job['processes']
+    try:
+        lines, subroutines, blocks, percent = program_scanner.readProgram(filename, processes)
+        if lines < MIN_PROGRAM_LINES:
+            conn.send(('sequential', "program is short"))
+            return
+        scanner = program_scanner.Scanner(filename, subroutines)
+        effect = {}
+        for line in (job['unitcode'], job['initcode']):
+            scanner.scanLine(line, effect)
+        state = program_scanner.applied({}, effect)
+        for sub in subroutines:
+            scanner.subEffect(sub.name)
+    except program_scanner.Unsafe as e:
+        conn.send(('sequential', str(e)))
+        return
+
+    factory, args = job['canon']
+    _context = _Context(filename=filename, make_canon=lambda: factory(*args),
+                        unitcode=job['unitcode'], initcode=job['initcode'],
+                        parameter_file=job['parameter_file'], subroutines=subroutines,
+                        scanner=scanner, percent=percent, tmpdir=job['tmpdir'])
+    pool = multiprocessing.Pool(processes, _initWorker)
+    try:
+        scans = pool.map_async(_scanBlock, blocks)
+        while not scans.ready():
+            scans.wait(0.1)
+            _checkAbort(conn, stop, parent_pid)
+        try:
+            chunks = program_scanner.splitProgram(scans.get(), blocks, state, lines,
+                                                  processes, percent)
+        except program_scanner.Unsafe as e:
+            conn.send(('sequential', str(e)))
+            return
+        if chunks is None:
+            conn.send(('sequential', "no split points"))
+            return
+        conn.send(('chunks', chunks, lines))
+
+        results = pool.imap(_parseChunk, chunks)
+        for chunk in chunks:
+            while True:
+                try:
+                    index, result, seq = results.next(0.1)
+                    break
+                except multiprocessing.TimeoutError:
+                    _checkAbort(conn, stop, parent_pid)
+            conn.send(('chunk', index, result, seq))
+            if result > gcode.MIN_ERROR:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+        _context = None
+
+
+def _helperMain(conn, stop, parent_pid):
+    """Runs the jobs sent by parse(), each ends with a ('done',) message."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while not stop.is_set() and os.getppid() == parent_pid:
+        if not conn.poll(0.2):
+            continue
+        job = conn.recv()
+        if not isinstance(job, dict):
+            # an abort that came after the job was done
+            continue
+        try:
+            _runJob(conn, stop, parent_pid, job)
+        except _Aborted:
+            pass
+        except _Exit:
+            return
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+        conn.send(('done',))
+
+
+class _Helper(object):
+    """The process the worker pools are forked from.
+
+    A fork only copies the thread that forks, so locks held by other
+    threads of the GUI, e.g. in logging or the GL driver, would stay locked
+    in the workers forever. The helper is forked before there are any
+    threads and forks the workers in turn.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        # one program at a time, parse() falls back if the helper is busy
+        self.lock = threading.Lock()
+        self.busy = False
+        self.stop = multiprocessing.Event()
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_helperMain, name='preview-helper',
+                                               args=(child_conn, self.stop, os.getpid()))
+        # not a daemon, those can not have children
+        self.process.start()
+        child_conn.close()
+
+    def start(self, job):
+        job['processes'] = self.processes
+        self.busy = True
+        self.conn.send(job)
+
+    def receive(self, canon=None):
+        """Waits for the next message of the job, calls `canon.check_abort()`
+        before and while waiting if a canon is given."""
+        while True:
+            if canon is not None:
+                canon.check_abort()
+            if self.conn.poll(0.1):
+                break
+            if not self.process.is_alive():
+                self.busy = False
+                raise RuntimeError("Preview helper process exited")
+        message = self.conn.recv()
+        if message[0] == 'done':
+            self.busy = False
+        return message
+
+    def finish(self):
+        """Stops the job if it is still running and waits until it is done."""
+        if self.busy:
+            self.conn.send(('abort',))
+            while self.busy:
+                self.receive()
+
+    def close(self):
+        self.stop.set()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+_helper = None
+
+
+def configuredProcesses(inifile):
+    """Returns the number of processes the INI asks for.
+
+    Args:
+        inifile (linuxcnc.ini): the machine INI.
+
+    Returns:
+        int: [DISPLAY] PREVIEW_PROCESSES, 0 if the config has REMAP codes,
+            which can not be followed when splitting the program.
+    """
+    processes = int(inifile.find("DISPLAY", "PREVIEW_PROCESSES") or 0)
+    if inifile.findall("RS274NGC", "REMAP"):
+        return 0
+    return processes
+
+
+def startHelper(processes=None):
+    """Starts the process parse() runs the workers from.
+
+    Must be called before the application starts any threads, the
+    VCPApplication does it first thing. Without the helper every program
+    is interpreted the usual way.
+
+    Args:
+        processes (int, optional): the number of worker processes, read
+            from the INI if not given.
+
+    Returns:
+        bool: whether the helper is running.
+    """
+    global _helper
+    if _helper is not None:
+        return True
+    if processes is None:
+        ini_file = os.environ.get('INI_FILE_NAME')
+        if ini_file is None:
+            return False
+        inifile = linuxcnc.ini(ini_file)
+        processes = configuredProcesses(inifile)
+        if not processes and int(inifile.find("DISPLAY", "PREVIEW_PROCESSES") or 0) > 1:
+            LOG.info("PREVIEW_PROCESSES is ignored, the config has REMAP codes")
+    if numpy is None or processes < 2:
+        return False
+    _helper = _Helper(processes)
+    atexit.register(_helper.close)
+    LOG.debug("Started preview helper with {} processes".format(processes))
+    return True
+
+
+def parse(filename, canon, canon_factory, unitcode, initcode,
+          progress_callback=None, batch_callback=None):
+    """Interprets a program for the preview with several processes.
+
+    Must be called with the main canon, which gets the merged segments,
+    from the thread that would otherwise call gcode.parse. The program is
+    interpreted by the worker processes of the helper, see startHelper().
+
+    Args:
+        filename (str): the program file.
+        canon (GLCanon): the canon to store the segments in, its
+            `check_abort()` is called while waiting for the workers.
+        canon_factory (tuple): a function that returns a new canon for a
+            worker and its arguments, both picklable.
+        unitcode (str): the units G-code, as passed to gcode.parse.
+        initcode (str): the startup G-code, as passed to gcode.parse.
+        progress_callback (callable, optional): called with the percentage
+            of the program that has been interpreted.
+        batch_callback (callable, optional): called with the segments of
+            each chunk in program order, see StatCanon.flush_batch().
+
+    Returns:
+        tuple: the result and the last sequence number like gcode.parse, or
+            None if the program has to be interpreted the usual way.
+    """
+    helper = _helper
+    if helper is None or not helper.process.is_alive():
+        return None
+    if not helper.lock.acquire(False):
+        LOG.debug("Preview helper is busy, interpreting {} in one go".format(filename))
+        return None
+
+    tmpdir = tempfile.mkdtemp(prefix='qtpyvcp-preview-')
+    try:
+        helper.start(dict(filename=filename, canon=canon_factory, unitcode=unitcode,
+                          initcode=initcode, parameter_file=canon.parameter_file,
+                          tmpdir=tmpdir))
+        message = helper.receive(canon)
+        if message[0] == 'error':
+            LOG.warning("Parallel interpretation of {} failed:\n{}".format(filename, message[1]))
+            return None
+        elif message[0] != 'chunks':
+            LOG.debug("Not splitting program, {}".format(message[1]))
+            return None
+        chunks, lines = message[1:]
+        LOG.debug("Interpreting {} in {} chunks".format(filename, len(chunks)))
+
+        parts = dict((name, []) for name in preview_cache.STORES)
+        dwells = []
+        dwell_time = 0
+        operations = []
+        counts = dict((name, 0) for name in preview_cache.STORES)
+        extents = None
+        done = 0
+        for chunk in chunks:
+            message = helper.receive(canon)
+            if message[0] != 'chunk':
+                raise RuntimeError(message[-1])
+            index, result, seq = message[1:]
+            if result > gcode.MIN_ERROR and not seq:
+                # the error is in the preamble, interpret it again in one go
+                return None
+
+            path = os.path.join(tmpdir, str(index))
+            segments = {}
+            for name in preview_cache.STORES:
+                segments[name] = preview_cache.load_segments(path, name)[0]
+                parts[name].append(segments[name])
+            attributes = preview_cache.load_attributes(path)
+            dwells.extend(attributes['dwells'])
+            dwell_time += attributes['dwell_time']
+            for operation in attributes['operations']:
+                operations.append(operation._replace(**dict(
+                    (name, getattr(operation, name) + counts[name]) for name in counts)))
+            for name in counts:
+                counts[name] += len(segments[name].lineno)
+
+            done += chunk.end_line - chunk.start_line
+            if progress_callback is not None:
+                progress_callback(min(100, done * 100 / lines))
+            if batch_callback is not None:
+                batch = {'rapids': segments['traverse'], 'feed': segments['feed'],
+                         'arcfeed': segments['arcfeed']}
+                chunk_extents = toolpath.segments_extents(batch.values())
+                if extents is not None:
+                    chunk_extents = toolpath.merge_extents(extents, chunk_extents)
+                extents = batch['extents'] = chunk_extents
+                batch_callback(batch)
+
+            if result > gcode.MIN_ERROR:
+                # the interpreter stops at the error, so do the later chunks
+                break
+
+        for name in preview_cache.STORES:
+            getattr(canon, name).setArrays(_concatSegments(parts[name]))
+        canon.dwells.extend(dwells)
+        canon.dwell_time += dwell_time
+        canon.operations.extend(operations)
+        return result, seq
+
+    except Exception:
+        LOG.warning("Parallel interpretation of {} failed".format(filename), exc_info=True)
+        return None
+    finally:
+        try:
+            helper.finish()
+        except Exception:
+            LOG.warning("Lost the preview helper", exc_info=True)
+        helper.lock.release()
+        shutil.rmtree(tmpdir, ignore_errors=True)
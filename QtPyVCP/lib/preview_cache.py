@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   On-disk cache of interpreted G-code previews, so reopening a program
+#   does not have to run the interpreter again.
+
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from QtPyVCP.lib import toolpath
+from QtPyVCP.lib.toolpath import numpy
+
+from QtPyVCP.utilities import logger
+LOG = logger.getLogger(__name__)
+
+# change when the format of the cached data changes
+CACHE_VERSION = 2
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/qtpyvcp/preview')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+STORES = ('traverse', 'feed', 'arcfeed')
+COLUMNS = toolpath.Segments._fields
+
+COMMENT_RE = re.compile(r'\([^)]*\)|;.*')
+# o-word subroutine definitions and calls, of named, numbered and computed
+# o-words
+SUB_RE = re.compile(r'O\s*(<[^>]*>|\d+)\s*SUB\b')
+CALL_RE = re.compile(r'O\s*(<[^>]*>|\d+|\[[^\]]*\]|#<?[^\s>]*>?)\s*CALL\b')
+
+# GLCanon attributes saved along with the segments
+CANON_ATTRIBUTES = ('dwells', 'min_extents', 'max_extents', 'min_extents_notool',
+                    'max_extents_notool', 'dwell_time', 'foam_z', 'foam_w', 'operations')
+
+
+class PreviewCache(object):
+    """Caches the output of the preview canon in a directory per program.
+
+    The segment columns and the line index of each SegmentStore are saved
+    as .npy files and memory mapped when loaded, the rest of the canon state
+    is pickled. Entries are keyed by the contents of the program and of the
+    parameter file, along with the program file mtime, the units, the startup
+    code and the tool table. Only the `max_entries` most recently used
+    entries that fit in `max_bytes` are kept. Requires numpy.
+
+    Args:
+        path (str, optional): the cache directory.
+        max_entries (int, optional): the number of programs to keep.
+        max_bytes (int, optional): the max total size of the entries.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_entries=20, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def key(self, filename, unitcode, initcode, tool_table, parameter_file,
+            settings=(), search_path=(), extra_subs=()):
+        """Returns the cache key of a program, reads the whole file.
+
+        The subroutine files the program calls are hashed as well, found
+        the way the interpreter does in the `search_path` directories.
+
+        Args:
+            settings (tuple, optional): the canon and machine settings that
+                change the preview, e.g. lathe mode and GEOMETRY.
+            search_path (list, optional): the directories searched for
+                subroutine files, PROGRAM_PREFIX and SUBROUTINE_PATH.
+            extra_subs (list, optional): names of subroutines that may be
+                called by the config rather than the program, e.g. REMAPs.
+
+        Returns:
+            str: the key, or None if the program must not be cached because
+                it calls a subroutine that can not be resolved.
+        """
+        subs = _subroutineFiles(filename, search_path, extra_subs)
+        if subs is None:
+            LOG.debug("Not caching {}, it calls unresolved subroutines".format(filename))
+            return None
+
+        h = hashlib.sha1()
+        st = os.stat(filename)
+        h.update(repr((CACHE_VERSION, st.st_mtime, st.st_size, unitcode, initcode,
+                       tool_table, tuple(settings), tuple(search_path), tuple(extra_subs))))
+        _hashFile(h, filename)
+        if os.path.isfile(parameter_file):
+            _hashFile(h, parameter_file)
+        for sub in subs:
+            h.update(sub)
+            _hashFile(h, sub)
+        return h.hexdigest()
+
+    def load(self, key, canon):
+        """Loads a cached preview into a canon.
+
+        Returns:
+            bool: True if the preview was found in the cache.
+        """
+        path = os.path.join(self.path, key)
+        if not os.path.isfile(os.path.join(path, 'canon.pickle')):
+            return False
+
+        try:
+            load_canon(path, canon)
+
+            # mark as recently used
+            os.utime(path, None)
+        except Exception:
+            LOG.warning("Failed to load cached preview {}".format(key), exc_info=True)
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+
+        LOG.debug("Loaded preview from cache {}".format(key))
+        return True
+
+    def store(self, key, canon):
+        """Saves the preview in a canon to the cache."""
+        path = os.path.join(self.path, key)
+        if os.path.isdir(path):
+            return
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            # write to a temporary directory first, so an entry is never
+            # seen half written
+            tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+            try:
+                save_canon(tmp, canon)
+                os.rename(tmp, path)
+            except:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+        except Exception:
+            LOG.warning("Failed to cache preview {}".format(key), exc_info=True)
+            return
+
+        LOG.debug("Stored preview in cache {}".format(key))
+        self.prune()
+
+    def prune(self):
+        """Removes the least recently used entries over `max_entries` or
+        `max_bytes`."""
+        try:
+            entries = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                       if not name.startswith('.')]
+            entries.sort(key=os.path.getmtime, reverse=True)
+        except OSError:
+            return
+        total = 0
+        for i, path in enumerate(entries):
+            total += _dirSize(path)
+            if i >= self.max_entries or total > self.max_bytes:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def save_canon(path, canon, index=True):
+    """Writes the segments and state of a canon to a directory.
+
+    Args:
+        path (str): an existing directory.
+        canon (GLCanon): the canon to save.
+        index (bool, optional): whether to save the line index as well.
+    """
+    for name in STORES:
+        store = getattr(canon, name)
+        a = store.arrays()
+        for column in COLUMNS:
+            if getattr(a, column) is not None:
+                numpy.save(os.path.join(path, '{}.{}.npy'.format(name, column)), getattr(a, column))
+        if index:
+            lines, order = store.lineIndex()
+            numpy.save(os.path.join(path, '{}.index_lines.npy'.format(name)), lines)
+            numpy.save(os.path.join(path, '{}.index_order.npy'.format(name)), order)
+
+    attributes = dict((name, getattr(canon, name)) for name in CANON_ATTRIBUTES)
+    with open(os.path.join(path, 'canon.pickle'), 'wb') as fh:
+        pickle.dump(attributes, fh, pickle.HIGHEST_PROTOCOL)
+
+
+def load_segments(path, name):
+    """Memory maps a store saved by `save_canon()`.
+
+    Returns:
+        tuple: the toolpath.Segments of the store and its line index, or
+            None if the index was not saved.
+    """
+    columns = toolpath.Segments(*[_loadArray(path, name, column) for column in COLUMNS])
+    lines = _loadArray(path, name, 'index_lines')
+    order = _loadArray(path, name, 'index_order')
+    if lines is None or order is None:
+        return columns, None
+    return columns, (lines, order)
+
+
+def load_attributes(path):
+    """Returns the canon attributes saved by `save_canon()`."""
+    with open(os.path.join(path, 'canon.pickle'), 'rb') as fh:
+        return pickle.load(fh)
+
+
+def load_canon(path, canon):
+    """Loads a canon saved by `save_canon()`."""
+    attributes = load_attributes(path)
+    for name in STORES:
+        store = getattr(canon, name)
+        segments, index = load_segments(path, name)
+        if not store.has_feed:
+            segments = segments._replace(feed=None)
+        store.setArrays(segments, index)
+
+    for name, value in attributes.items():
+        setattr(canon, name, value)
+    canon.dwell_index = None
+
+
+def _loadArray(path, name, column):
+    filename = os.path.join(path, '{}.{}.npy'.format(name, column))
+    if not os.path.isfile(filename):
+        return None
+    return numpy.load(filename, mmap_mode='r')
+
+
+def _subroutineFiles(filename, search_path, extra_subs=()):
+    """Returns the subroutine files a program calls, directly or from other
+    subroutine files, or None if a call can not be resolved to a file."""
+    files = []
+    pending = [(filename, False)] + [(name, True) for name in extra_subs]
+    seen = set()
+    while pending:
+        name, is_sub = pending.pop()
+        if is_sub:
+            name = _findSubroutine(name, search_path)
+            if name is None:
+                return None
+            files.append(name)
+        if name in seen:
+            continue
+        seen.add(name)
+
+        with open(name) as fh:
+            text = COMMENT_RE.sub('', fh.read().upper())
+        defined = set(_oword(match) for match in SUB_RE.findall(text))
+        for match in CALL_RE.findall(text):
+            oword = _oword(match)
+            if oword in defined:
+                continue
+            if not oword.startswith('<'):
+                # numbered and computed o-words are not looked up in files
+                return None
+            pending.append((oword[1:-1], True))
+    return sorted(set(files))
+
+
+def _oword(text):
+    # o-word names are case insensitive and ignore white space
+    return re.sub(r'\s', '', text).lower()
+
+
+def _findSubroutine(name, search_path):
+    for directory in search_path:
+        path = os.path.join(directory, name + '.ngc')
+        if os.path.isfile(path):
+            return os.path.realpath(path)
+    return None
+
+
+def _dirSize(path):
+    size = 0
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return 0
+    for name in names:
+        try:
+            size += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return size
+
+
+def _hashFile(h, filename):
+    buf_size = 1024 * 1024
+    with open(filename, 'rb') as fh:
+        buf = fh.read(buf_size)
+        while buf:
+            h.update(buf)
+            buf = fh.read(buf_size)
@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Follows the state of a G-code program without interpreting it, to split
+#   the program for parallel_preview.
+#
+#   The effect of each part of the program on the interpreter state is
+#   worked out from its words. Values that depend on the state at the start
+#   of the part are kept as references and resolved once that state is
+#   known, so the parts can be scanned in parallel. Lines the scanner can
+#   not follow raise Unsafe.
+
+import os
+import re
+import bisect
+from collections import namedtuple
+
+# the smallest chunk that is worth a process
+MIN_CHUNK_LINES = 20000
+# more chunks than processes, so the work is spread evenly
+CHUNKS_PER_PROCESS = 2
+# the program is scanned in blocks of at least this many bytes
+MIN_BLOCK_SIZE = 1 << 20
+BLOCKS_PER_PROCESS = 4
+
+AXES = 'XYZABCUVW'
+
+# state values that are not G-code words
+DIRTY = '<dirty>'  # can not be known without interpreting the program
+UNSET = '<unset>'  # never set, the interpreter default is in effect
+
+PLANES = set(['17', '18', '19', '17.1', '18.1', '19.1'])
+LENGTH_UNITS = set(['20', '21'])
+FEED_MODES = set(['93', '94', '95'])
+DIAMETER_MODES = set(['7', '8'])
+COORDINATE_SYSTEMS = set(['54', '55', '56', '57', '58', '59', '59.1', '59.2', '59.3'])
+ARC_DISTANCE_MODES = set(['90.1', '91.1'])
+RETRACT_MODES = set(['98', '99'])
+
+RAPID = '0'
+FEED_MOTIONS = set(['1', '2', '3', '5', '5.1', '33'])
+# motions that do not end where their axis words say, canned cycles,
+# probing and rigid tapping
+OTHER_MOTIONS = set(['33.1', '38.2', '38.3', '38.4', '38.5', '73', '76', '80',
+                     '81', '82', '83', '84', '85', '86', '87', '88', '89'])
+MOTIONS = FEED_MOTIONS | OTHER_MOTIONS | set([RAPID])
+
+# codes that change state the scanner does not follow, with G16 the X and
+# Y words are polar coordinates. Without G16 the G15 default is always in
+# effect, so G15 needs no tracking.
+UNSAFE_G = set(['5.2', '5.3', '10', '16', '28', '30', '41', '41.1', '42', '42.1',
+                '43.1', '43.2', '52', '91', '92', '92.1', '92.2', '92.3'])
+# saving and restoring the modal state
+MODAL_STATE_M = set(['70', '71', '72', '73'])
+END_M = set(['2', '30'])
+
+# the modal state written at the end of a preamble, in this order
+MODAL_ITEMS = ('units', 'wcs', 'tlo', 'diameter', 'plane', 'arc_distance',
+               'feed_mode', 'retract')
+ALL_ITEMS = tuple(AXES) + MODAL_ITEMS + ('F', 'T', 'tool', 'motion', 'first_move')
+
+# o-word control flow, only followed inside subroutines
+SUB_FLOW = set(['IF', 'ELSEIF', 'ELSE', 'ENDIF', 'DO', 'WHILE', 'ENDWHILE', 'REPEAT',
+                'ENDREPEAT', 'BREAK', 'CONTINUE', 'RETURN', 'ENDSUB'])
+
+COMMENT_RE = re.compile(r'\([^)]*\)|;.*')
+WORD_RE = re.compile(r'([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))')
+# in subroutines values can be expressions and parameters
+SUB_WORD_RE = re.compile(r'([A-Z])([-+]?(?:\d+\.?\d*|\.\d+)|[\[#])')
+PARAMETER_NAME_RE = re.compile(r'#<[^>]*>')
+GLOBAL_ASSIGNMENT_RE = re.compile(r'#(<_[^>]*>|\d+)=')
+OWORD_RE = re.compile(r'(?:N\d+)?O(<[^>]*>|\d+)([A-Z]*)')
+SUB_DEFINITION_RE = re.compile(r'^[ \t]*(?:N[ \t]*\d+[ \t]*)?O[ \t]*(<[^>\n]*>|\d+)[ \t]*(SUB|ENDSUB)\b',
+                               re.I | re.M)
+
+# kinds of split points
+TOOL_CHANGE = 'tool change'
+CALL = 'call'
+END = 'end'
+
+Subroutine = namedtuple('Subroutine', 'name first_line last_line start_byte end_byte')
+Block = namedtuple('Block', 'start_line start_byte end_byte')
+Chunk = namedtuple('Chunk', 'index start_line start_byte end_line end_byte preamble first_move')
+
+
+class Unsafe(Exception):
+    """Raised for program lines the scanner can not follow."""
+
+
+class _Ref(object):
+    """The value of a state item at the start of a block."""
+
+    def __init__(self, key):
+        self.key = key
+
+
+class _Motion(object):
+    """A value that depends on the motion mode at the start of a block."""
+
+    def __init__(self, rapid, feed):
+        self.rapid = rapid
+        self.feed = feed
+
+
+def _resolve(value, state):
+    if isinstance(value, _Ref):
+        return state.get(value.key, UNSET)
+    if isinstance(value, _Motion):
+        motion = state.get('motion', UNSET)
+        if motion == RAPID:
+            return _resolve(value.rapid, state)
+        if motion in FEED_MOTIONS:
+            return _resolve(value.feed, state)
+        return DIRTY
+    if isinstance(value, tuple):
+        return tuple(_resolve(v, state) for v in value)
+    return value
+
+
+def applied(state, effect):
+    """Returns the state after a part of the program with `effect`."""
+    new = dict(state)
+    for key, value in effect.items():
+        new[key] = _resolve(value, state)
+    return new
+
+
+def _isDirty(value):
+    if isinstance(value, tuple):
+        return any(_isDirty(v) for v in value)
+    return value == DIRTY
+
+
+def _subName(text):
+    name = text.strip('<>').replace(' ', '').replace('\t', '').lower()
+    if name.isdigit():
+        name = str(int(name))
+    return name
+
+
+def parseLine(line, in_sub=False):
+    """Splits a program line into words.
+
+    Returns:
+        tuple: ('words', gcodes, mcodes, values), (CALL, name) or (END,),
+            or None for lines without words.
+    """
+    if '(' in line or ';' in line:
+        if '(AXIS,' in line.upper():
+            raise Unsafe('AXIS comment')
+        line = COMMENT_RE.sub('', line)
+    line = line.upper().replace(' ', '').replace('\t', '').strip()
+    if not line:
+        return None
+    if line == '%':
+        return (END,)
+    if line[0] == '/':
+        raise Unsafe('block delete')
+
+    if in_sub:
+        for match in GLOBAL_ASSIGNMENT_RE.finditer(line):
+            if match.group(1).startswith('<') or int(match.group(1)) > 30:
+                raise Unsafe('global parameter set in subroutine')
+        line = PARAMETER_NAME_RE.sub('#', line)
+
+    oword = OWORD_RE.match(line) if 'O' in line else None
+    if oword is not None:
+        keyword = oword.group(2)
+        if keyword == 'CALL':
+            if '#' in line and not in_sub:
+                raise Unsafe('parameters')
+            return (CALL, _subName(oword.group(1)))
+        if in_sub and keyword in SUB_FLOW:
+            return None
+        raise Unsafe('o-word {}'.format(keyword.lower()))
+
+    if in_sub:
+        words = SUB_WORD_RE.findall(line)
+    elif '#' in line or '[' in line or 'O' in line:
+        raise Unsafe('parameters or expressions')
+    else:
+        words = WORD_RE.findall(line)
+
+    gcodes = set()
+    mcodes = set()
+    values = {}
+    for letter, value in words:
+        if letter == 'G' or letter == 'M':
+            if value == '[' or value == '#':
+                raise Unsafe('computed G or M code')
+            code = '%g' % float(value)
+            if letter == 'G':
+                gcodes.add(code)
+            else:
+                mcodes.add(code)
+        else:
+            values[letter] = value
+    return ('words', gcodes, mcodes, values)
+
+
+def applyWords(gcodes, mcodes, values, effect, dirty=False):
+    """Applies the words of a line to `effect`, in the order the interpreter
+    executes them.
+
+    Args:
+        dirty (bool, optional): make everything the line changes DIRTY, for
+            subroutines, whose control flow is not followed.
+
+    Returns:
+        TOOL_CHANGE or END for lines that change the tool or end the program.
+    """
+    unsafe = gcodes & UNSAFE_G
+    if unsafe:
+        raise Unsafe('G{}'.format(min(unsafe)))
+    if mcodes & MODAL_STATE_M:
+        if not dirty:
+            raise Unsafe('M{}'.format(min(mcodes & MODAL_STATE_M)))
+        for key in MODAL_ITEMS + ('motion',):
+            effect[key] = DIRTY
+
+    def value(key):
+        text = values[key]
+        if dirty or text == '[' or text == '#':
+            return DIRTY
+        return text
+
+    def modal(key, group):
+        codes = gcodes & group
+        if codes:
+            effect[key] = DIRTY if dirty else codes.pop()
+
+    kind = None
+    modal('feed_mode', FEED_MODES)
+    if 'F' in values:
+        feed = value('F')
+        if feed != DIRTY:
+            feed = (feed, effect.get('units', _Ref('units')), effect.get('feed_mode', _Ref('feed_mode')))
+        effect['F'] = feed
+    if 'T' in values:
+        effect['T'] = value('T')
+    if '6' in mcodes:
+        effect['tool'] = DIRTY if dirty else ('6', effect.get('T', _Ref('T')))
+        effect['first_move'] = DIRTY if dirty else True
+        kind = TOOL_CHANGE
+    if '61' in mcodes:
+        effect['tool'] = ('61', value('Q')) if 'Q' in values else DIRTY
+        effect['first_move'] = DIRTY if dirty else True
+    modal('plane', PLANES)
+    modal('units', LENGTH_UNITS)
+    modal('diameter', DIAMETER_MODES)
+    if '49' in gcodes or '43' in gcodes:
+        if dirty:
+            effect['tlo'] = DIRTY
+        elif '49' in gcodes:
+            effect['tlo'] = ('49',)
+        else:
+            # without an H word the offset of the tool in the spindle is used
+            effect['tlo'] = ('43', value('H') if 'H' in values else effect.get('tool', _Ref('tool')))
+        effect['first_move'] = DIRTY if dirty else True
+    modal('wcs', COORDINATE_SYSTEMS)
+    modal('arc_distance', ARC_DISTANCE_MODES)
+    modal('retract', RETRACT_MODES)
+    modal('motion', MOTIONS)
+
+    axes = [axis for axis in AXES if axis in values]
+    if axes:
+        # None if the motion mode was set before this block
+        motion = effect.get('motion')
+        if dirty or motion == DIRTY:
+            for axis in axes:
+                effect[axis] = DIRTY
+            effect['first_move'] = DIRTY
+        else:
+            frame = ('g53' if '53' in gcodes else 'abs',)
+            frame_values = (effect.get('units', _Ref('units')), effect.get('wcs', _Ref('wcs')),
+                            effect.get('tlo', _Ref('tlo')), effect.get('diameter', _Ref('diameter')))
+            for axis in axes:
+                position = value(axis)
+                if position != DIRTY:
+                    position = frame + (position,) + frame_values
+                    if motion is None:
+                        position = _Motion(position, position)
+                    elif motion != RAPID and motion not in FEED_MOTIONS:
+                        position = DIRTY
+                effect[axis] = position
+
+            if motion is None:
+                if not isinstance(effect.get('first_move'), _Motion):
+                    effect['first_move'] = _Motion(effect.get('first_move', _Ref('first_move')), False)
+            elif motion in OTHER_MOTIONS:
+                # canned cycles end at the retract plane
+                for axis in 'XYZ':
+                    effect[axis] = DIRTY
+                effect['first_move'] = False
+            elif motion != RAPID:
+                effect['first_move'] = False
+
+    if mcodes & END_M:
+        kind = END
+    return kind
+
+
+class Scanner(object):
+    """Works out the effect of the subroutines defined in a program."""
+
+    def __init__(self, filename, subroutines):
+        self.filename = filename
+        self.subroutines = dict((sub.name, sub) for sub in subroutines)
+        self._effects = {}
+        self._scanning = set()
+
+    def subEffect(self, name):
+        """Returns the effect of calling a subroutine, everything it may
+        change is DIRTY."""
+        effect = self._effects.get(name)
+        if effect is not None:
+            return effect
+
+        sub = self.subroutines.get(name)
+        if sub is None:
+            raise Unsafe('call of subroutine {} from another file'.format(name))
+        if name in self._scanning:
+            return dict((key, DIRTY) for key in ALL_ITEMS)
+
+        self._scanning.add(name)
+        try:
+            with open(self.filename, 'rb') as fh:
+                fh.seek(sub.start_byte)
+                lines = fh.read(sub.end_byte - sub.start_byte).splitlines()
+            effect = {}
+            for line in lines[1:-1]:
+                self.scanLine(line, effect, in_sub=True)
+        finally:
+            self._scanning.discard(name)
+        self._effects[name] = effect
+        return effect
+
+    def scanLine(self, line, effect, in_sub=False):
+        parsed = parseLine(line, in_sub)
+        if parsed is None:
+            return None
+        if parsed[0] == CALL:
+            effect.update(self.subEffect(parsed[1]))
+            return CALL
+        if parsed[0] == END:
+            return END
+        return applyWords(parsed[1], parsed[2], parsed[3], effect, dirty=in_sub)
+
+
+def readProgram(filename, processes):
+    """Finds the subroutine definitions and splits the file into blocks.
+
+    Returns:
+        tuple: the number of lines, the Subroutines, the Blocks and whether
+            the program is delimited by percent signs.
+    """
+    size = os.path.getsize(filename)
+    block_size = max(MIN_BLOCK_SIZE, size // (processes * BLOCKS_PER_PROCESS) + 1)
+    subroutines = []
+    blocks = []
+    open_sub = None
+    line = 1
+    offset = 0
+    with open(filename, 'rb') as fh:
+        percent = fh.readline().strip() == '%'
+        fh.seek(0)
+        while True:
+            data = fh.read(block_size)
+            if not data:
+                break
+            if not data.endswith('\n'):
+                data += fh.readline()
+            blocks.append(Block(line, offset, offset + len(data)))
+
+            pos = 0
+            match_line = line
+            for match in SUB_DEFINITION_RE.finditer(data):
+                match_line += data.count('\n', pos, match.start())
+                pos = match.start()
+                name = _subName(match.group(1))
+                if match.group(2).upper() == 'SUB':
+                    if open_sub is not None:
+                        raise Unsafe('nested subroutine definition')
+                    open_sub = (name, match_line, offset + match.start())
+                else:
+                    if open_sub is None or open_sub[0] != name:
+                        raise Unsafe('endsub without sub')
+                    end = data.find('\n', match.end())
+                    end = len(data) if end < 0 else end + 1
+                    subroutines.append(Subroutine(name, open_sub[1], match_line, open_sub[2], offset + end))
+                    open_sub = None
+
+            line += data.count('\n')
+            offset += len(data)
+            last = data
+
+    if open_sub is not None:
+        raise Unsafe('sub without endsub')
+    if blocks and not last.endswith('\n'):
+        # the last line has no newline
+        line += 1
+    return line - 1, subroutines, blocks, percent
+
+
+def scanBlock(filename, block, subroutines, scanner, percent):
+    """Scans a block of the program.
+
+    Args:
+        filename (str): the program file.
+        block (Block): the part of the program to scan.
+        subroutines (list): the Subroutines defined in the program, in
+            program order, see readProgram().
+        scanner (Scanner): gives the effect of the subroutine calls.
+        percent (bool): whether the program is delimited by percent signs.
+
+    Returns:
+        dict: the 'effect' of the block, the split point 'candidates' as
+            (line, byte offset, kind, effect before the line, set again)
+            tuples, the 'end' of the program as (line after it, byte offset
+            after it, kind) if it is in the block, and the reason the
+            program is 'unsafe' to split, if it is. `set again` are the axes
+            and F set after a tool change before the first feed move, their
+            values from before the tool change do not matter.
+    """
+    subs = subroutines
+    first_lines = [sub.first_line for sub in subs]
+    effect = {}
+    candidates = []
+    end = None
+    set_again = None
+    lineno = block.start_line
+    pos = block.start_byte
+    try:
+        with open(filename, 'rb') as fh:
+            fh.seek(pos)
+            j = max(bisect.bisect_right(first_lines, lineno) - 1, 0)
+            for line in fh:
+                if pos >= block.end_byte:
+                    break
+                start = pos
+                pos += len(line)
+                this = lineno
+                lineno += 1
+
+                # subroutine definitions are scanned separately
+                while j < len(subs) and subs[j].last_line < this:
+                    j += 1
+                if j < len(subs) and subs[j].first_line <= this:
+                    continue
+                if this == 1 and percent:
+                    continue
+
+                parsed = parseLine(line)
+                if parsed is None:
+                    continue
+                if parsed[0] == CALL:
+                    candidates.append((this, start, CALL, dict(effect), set()))
+                    effect.update(scanner.subEffect(parsed[1]))
+                    set_again = None
+                elif parsed[0] == END:
+                    end = (this, start, '%')
+                    break
+                else:
+                    gcodes, mcodes, values = parsed[1:]
+                    if '6' in mcodes:
+                        set_again = set()
+                        candidates.append((this, start, TOOL_CHANGE, dict(effect), set_again))
+                    if applyWords(gcodes, mcodes, values, effect) == END:
+                        end = (lineno, pos, 'M2')
+                        break
+                    if set_again is not None:
+                        if 'F' in values:
+                            set_again.add('F')
+                        axes = [axis for axis in AXES if axis in values]
+                        if axes and effect.get('motion') == RAPID:
+                            set_again.update(axes)
+                        elif axes:
+                            set_again = None
+    except Unsafe as e:
+        return {'unsafe': 'line {}: {}'.format(lineno - 1, e)}
+    return {'effect': effect, 'candidates': candidates, 'end': end, 'unsafe': None}
+
+
+def _frameWords(units, wcs, tlo, diameter):
+    words = []
+    if units != UNSET:
+        words.append('G' + units)
+    if wcs != UNSET:
+        words.append('G' + wcs)
+    if diameter != UNSET:
+        words.append('G' + diameter)
+    if tlo != UNSET:
+        if tlo[0] == '49':
+            words.append('G49')
+        elif tlo[1] == UNSET:
+            words.append('G43')
+        else:
+            # a tool reference is a ('6' or '61', number) tuple
+            words.append('G43 H' + (tlo[1][1] if isinstance(tlo[1], tuple) else tlo[1]))
+    return words
+
+
+def preambleLines(state, kind, set_again=()):
+    """Returns the lines that recreate the interpreter state at a split
+    point, or None if it can not be recreated. Items in `set_again` are set
+    by the chunk before they are used, they are left out if not known."""
+    state = dict((key, value) for key, value in state.items()
+                 if key not in set_again or not _isDirty(value))
+    for key, value in state.items():
+        if key == 'first_move' and kind == TOOL_CHANGE:
+            continue
+        if _isDirty(value):
+            return None
+    motion = state.get('motion', UNSET)
+    if motion not in (UNSET, RAPID, '1', '80'):
+        return None
+    feed = state.get('F', UNSET)
+    if motion == '1' and feed == UNSET:
+        return None
+
+    lines = []
+    tool = state.get('tool', UNSET)
+    if tool != UNSET:
+        if tool[0] == '61':
+            lines.append('M61 Q' + tool[1])
+        elif tool[1] != UNSET:
+            lines.append('T{} M6'.format(tool[1]))
+
+    # each axis is moved with the units and offsets it was last set with,
+    # groups set earlier have fewer modes set and go first, because the
+    # interpreter defaults can not be selected again once changed
+    groups = {}
+    for axis in AXES:
+        position = state.get(axis, UNSET)
+        if position != UNSET:
+            frame = (position[0],) + position[2:]
+            groups.setdefault(frame, []).append(axis + position[1])
+    for frame in sorted(groups, key=lambda frame: sum(v != UNSET for v in frame[1:])):
+        words = _frameWords(*frame[1:])
+        if frame[0] == 'g53':
+            words.append('G53')
+        lines.append(' '.join(words + ['G0'] + groups[frame]))
+
+    # a motion mode can only be selected with a move, so move by nothing
+    if motion in (RAPID, '1'):
+        lines.append('G91 G{} X0{}'.format(motion, ' F1' if motion == '1' else ''))
+        lines.append('G90')
+    elif motion == '80':
+        lines.append('G80')
+
+    if feed != UNSET:
+        text, units, feed_mode = feed
+        words = _frameWords(units, UNSET, UNSET, UNSET)
+        if feed_mode != UNSET:
+            words.append('G' + feed_mode)
+        lines.append(' '.join(words + ['F' + text]))
+
+    words = _frameWords(*[state.get(key, UNSET) for key in MODAL_ITEMS[:4]])
+    words += ['G' + state[key] for key in MODAL_ITEMS[4:] if state.get(key, UNSET) != UNSET]
+    if words:
+        lines.append(' '.join(words))
+    if state.get('T', UNSET) != UNSET:
+        lines.append('T' + state['T'])
+    return lines
+
+
+def splitProgram(scans, blocks, state, lines, processes, percent):
+    """Picks the split points.
+
+    Returns:
+        list: the Chunks, or None if there are no split points far enough
+            apart.
+
+    Raises:
+        Unsafe: if a block of the program can not be followed.
+    """
+    candidates = []
+    end = None
+    for scan in scans:
+        if scan['unsafe']:
+            raise Unsafe(scan['unsafe'])
+        for lineno, offset, kind, effect, set_again in scan['candidates']:
+            split_state = applied(state, effect)
+            preamble = preambleLines(split_state, kind, set_again)
+            if preamble is None:
+                continue
+            first_move = None
+            if kind == CALL:
+                first_move = split_state.get('first_move', UNSET) in (UNSET, True)
+            candidates.append((lineno, offset, preamble, first_move))
+        state = applied(state, scan['effect'])
+        if scan['end'] is not None:
+            end = scan['end']
+            break
+
+    if end is None:
+        if percent:
+            return None
+        end = (lines + 1, blocks[-1].end_byte, None)
+    elif end[2] == '%' and not percent:
+        return None
+    end_line, end_byte = end[:2]
+
+    target = max(MIN_CHUNK_LINES, end_line // (processes * CHUNKS_PER_PROCESS))
+    splits = [(1, 0, [], None)]
+    for candidate in candidates:
+        if candidate[0] - splits[-1][0] >= target and end_line - candidate[0] >= MIN_CHUNK_LINES:
+            splits.append(candidate)
+    if len(splits) < 2:
+        return None
+
+    chunks = []
+    for i, (lineno, offset, preamble, first_move) in enumerate(splits):
+        next_line, next_byte = splits[i + 1][:2] if i + 1 < len(splits) else (end_line, end_byte)
+        chunks.append(Chunk(i, lineno, offset, next_line, next_byte, preamble, first_move))
+    return chunks
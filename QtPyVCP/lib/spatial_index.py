@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Uniform grid over the toolpath segments of a program, to find the line
+#   nearest to a point without scanning the whole program.
+
+from QtPyVCP.lib.toolpath import numpy
+
+STORES = ('traverse', 'feed', 'arcfeed')
+
+# the average number of segments per grid cell
+CELL_SEGMENTS = 8
+# the max number of cells along an axis
+MAX_CELLS = 1024
+# segments too long for the cells of a level go to a level with cells this
+# many times bigger
+LEVEL_SCALE = 8
+# fewer segments than this are checked one by one instead
+MIN_GRID_SEGMENTS = 256
+
+
+class SegmentGrid(object):
+    """Loose uniform grids over the XYZ segments of a program.
+
+    Each segment is put in the cell of its midpoint, so a segment is in
+    exactly one cell and a grid is built with one sort. Segments longer
+    than a cell go to a coarser grid, and the few longest ones to a list
+    that every query checks. A query looks at the cells of each grid in
+    growing shells around the point, until no unvisited segment can be
+    nearer than the best one found. The segment arrays are not copied, the
+    grids only hold their order. Requires numpy.
+
+    Args:
+        stores (dict): the 'traverse', 'feed' and 'arcfeed' SegmentStores.
+    """
+
+    def __init__(self, stores):
+        self.segments = [stores[name].arrays() for name in STORES]
+        counts = [len(a.lineno) for a in self.segments]
+        # the first global segment number of each store
+        self.offsets = numpy.cumsum([0] + counts)
+        self.levels = []
+        self.rest = numpy.zeros(0, numpy.int64)
+        if not self.offsets[-1]:
+            return
+
+        mids = numpy.concatenate([(a.start[:, :3] + a.end[:, :3]) / 2 for a in self.segments])
+        half = numpy.concatenate([numpy.sqrt(((a.end[:, :3] - a.start[:, :3]) ** 2).sum(1)) / 2
+                                  for a in self.segments])
+        lo = mids.min(0)
+        size = mids.max(0) - lo
+
+        # cubic cells, sized for CELL_SEGMENTS segments per cell over the
+        # axes the program moves in
+        extent = size.max()
+        cell_size = 1.
+        if extent > 0:
+            axes = size > extent * 1e-6
+            cells = max(float(len(mids)) / CELL_SEGMENTS, 1.)
+            cell_size = (numpy.prod(size[axes]) / cells) ** (1. / axes.sum())
+            cell_size = max(cell_size, extent / MAX_CELLS)
+
+        segments = numpy.arange(len(mids))
+        while len(segments) >= MIN_GRID_SEGMENTS:
+            small = half[segments] <= cell_size
+            if small.any():
+                self.levels.append(_Level(mids, segments[small], lo, size, cell_size))
+            segments = segments[~small]
+            if extent <= cell_size:
+                break
+            cell_size *= LEVEL_SCALE
+        self.rest = segments
+
+    def nearest(self, xyz, rapids=True):
+        """Finds the segment nearest to a point.
+
+        Args:
+            xyz (sequence): the XYZ point.
+            rapids (bool, optional): whether traverse moves can be found.
+
+        Returns:
+            tuple: the line number of the segment and the distance to it, or
+                None if there are no segments.
+        """
+        point = numpy.asarray(xyz, numpy.float64)[:3]
+        first = 0 if rapids else self.offsets[1]
+        best = None
+
+        rest = self.rest[self.rest >= first]
+        if len(rest):
+            best = self._nearestOf(rest, point)
+
+        for level in self.levels:
+            center = level.cells(point[numpy.newaxis])[0]
+            radius = 0
+            while True:
+                lo = numpy.maximum(center - radius, 0)
+                hi = numpy.minimum(center + radius, level.shape - 1)
+                candidates = level.shell(center, radius, lo, hi)
+                candidates = candidates[candidates >= first]
+                if len(candidates):
+                    found = self._nearestOf(candidates, point)
+                    if best is None or found[1] < best[1]:
+                        best = found
+
+                # the segments not visited yet have their midpoint outside
+                # the box of cells lo-hi, and reach at most a cell from it
+                bound = level.outsideDistance(point, lo, hi)
+                if bound is None:
+                    break
+                if best is not None and best[1] <= bound - level.cell_size:
+                    break
+                radius += 1
+
+        return best
+
+    def _nearestOf(self, segments, point):
+        """Returns the line number and distance of the nearest of some
+        segments, given by global number."""
+        which = numpy.searchsorted(self.offsets, segments, 'right') - 1
+        best = None
+        for i, a in enumerate(self.segments):
+            rows = segments[which == i] - self.offsets[i]
+            if not len(rows):
+                continue
+            start = a.start[rows, :3]
+            direction = a.end[rows, :3] - start
+            length = (direction ** 2).sum(1)
+            t = ((point - start) * direction).sum(1) / numpy.where(length > 0, length, 1)
+            t = numpy.clip(t, 0, 1)
+            distance = (((start + direction * t[:, numpy.newaxis]) - point) ** 2).sum(1)
+            j = numpy.argmin(distance)
+            if best is None or distance[j] < best[1]:
+                best = (int(a.lineno[rows[j]]), float(distance[j]))
+        return best[0], best[1] ** .5
+
+
+class _Level(object):
+    """One grid of SegmentGrid, with the segments at most a cell long."""
+
+    def __init__(self, mids, segments, origin, size, cell_size):
+        self.origin = origin
+        self.cell_size = cell_size
+        self.shape = numpy.minimum(numpy.floor(size / cell_size).astype(numpy.int64) + 1, MAX_CELLS)
+        # the segments of cell i are order[starts[i]:starts[i + 1]]
+        keys = self.keys(self.cells(mids[segments]))
+        self.order = segments[numpy.argsort(keys, kind='mergesort')].astype(numpy.int32)
+        counts = numpy.bincount(keys, minlength=int(self.shape.prod()))
+        self.starts = numpy.concatenate(([0], numpy.cumsum(counts)))
+
+    def cells(self, points):
+        cells = numpy.floor((points - self.origin) / self.cell_size).astype(numpy.int64)
+        return numpy.clip(cells, 0, self.shape - 1)
+
+    def keys(self, cells):
+        return (cells[:, 0] * self.shape[1] + cells[:, 1]) * self.shape[2] + cells[:, 2]
+
+    def shell(self, center, radius, lo, hi):
+        """Returns the global numbers of the segments in the cells at a
+        Chebyshev distance of `radius` from the center cell."""
+        ranges = [numpy.arange(lo[i], hi[i] + 1) for i in range(3)]
+        x, y, z = numpy.meshgrid(*ranges, indexing='ij')
+        cells = numpy.column_stack((x.ravel(), y.ravel(), z.ravel()))
+        keys = self.keys(cells[numpy.abs(cells - center).max(1) == radius])
+        starts = self.starts[keys]
+        stops = self.starts[keys + 1]
+        parts = [self.order[start:stop] for start, stop in zip(starts.tolist(), stops.tolist())
+                 if stop > start]
+        if not parts:
+            return numpy.zeros(0, numpy.int64)
+        return numpy.concatenate(parts).astype(numpy.int64)
+
+    def outsideDistance(self, point, lo, hi):
+        """Returns the distance from a point to the part of the grid outside
+        the box of cells lo-hi, None if the box covers the grid."""
+        grid_lo = self.origin
+        grid_hi = self.origin + self.shape * self.cell_size
+        distances = []
+        for i in range(3):
+            if lo[i] > 0:
+                region_hi = grid_hi.copy()
+                region_hi[i] = self.origin[i] + lo[i] * self.cell_size
+                distances.append(_boxDistance(point, grid_lo, region_hi))
+            if hi[i] < self.shape[i] - 1:
+                region_lo = grid_lo.copy()
+                region_lo[i] = self.origin[i] + (hi[i] + 1) * self.cell_size
+                distances.append(_boxDistance(point, region_lo, grid_hi))
+        if not distances:
+            return None
+        return min(distances)
+
+
+def _boxDistance(point, lo, hi):
+    offset = numpy.maximum(numpy.maximum(lo - point, point - hi), 0)
+    return numpy.sqrt((offset ** 2).sum())
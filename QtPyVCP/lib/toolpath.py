@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Compact storage for the toolpath segments produced by GLCanon.
+
+import array
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# number of segments per storage chunk
+CHUNK_SIZE = 65536
+
+# the columns of a SegmentStore as numpy arrays, `start` and `end` are
+# (n, 9) XYZABCUVW positions, `tlo` is the (n, 3) XYZ tool offset and `feed`
+# is None for stores without feed rates
+Segments = namedtuple('Segments', 'lineno start end feed tlo')
+
+# the extents of a program, as returned by `calc_extents()`
+Extents = namedtuple('Extents', 'min_extents max_extents min_extents_notool max_extents_notool')
+
+# a tool change, the segments of each store from the given counts on belong
+# to the operation, up to the next tool change
+Operation = namedtuple('Operation', 'lineno tool traverse feed arcfeed')
+
+
+class SegmentStore(object):
+    """Columnar storage for the traverse, feed or arcfeed moves of a program.
+
+    Segments are stored in typed arrays, one per column, instead of a tuple
+    and two lists per move. Storage grows one chunk of `chunk_size`
+    segments at a time, and a chunk is never written to again once full.
+
+    Iterating or indexing a store yields the same tuples GLCanon used to
+    keep in its lists, `(lineno, start, end, [feedrate,] tlo)`, and
+    `iterchunks()` yields them one chunk at a time as lists for the
+    `linuxcnc` and `gcode` C functions. If numpy is installed `arrays()`
+    returns the columns as numpy arrays.
+
+    Args:
+        has_feed (bool): whether the segments have a feed rate, traverse
+            moves do not.
+        chunk_size (int, optional): number of segments per chunk.
+    """
+
+    def __init__(self, has_feed=True, chunk_size=CHUNK_SIZE):
+        self.has_feed = has_feed
+        self.chunk_size = chunk_size
+        self._chunks = []
+        self._count = 0
+        # once arrays() has been called the segments are moved to numpy
+        # arrays, later segments go to new chunks again
+        self._arrays = None
+        self._frozen = 0
+        self._index = None
+        self._newChunk()
+
+    def _newChunk(self):
+        self._lineno = array.array('i')
+        self._start = array.array('d')
+        self._end = array.array('d')
+        self._feed = array.array('d')
+        self._tlo = array.array('d')
+        self._chunks.append((self._lineno, self._start, self._end, self._feed, self._tlo))
+        self._room = self.chunk_size
+
+    def append(self, lineno, start, end, feedrate, tlo):
+        """Add a segment.
+
+        Args:
+            lineno (int): the program line the segment belongs to.
+            start (sequence): the XYZABCUVW start position.
+            end (sequence): the XYZABCUVW end position.
+            feedrate (float): the feed rate, ignored if the store has none.
+            tlo (sequence): the XYZ tool offset.
+        """
+        if not self._room:
+            self._newChunk()
+        self._room -= 1
+        self._count += 1
+        self._index = None
+
+        self._lineno.append(lineno)
+        self._start.extend(start)
+        self._end.extend(end)
+        if self.has_feed:
+            self._feed.append(feedrate)
+        self._tlo.extend(tlo)
+
+    def extend(self, lineno, start, points, feedrate, tlo):
+        """Add a polyline, one segment from each point to the next.
+
+        Returns:
+            the last point, or `start` if there are no points.
+        """
+        append = self.append
+        for end in points:
+            append(lineno, start, end, feedrate, tlo)
+            start = end
+        return start
+
+    def __len__(self):
+        return self._count
+
+    def _chunkRow(self, chunk, i):
+        lineno, start, end, feed, tlo = chunk
+        j = i * 9
+        k = i * 3
+        if self.has_feed:
+            return (lineno[i], tuple(start[j:j + 9]), tuple(end[j:j + 9]),
+                    feed[i], list(tlo[k:k + 3]))
+        return (lineno[i], tuple(start[j:j + 9]), tuple(end[j:j + 9]),
+                list(tlo[k:k + 3]))
+
+    def _frozenRow(self, i):
+        a = self._arrays
+        if self.has_feed:
+            return (int(a.lineno[i]), tuple(a.start[i].tolist()), tuple(a.end[i].tolist()),
+                    float(a.feed[i]), a.tlo[i].tolist())
+        return (int(a.lineno[i]), tuple(a.start[i].tolist()), tuple(a.end[i].tolist()),
+                a.tlo[i].tolist())
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("segment index out of range")
+        if i < self._frozen:
+            return self._frozenRow(i)
+        i -= self._frozen
+        return self._chunkRow(self._chunks[i // self.chunk_size], i % self.chunk_size)
+
+    def __iter__(self):
+        for rows in self.iterchunks():
+            for row in rows:
+                yield row
+
+    def iterchunks(self):
+        """Yields the segments at most one chunk at a time as lists of tuples."""
+        row = self._frozenRow
+        for i in xrange(0, self._frozen, self.chunk_size):
+            yield [row(j) for j in xrange(i, min(i + self.chunk_size, self._frozen))]
+
+        row = self._chunkRow
+        for chunk in self._chunks:
+            if len(chunk[0]):
+                yield [row(chunk, i) for i in xrange(len(chunk[0]))]
+
+    def tolist(self):
+        return list(self)
+
+    def buildLineIndex(self):
+        """Builds the index used by `segmentsForLine()`.
+
+        With numpy the index is the segment numbers sorted by line number,
+        so the segments of a line are found with a binary search. Without
+        numpy it is a dict of the segment numbers of each line.
+        """
+        if numpy is not None:
+            lineno = self.arrays().lineno
+            order = numpy.argsort(lineno, kind='mergesort').astype(numpy.int32)
+            self._index = (lineno[order], order)
+        else:
+            index = {}
+            i = 0
+            for lineno in self._columns(0):
+                rows = index.get(lineno)
+                if rows is None:
+                    rows = index[lineno] = array.array('i')
+                rows.append(i)
+                i += 1
+            self._index = index
+        return self._index
+
+    def lineIndex(self):
+        """Returns the line index, building it if needed."""
+        if self._index is None:
+            self.buildLineIndex()
+        return self._index
+
+    def setArrays(self, segments, index=None):
+        """Replaces the contents of the store with numpy columns.
+
+        Args:
+            segments (Segments): the columns, e.g. memory mapped from a file.
+            index (optional): the line index of the segments, as returned by
+                `lineIndex()`.
+        """
+        self._arrays = segments
+        self._count = self._frozen = len(segments.lineno)
+        self._chunks = []
+        self._newChunk()
+        self._index = index
+
+    def linesSegments(self, lineno):
+        """Returns the numbers of the segments that belong to a line."""
+        index = self._index
+        if index is None:
+            index = self.buildLineIndex()
+        if numpy is not None:
+            lines, order = index
+            return order[lines.searchsorted(lineno, 'left'):lines.searchsorted(lineno, 'right')]
+        return index.get(lineno, ())
+
+    def segmentsForLine(self, lineno):
+        """Returns the (start, end) positions of the segments of a line."""
+        rows = self.linesSegments(lineno)
+        if numpy is not None:
+            a = self.arrays()
+            return zip(map(tuple, a.start[rows].tolist()), map(tuple, a.end[rows].tolist()))
+        result = []
+        for i in rows:
+            row = self[i]
+            result.append((row[1], row[2]))
+        return result
+
+    def _columns(self, column):
+        """Yields the values of one of the chunked columns."""
+        for chunk in self._chunks:
+            for value in chunk[column]:
+                yield value
+
+    def rows(self, start, stop):
+        """Returns a copy of the columns of segments `start` to `stop`.
+
+        Unlike `arrays()` this leaves the storage alone, so it can be used
+        while the store is still being filled, from the filling thread.
+
+        Returns:
+            Segments: the segment columns as numpy arrays.
+        """
+        parts = []
+        if start < self._frozen:
+            a = self._arrays
+            end = min(stop, self._frozen)
+            parts.append(Segments(a.lineno[start:end], a.start[start:end], a.end[start:end],
+                                  None if a.feed is None else a.feed[start:end], a.tlo[start:end]))
+        offset = self._frozen
+        for chunk in self._chunks:
+            lo = max(start - offset, 0)
+            hi = min(stop - offset, len(chunk[0]))
+            offset += len(chunk[0])
+            if lo >= hi:
+                continue
+            lineno, pstart, pend, feed, tlo = chunk
+            parts.append(Segments(
+                numpy.frombuffer(lineno, numpy.int32)[lo:hi],
+                numpy.frombuffer(pstart, numpy.float64).reshape(-1, 9)[lo:hi],
+                numpy.frombuffer(pend, numpy.float64).reshape(-1, 9)[lo:hi],
+                numpy.frombuffer(feed, numpy.float64)[lo:hi] if self.has_feed else None,
+                numpy.frombuffer(tlo, numpy.float64).reshape(-1, 3)[lo:hi]))
+
+        if not parts:
+            return Segments(numpy.zeros(0, numpy.int32), numpy.zeros((0, 9)), numpy.zeros((0, 9)),
+                            numpy.zeros(0) if self.has_feed else None, numpy.zeros((0, 3)))
+        columns = zip(*parts)
+        return Segments(*[None if column[0] is None else numpy.concatenate(column)
+                          for column in columns])
+
+    def arrays(self):
+        """Returns the columns as numpy arrays.
+
+        The chunks are moved into the arrays, so the segments are not kept
+        twice. Returns None if numpy is not available.
+
+        Returns:
+            Segments: the segment columns.
+        """
+        if numpy is None:
+            return None
+        if self._arrays is None or self._frozen != self._count:
+            columns = zip(*self._chunks)
+            frozen = self._arrays or Segments(None, None, None, None, None)
+            lineno = _concat(frozen.lineno, columns[0], numpy.int32)
+            start = _concat(frozen.start, columns[1], numpy.float64, 9)
+            end = _concat(frozen.end, columns[2], numpy.float64, 9)
+            feed = _concat(frozen.feed, columns[3], numpy.float64) if self.has_feed else None
+            tlo = _concat(frozen.tlo, columns[4], numpy.float64, 3)
+            self._arrays = Segments(lineno, start, end, feed, tlo)
+            self._frozen = self._count
+            self._chunks = []
+            self._newChunk()
+        return self._arrays
+
+
+def _concat(frozen, parts, dtype, width=None):
+    parts = [numpy.frombuffer(part, dtype) for part in parts if len(part)]
+    if width is not None:
+        parts = [part.reshape(-1, width) for part in parts]
+    if frozen is not None:
+        parts.insert(0, frozen)
+    if not parts:
+        return numpy.zeros((0, width) if width else 0, dtype)
+    return numpy.concatenate(parts)
+
+
+def calc_extents(stores):
+    """Vectorized version of `gcode.calc_extents` for SegmentStores.
+
+    Returns:
+        tuple: the min and max XYZ extents, and the min and max XYZ extents
+            with the tool offset added, as lists. Requires numpy.
+    """
+    return segments_extents(store.arrays() for store in stores)
+
+
+def segments_extents(segments):
+    """Returns the extents of Segments, see `calc_extents()`."""
+    extents = [9e99] * 3, [-9e99] * 3, [9e99] * 3, [-9e99] * 3
+    for a in segments:
+        if not len(a.lineno):
+            continue
+        start = a.start[:, :3]
+        end = a.end[:, :3]
+        extents = merge_extents(extents, (
+            numpy.minimum(start.min(0), end.min(0)).tolist(),
+            numpy.maximum(start.max(0), end.max(0)).tolist(),
+            numpy.minimum((start + a.tlo).min(0), (end + a.tlo).min(0)).tolist(),
+            numpy.maximum((start + a.tlo).max(0), (end + a.tlo).max(0)).tolist()))
+    return extents
+
+
+def merge_extents(a, b):
+    """Combines two (min, max, min_tlo, max_tlo) extents tuples."""
+    return ([min(i, j) for i, j in zip(a[0], b[0])],
+            [max(i, j) for i, j in zip(a[1], b[1])],
+            [min(i, j) for i, j in zip(a[2], b[2])],
+            [max(i, j) for i, j in zip(a[3], b[3])])
+
+
+def vertex9(points, geometry):
+    """Vectorized version of the `linuxcnc` vertex9 function.
+
+    Maps XYZABCUVW positions to XYZ display coordinates according to the
+    [DISPLAY] GEOMETRY of the machine.
+
+    Args:
+        points (ndarray): (n, 9) positions.
+        geometry (str): the geometry string, e.g. 'XYZ' or '-XYZAC'.
+
+    Returns:
+        ndarray: (n, 3) positions.
+    """
+    p = numpy.zeros((len(points), 3))
+    sign = 1
+    for letter in geometry:
+        if letter == '-':
+            sign = -1
+            continue
+        if letter in 'XYZ':
+            p[:, 'XYZ'.index(letter)] += sign * points[:, 'XYZ'.index(letter)]
+        elif letter in 'UVW':
+            p[:, 'UVW'.index(letter)] += sign * points[:, 6 + 'UVW'.index(letter)]
+        elif letter in 'ABC':
+            i = 'ABC'.index(letter)
+            theta = numpy.radians(sign * points[:, 3 + i])
+            c = numpy.cos(theta)
+            s = numpy.sin(theta)
+            # the two coordinates rotated about the X, Y or Z axis
+            j, k = ((1, 2), (0, 2), (0, 1))[i]
+            pj = p[:, j] * c - p[:, k] * s
+            pk = p[:, j] * s + p[:, k] * c
+            p[:, j] = pj
+            p[:, k] = pk
+        sign = 1
+    return p
+
+
+def project_lines(start, end, geometry):
+    """Vectorized version of `linuxcnc.line9` for many segments.
+
+    Segments with rotary motion are split into steps the same way line9
+    does it, when the geometry has rotary axes.
+
+    Args:
+        start (ndarray): (n, 9) start positions.
+        end (ndarray): (n, 9) end positions.
+        geometry (str): the geometry string.
+
+    Returns:
+        tuple: the (2m, 3) float32 GL_LINES vertices and the (m,) index of
+            the segment each pair of vertices belongs to.
+    """
+    n = len(start)
+    seg = numpy.arange(n)
+    p0, p1 = start, end
+    if n and any(letter in geometry for letter in 'ABC'):
+        dc = numpy.abs(end[:, 3:6] - start[:, 3:6]).max(1)
+        steps = numpy.where(dc > 0, numpy.ceil(numpy.maximum(10, dc / 10)), 1).astype(numpy.int64)
+        if steps.max() > 1:
+            seg = numpy.repeat(seg, steps)
+            first = numpy.repeat(numpy.cumsum(steps) - steps, steps)
+            k = numpy.arange(len(seg)) - first
+            st = steps[seg].astype(numpy.float64)
+            delta = end[seg] - start[seg]
+            p0 = start[seg] + (k / st)[:, None] * delta
+            p1 = start[seg] + ((k + 1) / st)[:, None] * delta
+
+    vertices = numpy.empty((2 * len(seg), 3), numpy.float32)
+    vertices[0::2] = vertex9(p0, geometry)
+    vertices[1::2] = vertex9(p1, geometry)
+    return vertices, seg
+
+
+# tolerances of the level of detail polylines, as fractions of the size of
+# the program
+LOD_FRACTIONS = (1 / 256., 1 / 1024., 1 / 4096.)
+
+
+def decimate_lines(vertices, tolerance):
+    """Simplifies GL_LINES vertices with a bounded error.
+
+    Segments that join up are treated as a polyline, and consecutive
+    polyline points that fall into the same cell of a grid with a spacing
+    of `tolerance` are merged. No point moves more than `tolerance` times
+    the cell diagonal, and the first and last point of every polyline are
+    kept.
+
+    Args:
+        vertices (ndarray): (2n, 3) GL_LINES vertices.
+        tolerance (float): the grid spacing in program units.
+
+    Returns:
+        ndarray: the simplified (2m, 3) float32 GL_LINES vertices.
+    """
+    start = vertices[0::2]
+    end = vertices[1::2]
+    m = len(start)
+    if m == 0:
+        return numpy.zeros((0, 3), numpy.float32)
+
+    # a segment begins a new polyline if it does not start where the
+    # previous one ended
+    joined = numpy.all(start[1:] == end[:-1], axis=1)
+    begins = numpy.concatenate(([True], ~joined))
+    ends = numpy.concatenate((~joined, [True]))
+
+    # the points of all the polylines, the start of each polyline followed
+    # by the ends of its segments
+    end_idx = numpy.arange(m) + numpy.cumsum(begins)
+    begin_idx = end_idx[begins] - 1
+    points = numpy.empty((m + int(begins.sum()), 3), numpy.float64)
+    points[end_idx] = end
+    points[begin_idx] = start[begins]
+    first = numpy.zeros(len(points), bool)
+    first[begin_idx] = True
+    last = numpy.zeros(len(points), bool)
+    last[end_idx[ends]] = True
+
+    cells = numpy.floor(points / tolerance)
+    keep = first | last
+    keep[1:] |= numpy.any(cells[1:] != cells[:-1], axis=1)
+
+    kept = points[keep]
+    # connect each kept point to the next one of the same polyline
+    joins = ~first[keep][1:]
+    result = numpy.empty((2 * int(joins.sum()), 3), numpy.float32)
+    result[0::2] = kept[:-1][joins]
+    result[1::2] = kept[1:][joins]
+    return result
+
+
+def lod_levels(vertices, size, fractions=LOD_FRACTIONS):
+    """Builds level of detail versions of GL_LINES vertices.
+
+    Args:
+        vertices (ndarray): (2n, 3) GL_LINES vertices.
+        size (float): the size of the program, e.g. its extents diagonal.
+        fractions (tuple): the tolerances as fractions of `size`.
+
+    Returns:
+        list: (tolerance, vertices) tuples, coarsest first. Levels that do
+            not save at least a third of the vertices of the next finer
+            level are left out.
+    """
+    levels = []
+    finer = len(vertices)
+    for fraction in sorted(fractions):
+        tolerance = size * fraction
+        if tolerance <= 0:
+            continue
+        simplified = decimate_lines(vertices, tolerance)
+        if len(simplified) < finer * 2 / 3:
+            levels.append((tolerance, simplified))
+            finer = len(simplified)
+    levels.reverse()
+    return levels
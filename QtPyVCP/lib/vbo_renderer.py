@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Draws the program toolpath from vertex buffer objects, so the GPU keeps
+#   the geometry and nothing has to be recompiled when a layer is toggled.
+
+import ctypes
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from OpenGL import GL
+except ImportError:
+    GL = None
+
+from QtPyVCP.utilities import logger
+LOG = logger.getLogger(__name__)
+
+# max number of vertices per buffer, large layers are split over several
+MAX_BUFFER_VERTICES = 1 << 20
+
+# the number of vertices per bounding box, parts of a buffer outside the
+# view are not drawn
+CULL_VERTICES = 1 << 14
+
+# the size in pixels of the area searched around a click
+PICK_SIZE = 5
+# line numbers are picked as 24 bit RGB colors, 0 is the background
+MAX_PICK_LINE = (1 << 24) - 2
+
+if numpy is not None:
+    # interleaved color and position, the GL_C4UB_V3F format
+    VERTEX_DTYPE = numpy.dtype([('color', numpy.uint8, 4), ('position', numpy.float32, 3)])
+
+
+def supported():
+    """Returns True if vertex buffer objects can be used.
+
+    Must be called with the GL context current.
+    """
+    if numpy is None or GL is None:
+        return False
+    try:
+        return bool(GL.glGenBuffers) and bool(GL.glBufferData)
+    except Exception:
+        return False
+
+
+class PickError(Exception):
+    """Raised if the color-ID pick pass can not be used."""
+
+
+def pick_colors(lineno):
+    """Returns the (n, 4) uint8 color IDs of line numbers, the RGB color of
+    a line is its line number + 1."""
+    ids = numpy.asarray(lineno, numpy.int64) + 1
+    colors = numpy.empty((len(ids), 4), numpy.uint8)
+    colors[:, 0] = ids & 0xff
+    colors[:, 1] = (ids >> 8) & 0xff
+    colors[:, 2] = (ids >> 16) & 0xff
+    colors[:, 3] = 0xff
+    return colors
+
+
+def pick_color(lineno):
+    """Returns the color ID of a line number as a 0-1 RGB tuple."""
+    return tuple(c / 255. for c in pick_colors([lineno])[0, :3].tolist())
+
+
+def view_matrix():
+    """Returns the current modelview * projection matrix, for row vectors."""
+    modelview = numpy.asarray(GL.glGetDoublev(GL.GL_MODELVIEW_MATRIX), numpy.float64).reshape(4, 4)
+    projection = numpy.asarray(GL.glGetDoublev(GL.GL_PROJECTION_MATRIX), numpy.float64).reshape(4, 4)
+    return modelview.dot(projection)
+
+
+def visible_boxes(lo, hi, matrix, rect=(-1, 1, -1, 1)):
+    """Returns which bounding boxes may be seen.
+
+    A box is hidden if all its corners are outside the same clip plane.
+
+    Args:
+        lo (ndarray): the (n, 3) min corners of the boxes.
+        hi (ndarray): the (n, 3) max corners of the boxes.
+        matrix (ndarray): the view matrix, see `view_matrix()`.
+        rect (tuple, optional): the part of the view to test against, as
+            xmin, xmax, ymin, ymax normalized device coordinates.
+
+    Returns:
+        ndarray: a bool for each box.
+    """
+    corners = numpy.ones((len(lo), 8, 4))
+    for i in range(8):
+        for axis in range(3):
+            corners[:, i, axis] = (hi if i >> axis & 1 else lo)[:, axis]
+    clip = corners.dot(matrix)
+    x, y, z, w = clip[..., 0], clip[..., 1], clip[..., 2], clip[..., 3]
+    xmin, xmax, ymin, ymax = rect
+    hidden = ((x < xmin * w).all(1) | (x > xmax * w).all(1) |
+              (y < ymin * w).all(1) | (y > ymax * w).all(1) |
+              (z < -w).all(1) | (z > w).all(1))
+    return ~hidden
+
+
+def _runs(mask):
+    """Returns the (start, stop) ranges of the True runs of a mask."""
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], mask, [0])).astype(numpy.int8)))
+    return zip(edges[::2].tolist(), edges[1::2].tolist())
+
+
+def make_vertices(positions, color):
+    """Builds interleaved vertex data.
+
+    Args:
+        positions (ndarray): (n, 3) vertex positions.
+        color (tuple | ndarray): a RGBA color in the 0-1 range used for all
+            the vertices, or a (n, 4) uint8 array of vertex colors.
+
+    Returns:
+        ndarray: the vertices, of VERTEX_DTYPE.
+    """
+    vertices = numpy.empty(len(positions), VERTEX_DTYPE)
+    vertices['position'] = positions
+    if isinstance(color, numpy.ndarray):
+        vertices['color'] = color
+    else:
+        vertices['color'] = [int(round(c * 255)) for c in color]
+    return vertices
+
+
+class Buffer(object):
+    """One vertex buffer object holding GL_LINES vertices."""
+
+    def __init__(self, vertices, lineno=None):
+        self.count = len(vertices)
+        # the line number of each segment, i.e. each pair of vertices
+        self.lineno = lineno
+        # the color IDs of the vertices, uploaded on the first pick
+        self.pick_vbo = None
+        # the bounding boxes of each CULL_VERTICES vertices
+        if self.count:
+            position = vertices['position']
+            starts = numpy.arange(0, self.count, CULL_VERTICES)
+            self.bounds_lo = numpy.minimum.reduceat(position, starts)
+            self.bounds_hi = numpy.maximum.reduceat(position, starts)
+        self.vbo = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.vbo)
+        data = numpy.ascontiguousarray(vertices).view(numpy.uint8)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, data.nbytes, data, GL.GL_STATIC_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def bind(self):
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.vbo)
+        GL.glInterleavedArrays(GL.GL_C4UB_V3F, 0, ctypes.c_void_p(0))
+
+    def ranges(self, matrix=None, rect=(-1, 1, -1, 1)):
+        """Returns the (first, count) vertex ranges that may be seen, all
+        of them if there is no view matrix."""
+        if matrix is None:
+            return [(0, self.count)] if self.count else []
+        if not self.count:
+            return []
+        visible = visible_boxes(self.bounds_lo, self.bounds_hi, matrix, rect)
+        return [(start * CULL_VERTICES, min(stop * CULL_VERTICES, self.count) - start * CULL_VERTICES)
+                for start, stop in _runs(visible)]
+
+    def draw(self, matrix=None):
+        ranges = self.ranges(matrix)
+        if not ranges:
+            return
+        self.bind()
+        for first, count in ranges:
+            GL.glDrawArrays(GL.GL_LINES, first, count)
+
+    def drawSelection(self):
+        """Draws the segments with the GL_SELECT name of their line."""
+        if self.lineno is None or not len(self.lineno):
+            return
+        self.bind()
+        lineno = self.lineno
+        starts = numpy.flatnonzero(numpy.diff(lineno)) + 1
+        starts = numpy.concatenate(([0], starts))
+        stops = numpy.concatenate((starts[1:], [len(lineno)]))
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            GL.glLoadName(int(lineno[start]))
+            GL.glDrawArrays(GL.GL_LINES, start * 2, (stop - start) * 2)
+
+    def drawPick(self, matrix=None, rect=(-1, 1, -1, 1)):
+        """Draws the segments in the color ID of their line, only the parts
+        of the buffer that may be seen in `rect` if a matrix is given."""
+        if self.lineno is None or not len(self.lineno):
+            return
+        ranges = self.ranges(matrix, rect)
+        if not ranges:
+            return
+        if self.pick_vbo is None:
+            if self.lineno.max() > MAX_PICK_LINE:
+                raise PickError("line numbers do not fit in a color ID")
+            colors = numpy.repeat(pick_colors(self.lineno), 2, axis=0)
+            self.pick_vbo = GL.glGenBuffers(1)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.pick_vbo)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, colors.nbytes, colors, GL.GL_STATIC_DRAW)
+
+        # the positions come from the interleaved buffer, the colors from
+        # the color ID buffer
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.vbo)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glVertexPointer(3, GL.GL_FLOAT, VERTEX_DTYPE.itemsize,
+                           ctypes.c_void_p(VERTEX_DTYPE.fields['position'][1]))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.pick_vbo)
+        GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+        GL.glColorPointer(4, GL.GL_UNSIGNED_BYTE, 0, ctypes.c_void_p(0))
+        for first, count in ranges:
+            GL.glDrawArrays(GL.GL_LINES, first, count)
+
+    def release(self):
+        if self.vbo is not None:
+            GL.glDeleteBuffers(1, [self.vbo])
+            self.vbo = None
+        if self.pick_vbo is not None:
+            GL.glDeleteBuffers(1, [self.pick_vbo])
+            self.pick_vbo = None
+
+
+def make_buffers(vertices, lineno=None):
+    """Uploads vertices, split over buffers of at most MAX_BUFFER_VERTICES."""
+    # the step is even, so the segment pairs stay together
+    step = MAX_BUFFER_VERTICES
+    return [Buffer(vertices[i:i + step], None if lineno is None else lineno[i // 2:(i + step) // 2])
+            for i in range(0, len(vertices), step)]
+
+
+class Layer(object):
+    """A named group of buffers drawn with the same line style.
+
+    A layer can have level of detail versions of its vertices. When it has,
+    the full detail vertices are only uploaded once they are needed.
+    """
+
+    def __init__(self, name, width=1, stipple=False, visible=True):
+        self.name = name
+        self.width = width
+        self.stipple = stipple
+        self.visible = visible
+        self.buffers = []
+        # (tolerance, buffers) tuples, coarsest first
+        self.levels = []
+        self._pending = None
+
+    def setData(self, vertices, lineno=None, levels=None):
+        self.clear()
+        if levels:
+            self.levels = [(tolerance, make_buffers(level)) for tolerance, level in levels]
+            self._pending = (vertices, lineno)
+        else:
+            self.buffers = make_buffers(vertices, lineno)
+
+    def appendData(self, vertices, lineno=None):
+        self.upload()
+        self.buffers.extend(make_buffers(vertices, lineno))
+
+    def upload(self):
+        if self._pending is not None:
+            vertices, lineno = self._pending
+            self._pending = None
+            self.buffers = make_buffers(vertices, lineno)
+
+    def buffersFor(self, tolerance=None):
+        """Returns the buffers to draw for a tolerance in program units, the
+        coarsest level of detail within it, or the full detail buffers."""
+        if tolerance is not None:
+            for level_tolerance, buffers in self.levels:
+                if level_tolerance <= tolerance:
+                    return buffers
+        self.upload()
+        return self.buffers
+
+    def clear(self):
+        for buf in self.buffers:
+            buf.release()
+        for tolerance, buffers in self.levels:
+            for buf in buffers:
+                buf.release()
+        self.buffers = []
+        self.levels = []
+        self._pending = None
+
+    def __len__(self):
+        if self._pending is not None:
+            return len(self._pending[0])
+        return sum(buf.count for buf in self.buffers)
+
+
+class ToolpathRenderer(object):
+    """Draws toolpath layers stored in vertex buffer objects.
+
+    The vertices of each layer are uploaded once, with the color of each
+    vertex interleaved with its position, and drawn with glDrawArrays.
+    Layers can be shown and hidden without uploading anything again.
+    All methods must be called with the GL context current.
+    """
+
+    def __init__(self):
+        self.layers = OrderedDict()
+        self._pick_supported = None
+
+    def addLayer(self, name, width=1, stipple=False, visible=True):
+        if name not in self.layers:
+            self.layers[name] = Layer(name, width, stipple, visible)
+        return self.layers[name]
+
+    def layer(self, name):
+        return self.layers.get(name)
+
+    def setLayerVisible(self, name, visible):
+        layer = self.layers.get(name)
+        if layer is not None:
+            layer.visible = visible
+
+    def isLayerVisible(self, name):
+        layer = self.layers.get(name)
+        return layer is not None and layer.visible
+
+    def setData(self, name, positions, color, lineno=None, levels=None):
+        """Replaces the vertices of a layer.
+
+        Args:
+            name (str): the layer name.
+            positions (ndarray): (2n, 3) GL_LINES vertex positions.
+            color (tuple): the RGBA color, see `make_vertices()`.
+            lineno (ndarray, optional): the (n,) line number of each segment.
+            levels (list, optional): (tolerance, positions) level of detail
+                versions of the positions, coarsest first.
+        """
+        if levels:
+            levels = [(tolerance, make_vertices(level, color)) for tolerance, level in levels]
+        self.addLayer(name).setData(make_vertices(positions, color), lineno, levels)
+
+    def appendData(self, name, positions, color, lineno=None):
+        """Adds vertices to a layer, used while a program is streamed in."""
+        self.addLayer(name).appendData(make_vertices(positions, color), lineno)
+
+    def clear(self, name=None):
+        for layer in self.layers.values():
+            if name is None or layer.name == name:
+                layer.clear()
+
+    def draw(self, names=None, tolerance=None):
+        """Draws the visible layers, or the visible layers in `names`.
+
+        Args:
+            names (list, optional): the names of the layers to draw.
+            tolerance (float, optional): the allowed error in program units,
+                usually the size of a pixel. Layers with level of detail
+                data draw the coarsest level within it.
+        """
+        matrix = view_matrix()
+        GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+        try:
+            for layer in self.layers.values():
+                if not layer.visible or not len(layer):
+                    continue
+                if names is not None and layer.name not in names:
+                    continue
+                GL.glLineWidth(layer.width)
+                if layer.stipple:
+                    GL.glEnable(GL.GL_LINE_STIPPLE)
+                for buf in layer.buffersFor(tolerance):
+                    buf.draw(matrix)
+                if layer.stipple:
+                    GL.glDisable(GL.GL_LINE_STIPPLE)
+        finally:
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            GL.glPopClientAttrib()
+            GL.glLineWidth(1)
+
+    def drawSelection(self, names):
+        """Draws the layers in `names` for GL_SELECT picking."""
+        GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+        try:
+            for name in names:
+                layer = self.layers.get(name)
+                if layer is None:
+                    continue
+                for buf in layer.buffersFor():
+                    buf.drawSelection()
+        finally:
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            GL.glPopClientAttrib()
+
+    def pick(self, x, y, names, draw_extra=None, size=PICK_SIZE):
+        """Finds the line drawn nearest to a window position.
+
+        The layers are drawn off-screen with the color ID of each line, only
+        in a small scissor box around the position, and the pixels read back.
+        Uses the current projection and modelview matrices, the GL state
+        changed for the pick pass, multisampling included, is restored.
+
+        Args:
+            x (int): the window x position.
+            y (int): the window y position, from the bottom.
+            names (list): the names of the layers to pick from.
+            draw_extra (callable, optional): draws more pickable items, in
+                the colors returned by `pick_color()`.
+            size (int, optional): the size of the searched area in pixels.
+
+        Returns:
+            int: the line number, or None if there is nothing at the position.
+
+        Raises:
+            PickError: if the framebuffer can not hold color IDs.
+        """
+        if self._pick_supported is None:
+            bits = [GL.glGetIntegerv(bit) for bit in (GL.GL_RED_BITS, GL.GL_GREEN_BITS, GL.GL_BLUE_BITS)]
+            self._pick_supported = min(bits) >= 8
+        if not self._pick_supported:
+            raise PickError("the framebuffer has less than 8 bits per color")
+
+        x0 = max(x - size // 2, 0)
+        y0 = max(y - size // 2, 0)
+
+        # only the parts of the buffers that may be seen in the pick box,
+        # with a pixel to spare, are drawn
+        vx, vy, width, height = [int(v) for v in GL.glGetIntegerv(GL.GL_VIEWPORT)]
+        rect = (2. * (x0 - 1 - vx) / width - 1, 2. * (x0 + size + 1 - vx) / width - 1,
+                2. * (y0 - 1 - vy) / height - 1, 2. * (y0 + size + 1 - vy) / height - 1)
+        matrix = view_matrix()
+
+        GL.glPushAttrib(GL.GL_ALL_ATTRIB_BITS)
+        GL.glPushClientAttrib(GL.GL_CLIENT_ALL_ATTRIB_BITS)
+        try:
+            GL.glEnable(GL.GL_SCISSOR_TEST)
+            GL.glScissor(x0, y0, size, size)
+            # multisampling would blend the edges of the lines into colors
+            # of other line numbers
+            for cap in (GL.GL_BLEND, GL.GL_DITHER, GL.GL_LIGHTING, GL.GL_FOG, GL.GL_TEXTURE_2D,
+                        GL.GL_LINE_SMOOTH, GL.GL_LINE_STIPPLE, GL.GL_CULL_FACE,
+                        GL.GL_MULTISAMPLE):
+                GL.glDisable(cap)
+            GL.glEnable(GL.GL_DEPTH_TEST)
+            GL.glDepthFunc(GL.GL_LESS)
+            GL.glDepthMask(GL.GL_TRUE)
+            GL.glClearColor(0, 0, 0, 0)
+            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+            GL.glLineWidth(1)
+
+            for name in names:
+                layer = self.layers.get(name)
+                if layer is None:
+                    continue
+                for buf in layer.buffersFor():
+                    buf.drawPick(matrix, rect)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            GL.glDisableClientState(GL.GL_COLOR_ARRAY)
+            if draw_extra is not None:
+                draw_extra()
+
+            GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+            data = GL.glReadPixels(x0, y0, size, size, GL.GL_RGB, GL.GL_UNSIGNED_BYTE)
+        finally:
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            GL.glPopClientAttrib()
+            GL.glPopAttrib()
+
+        # PyOpenGL returns a string or an array, depending on its settings
+        if isinstance(data, numpy.ndarray):
+            data = numpy.ravel(data)
+        else:
+            data = numpy.frombuffer(data, numpy.uint8)
+        pixels = data.astype(numpy.int64).reshape(size, size, 3)
+        ids = pixels[..., 0] | (pixels[..., 1] << 8) | (pixels[..., 2] << 16)
+        rows, columns = numpy.nonzero(ids)
+        if not len(rows):
+            return None
+        # the line nearest to the position wins
+        distance = (rows + y0 - y) ** 2 + (columns + x0 - x) ** 2
+        nearest = numpy.argmin(distance)
+        return int(ids[rows[nearest], columns[nearest]]) - 1
+
+    def release(self):
+        self.clear()
+        self.layers.clear()
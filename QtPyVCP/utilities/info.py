@@ -327,6 +327,29 @@ class _Info(object):
             return False
         return  temp
 
+    def getCycleTime(self, option='CYCLE_TIME', default=75):
+        '''Returns [DISPLAY] CYCLE_TIME in ms, values less than 1 are taken
+        to be in seconds, as with AXIS'''
+        temp = self.ini.find('DISPLAY', option)
+        if not temp:
+            return default
+        try:
+            cycle_time = float(temp)
+        except ValueError:
+            log.warning("Invalid [DISPLAY] {} entry in INI file, using {}ms".format(option, default))
+            return default
+        if cycle_time < 1:
+            cycle_time *= 1000
+        return int(cycle_time)
+
+    def getActiveCycleTime(self):
+        '''Returns [DISPLAY] ACTIVE_CYCLE_TIME in ms or 50'''
+        return self.getCycleTime('ACTIVE_CYCLE_TIME', 50)
+
+    def getIdleCycleTime(self):
+        '''Returns [DISPLAY] IDLE_CYCLE_TIME in ms or 250'''
+        return self.getCycleTime('IDLE_CYCLE_TIME', 250)
+
     def getStartupNotification(self):
         return self.ini.find('DISPLAY', 'STARTUP_NOTIFICATION')
 
@@ -18,8 +18,18 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import linuxcnc, time, threading, subprocess, os, json
-from PyQt5.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
+import linuxcnc, time, threading, subprocess, os, json, select
+import Queue
+from distutils.spawn import find_executable
+from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal, pyqtSlot
+
+from QtPyVCP.utilities.subscriptions import SubscriptionRegistry
+from QtPyVCP.utilities.status import Status as CoreStatus
+
+try:
+    import hal
+except ImportError:
+    hal = None
 
 # Setup logging
 try:
@@ -42,6 +52,9 @@ class StatusItem(QObject):
 
     valueChanged = pyqtSignal('PyQt_PyObject')
 
+    # set by the StatusPoller so it is notified when slots are connected
+    subscriptions = None
+
     def __init__(self, attr_name, index=None, key=None, stat=None):
         super(StatusItem, self).__init__()
         """StatusItem monitor class
@@ -71,10 +84,13 @@ class StatusItem(QObject):
         # Needed to avoid having both x==y and x!=y True at the same time!
         return not(self == other)
 
-    def update(self):
-        val = getattr(self.stat, self.attr_name)
-        if val == self.value:
-            return
+    def update(self, val):
+        """Update self from the value of the `linuxcnc.stat` attribute.
+
+        Args:
+            val: the value of the whole attribute, e.g. the `position` tuple.
+                Only the indexed/keyed element is compared with self.value.
+        """
         if self.index is not None:
             val = val[self.index]
             if self.key is not None:
@@ -90,6 +106,15 @@ class StatusItem(QObject):
                 log.debug("'{}' valueChanged => {}".format(self.formated_name, self.value))
 
 
+    def connectNotify(self, signal):
+        # start polling self as soon as something is connected
+        if self.subscriptions is not None:
+            self.subscriptions.invalidate()
+
+    def disconnectNotify(self, signal):
+        if self.subscriptions is not None:
+            self.subscriptions.invalidate()
+
     def connect(self, slot, log_change=False):
         log.debug("Connecting '{}' valueChanged signal to {}".format(self.formated_name, slot.__name__))
         self.valueChanged.connect(slot)
@@ -106,11 +131,7 @@ class StatusItem(QObject):
             self.valueChanged.disconnect()
 
     def getValue(self):
-        try:
-            self.stat.poll() # get fresh data
-        except Exception as e:
-            log.exception(e)
-            return
+        # the stat object is kept fresh by the status poll loop
         val = getattr(self.stat, self.attr_name)
         if self.index is not None:
             val = val[self.index]
@@ -138,35 +159,107 @@ class StatusItem(QObject):
 
 
 class StatusPoller(QObject):
-    """docstring for StatusPoller"""
+    """Provides `StatusItem` objects for `linuxcnc.stat` attributes.
 
-    stat = linuxcnc.stat()
-    timer = QTimer()
+    Does not poll on its own, the items are updated from the snapshots of
+    the shared status poll loop, so both status APIs see the same values.
+    """
 
     def __init__(self):
         super(StatusPoller, self).__init__()
 
         self.status_items = {}
 
-        # Start the timer
-        self._cycle_time = 75
-        self.timer.timeout.connect(self._poll)
-        self.timer.start(self._cycle_time)
+        self._core = CoreStatus()
+        self.stat = self._core.stat
+
+        # only the items that have slots connected are updated each cycle
+        self._keys_sync_pending = False
+        self._tracked_items = ()
+        self._item_groups = {}
+        self._subscriptions = SubscriptionRegistry(on_activated=self._onItemActivated,
+                                                   on_invalidated=self._scheduleKeysSync)
+
+        # items are only activated and removed after the registry is done
+        # iterating its entries, see `_processQueued`
+        self._activated = []
+        self._failed = []
+
+        self._core.snapshot_updated.connect(self._poll)
+
+        # release items whose receivers were destroyed while idle
+        self._refresh_timer = QTimer()
+        self._refresh_timer.timeout.connect(self._refresh)
+        self._refresh_timer.start(self._core.SUBSCRIPTION_REFRESH_INTERVAL)
+
+    def _scheduleKeysSync(self):
+        if not self._keys_sync_pending:
+            self._keys_sync_pending = True
+            QTimer.singleShot(0, self._syncKeys)
+
+    def _syncKeys(self):
+        # have the status poll loop fetch the attributes our items need
+        self._keys_sync_pending = False
+        self._trackItems(self._subscriptions.active())
+        self._processQueued(self._core.getSnapshot())
+
+    def _refresh(self):
+        self._subscriptions.refresh()
+        self._syncKeys()
+
+    def _trackItems(self, items):
+        if items is not self._tracked_items:
+            self._tracked_items = items
+
+            # group the items by attribute, so each is only fetched once
+            groups = {}
+            for item in items:
+                groups.setdefault(item.attr_name, []).append(item)
+            self._item_groups = dict((k, tuple(v)) for k, v in groups.items())
+
+            self._core.trackKeys(self, self._item_groups.keys())
+
+    def _onItemActivated(self, key, status_item):
+        # called while the registry iterates its entries, so only queue
+        self._activated.append(status_item)
+
+    def _processQueued(self, snapshot):
+        # deliver the current value to the newly connected slots, items
+        # whose attribute is not polled yet get it with a later snapshot
+        activated = self._activated
+        self._activated = []
+        for status_item in activated:
+            if status_item.attr_name in snapshot:
+                self._updateItem(status_item, snapshot[status_item.attr_name])
+            else:
+                self._activated.append(status_item)
 
-    def _poll(self):
-        # s = time.time()
+        failed = self._failed
+        self._failed = []
+        for status_item in failed:
+            self.status_items.pop(hash(status_item), None)
+            self._subscriptions.unregister(hash(status_item))
+
+    def _updateItem(self, status_item, value):
         try:
-            self.stat.poll()
+            status_item.update(value)
         except Exception as e:
-            log.warning("Status polling failed, is LinuxCNC running?", exc_info=e)
-            self.timer.stop()
-            return
-        for status_item in self.status_items.values():
-            try:
-                status_item.update()
-            except Exception as e:
-                log.exception(e)
-                del self.status_items[hash(status_item)]
+            log.exception(e)
+            self._failed.append(status_item)
+
+    @pyqtSlot(object, object)
+    def _poll(self, snapshot, changed):
+        # s = time.time()
+        self._trackItems(self._subscriptions.active())
+        groups = self._item_groups
+        for attr_name in changed:
+            items = groups.get(attr_name)
+            if items is None:
+                continue
+            value = snapshot[attr_name]
+            for status_item in items:
+                self._updateItem(status_item, value)
+        self._processQueued(snapshot)
         # print time.time() - s
 
     def getStatAttr(self, name, index=None, key=None, stat_class=StatusItem):
@@ -174,7 +267,9 @@ class StatusPoller(QObject):
         if si is None:
             si = stat_class(name, index=index, key=key, stat=self.stat)
             log.debug("Adding new StatusItem for '{}'".format(si.formated_name))
+            si.subscriptions = self._subscriptions
             self.status_items[hash(si)] = si
+            self._subscriptions.register(hash(si), si, (si.valueChanged,), si)
         return si
 
 class Status(QObject):
@@ -206,7 +301,7 @@ class HALPin(QObject):
 
     valueChanged = pyqtSignal([bool], [float], [int])
 
-    def __init__(self, pin_name, pin_type, pin_direction, pin_value):
+    def __init__(self, pin_name, pin_type, pin_direction, pin_value, poller=None):
         super(HALPin, self).__init__()
         """Initializes a new HALPin object
 
@@ -215,13 +310,16 @@ class HALPin(QObject):
             pin_type (str):      the HAL type for the pin, float, u32, s32 or bit
             pin_direction (str): the pin direction, IN, OUT, or I/O
             pin_value (str):     the initial value of the HAL pin
+            poller (HALPoller):  the poller whose HAL backend is used for
+                                 reading and writing, defaults to HALStatus()
         """
 
         self.pin_name = pin_name
+        self.poller = poller
         type_map = {'float': float, 's32': int, 'u32': int, 'bit': bool}
         self.type = type_map.get(pin_type)
         self.settable = pin_direction in ['IN', 'I/O']
-        self.value = self.type(pin_value)
+        self.value = self.convertType(pin_value)
 
         self.log_change = False
 
@@ -256,15 +354,29 @@ class HALPin(QObject):
             # remove all slots from signal it not slot given
             self.valueChanged[self.type].disconnect()
 
+    def getBackend(self):
+        return (self.poller or HALStatus()).getBackend()
+
     def getValue(self):
-        data = subprocess.check_output(['halcmd', '-s', 'show', 'pin', self.pin_name]).split()
-        return self.convertType(data[3])
+        return self.convertType(self.getBackend().getPin(self.pin_name))
 
     def setValue(self, value):
         if self.settable:
-            return subprocess.call(['halcmd', 'setp', self.pin_name, str(value)])
+            return self.getBackend().setPin(self.pin_name, value)
         raise TypeError("setValue failed, HAL pin '{}' is read only".format(self.pin_name))
 
+    def setValueAsync(self, value, callback=None):
+        """Sets the pin value without blocking, see `HALPoller.setPins()`.
+
+        Args:
+            value:                 the new value of the pin
+            callback (callable):   called in the GUI thread with the list of
+                                   pins that failed to be set, optional
+        """
+        if not self.settable:
+            raise TypeError("setValueAsync failed, HAL pin '{}' is read only".format(self.pin_name))
+        (self.poller or HALStatus()).setPins({self.pin_name: value}, callback)
+
     def getSettable(self):
         return self.settable
 
@@ -279,13 +391,361 @@ class HALPin(QObject):
         return self.log_change
 
     def convertType(self, value):
+        # values read with halcmd are strings, values read from the
+        # HAL shared memory are already python types
+        if not isinstance(value, basestring):
+            return self.type(value)
         if self.type == bool:
             return value.lower() in ['true', '1']
+        if self.type == int:
+            # halcmd shows u32 values in hex
+            return int(value, 0)
         return self.type(value)
 
 
+def halValue(value):
+    """Formats a value the way halcmd and hal.set_p expect it."""
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+class HalcmdTimeout(IOError):
+    """Raised when halcmd does not answer within HalcmdSession.TIMEOUT."""
+
+
+class _LineReader(object):
+    """Reads the lines of a pipe, waiting at most `timeout` seconds for
+    each, so a stalled process can not block the reader forever."""
+
+    def __init__(self, pipe, timeout):
+        self.fd = pipe.fileno()
+        self.timeout = timeout
+        self.buffer = ''
+
+    def _fill(self):
+        ready, _, _ = select.select([self.fd], [], [], self.timeout)
+        if not ready:
+            raise HalcmdTimeout("halcmd did not answer in {}s".format(self.timeout))
+        data = os.read(self.fd, 4096)
+        self.buffer += data
+        return bool(data)
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            if not self._fill():
+                raise EOFError("halcmd exited unexpectedly")
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def readall(self):
+        while self._fill():
+            pass
+        lines = self.buffer.splitlines()
+        self.buffer = ''
+        return lines
+
+
+def _cleanOutput(lines):
+    output = []
+    for line in lines:
+        line = line.strip()
+        while line.startswith('halcmd:'): # strip any prompts
+            line = line[7:].strip()
+        if line:
+            output.append(line)
+    return output
+
+
+class HalcmdSession(object):
+    """A long running `halcmd` process that HAL commands are piped to.
+
+    Each command is followed by a sync marker, a `ptype` of a pin that does
+    not exist, whose error message marks the end of the commands output.
+    All the commands of a batch are written before the output is read, so
+    a batch of reads and writes costs one round trip instead of a fork per
+    command. Safe to use from several threads.
+
+    The marker is written to stderr, so it only follows the output of the
+    command if both streams are line buffered. Without `stdbuf` to make
+    them so, each command is run by a halcmd process of its own instead.
+    A halcmd that does not answer within TIMEOUT seconds is killed and
+    HalcmdTimeout is raised, the next call starts a new one.
+    """
+
+    SYNC_MARK = '__qtpyvcp_sync_{}__'
+
+    # keep the output of a batch well below the 64 KB pipe buffer, so halcmd
+    # can not block on writing while we are still writing commands. The
+    # output of a `show pin` of _HalcmdBackend.MAX_PINS_PER_CALL pins is a
+    # few KB.
+    MAX_BATCH = 8
+
+    # seconds to wait for output, the lock is shared with the GUI thread
+    TIMEOUT = 2.0
+
+    def __init__(self):
+        self._proc = None
+        self._reader = None
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.persistent = find_executable('stdbuf') is not None
+        if not self.persistent:
+            log.info("stdbuf not found, running halcmd once per command")
+
+    def _start(self):
+        # halcmd's stdout is block buffered when it is a pipe
+        cmd = ['stdbuf', '-oL', '-eL', 'halcmd', '-k', '-s', '-f']
+        log.debug("Starting halcmd session: {}".format(' '.join(cmd)))
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT, close_fds=True)
+        self._reader = _LineReader(self._proc.stdout, self.TIMEOUT)
+
+    def _stop(self):
+        proc, self._proc = self._proc, None
+        self._reader = None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+            proc.kill()
+            proc.wait()
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+    def execute(self, commands):
+        """Run a batch of halcmd commands.
+
+        Args:
+            commands (list): the halcmd command lines, e.g. `getp motion.enable`
+
+        Returns:
+            list: a list of the output lines of each command.
+
+        Raises:
+            HalcmdTimeout: if halcmd stalled.
+        """
+        with self._lock:
+            if not self.persistent:
+                return [self._executeOnce(command) for command in commands]
+            try:
+                return self._tryExecute(commands)
+            except (IOError, OSError, EOFError) as e:
+                # halcmd exits when HAL goes away, try once with a new session.
+                # Not after a HalcmdTimeout, retrying could block the GUI
+                # thread for as long again.
+                log.debug("halcmd session failed, restarting", exc_info=e)
+                return self._tryExecute(commands)
+
+    def _tryExecute(self, commands):
+        """Runs a batch, stops the session if it fails so the next batch
+        does not read what is left of the output of this one."""
+        try:
+            return self._execute(commands)
+        except HalcmdTimeout:
+            log.warning("halcmd session stalled, restarting")
+            self._stop()
+            raise
+        except (IOError, OSError, EOFError):
+            self._stop()
+            raise
+
+    def _executeOnce(self, command):
+        proc = subprocess.Popen(['halcmd', '-s'] + command.split(), stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, close_fds=True)
+        try:
+            return _cleanOutput(_LineReader(proc.stdout, self.TIMEOUT).readall())
+        except HalcmdTimeout:
+            log.warning("halcmd stalled running '{}'".format(command))
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+    def _execute(self, commands):
+        if self._proc is None or self._proc.poll() is not None:
+            self._start()
+
+        stdin = self._proc.stdin
+        readline = self._reader.readline
+
+        results = []
+        for i in range(0, len(commands), self.MAX_BATCH):
+            marks = []
+            lines = []
+            for command in commands[i:i + self.MAX_BATCH]:
+                self._seq += 1
+                mark = self.SYNC_MARK.format(self._seq)
+                marks.append(mark)
+                lines.append(command)
+                lines.append('ptype ' + mark)
+            stdin.write('\n'.join(lines) + '\n')
+            stdin.flush()
+
+            for mark in marks:
+                output = []
+                while True:
+                    line = readline()
+                    if mark in line:
+                        break
+                    output.append(line)
+                results.append(_cleanOutput(output))
+        return results
+
+
+class _HalcmdBackend(object):
+    """Reads and writes HAL pins using a persistent halcmd session."""
+
+    name = 'halcmd'
+
+    # halcmd limits the number of tokens per command, so query the pins
+    # in batches. The first two tokens are used by `show pin`.
+    MAX_PINS_PER_CALL = 30
+
+    def __init__(self):
+        self.session = HalcmdSession()
+
+    def readPins(self, pin_names):
+        """Read HAL pin values.
+
+        Args:
+            pin_names (list): the names of the pins to read.
+
+        Returns:
+            tuple: dict of pin values and dict of values of the signals
+                connected to the pins.
+        """
+        pin_names = list(pin_names)
+        batches = [pin_names[i:i + self.MAX_PINS_PER_CALL]
+                   for i in range(0, len(pin_names), self.MAX_PINS_PER_CALL)]
+        if not batches:
+            return {}, {}
+
+        outputs = self.session.execute(['show pin ' + ' '.join(names) for names in batches])
+
+        pin_dict = {}
+        sig_dict = {}
+        for names, output in zip(batches, outputs):
+            # pin names are matched as prefixes, so ignore any extra pins
+            wanted = set(names)
+            for line in output:
+                p = line.split()
+                if len(p) < 5 or p[4] not in wanted:
+                    continue
+                pin_dict[p[4]] = p[3]
+                if len(p) > 6:
+                    # if there is a signal listed on this pin, make sure
+                    # that signal is in our signal dictionary
+                    sig_dict[p[6]] = p[3]
+        return pin_dict, sig_dict
+
+    def getPin(self, pin_name):
+        output = self.session.execute(['getp ' + pin_name])[0]
+        if len(output) != 1:
+            raise ValueError("Failed to read HAL pin '{}': {}".format(pin_name, ' '.join(output)))
+        return output[0]
+
+    def setPin(self, pin_name, value):
+        return 1 if self.setPins([(pin_name, value)]) else 0
+
+    def setPins(self, values):
+        """Set several HAL pins in one halcmd round trip.
+
+        Args:
+            values (list): (pin_name, value) pairs, set in order.
+
+        Returns:
+            list: the names of the pins that could not be set.
+        """
+        values = list(values)
+        outputs = self.session.execute(['setp {} {}'.format(pin_name, halValue(value))
+                                        for pin_name, value in values])
+        failed = []
+        for (pin_name, value), output in zip(values, outputs):
+            if output:
+                log.error("Failed to set HAL pin '{}': {}".format(pin_name, ' '.join(output)))
+                failed.append(pin_name)
+        return failed
+
+    def getPinInfo(self, pin_name):
+        """Returns the type, direction and value of a HAL pin."""
+        output = self.session.execute(['show pin ' + pin_name])[0]
+        if len(output) > 1: # more than one pin name matches
+            raise ValueError("HAL pin red<{}> does not exist".format(pin_name))
+        pin_data = output[0].split() if output else []
+        if len(pin_data) < 5: # no pin names match
+            raise ValueError("HAL pin red<{}> does not exist".format(pin_name))
+        if pin_name != pin_data[4]: # name is not complete, but only one pin could match
+            raise ValueError("HAL pin red<{}> does not exist, did you mean green<{}>?".format(pin_name, pin_data[4]))
+        return pin_data[1].strip(), pin_data[2].strip(), pin_data[3].strip()
+
+    def close(self):
+        self.session.close()
+
+
+class _HalModuleBackend(_HalcmdBackend):
+    """Reads and writes HAL pins directly in the HAL shared memory using
+    the LinuxCNC `hal` python module, only the requested pins are read.
+    Falls back to halcmd for the pin type and direction lookup."""
+
+    name = 'hal'
+
+    def __init__(self):
+        super(_HalModuleBackend, self).__init__()
+        # creating a component attaches us to the HAL shared memory
+        self.comp = hal.component('qtpyvcp-halpoller-{}'.format(os.getpid()))
+        self.comp.ready()
+        self._failed_pins = set()
+
+    def readPins(self, pin_names):
+        get_value = hal.get_value
+        pin_dict = {}
+        for pin_name in pin_names:
+            try:
+                pin_dict[pin_name] = get_value(pin_name)
+            except Exception as e:
+                if pin_name not in self._failed_pins:
+                    self._failed_pins.add(pin_name)
+                    log.warning("Failed to read HAL pin '{}'".format(pin_name), exc_info=e)
+        return pin_dict, {}
+
+    def getPin(self, pin_name):
+        return hal.get_value(pin_name)
+
+    def setPins(self, values):
+        failed = []
+        for pin_name, value in values:
+            try:
+                hal.set_p(pin_name, halValue(value))
+            except Exception as e:
+                log.error("Failed to set HAL pin '{}'".format(pin_name), exc_info=e)
+                failed.append(pin_name)
+        return failed
+
+    def close(self):
+        try:
+            self.comp.exit()
+        except Exception:
+            pass
+        super(_HalModuleBackend, self).close()
+
+
 class HALPoller(QObject):
     """docstring for StatusPoller"""
+
+    # emitted from the poll thread when there are changes waiting to be
+    # delivered, always received in the GUI thread
+    changes_pending = pyqtSignal()
+
+    # emitted from the write thread when a setPins() request has been
+    # applied, with the callback and the list of pins that failed
+    write_finished = pyqtSignal(object, object)
+
     def __init__(self):
         super(HALPoller, self).__init__()
 
@@ -296,14 +756,51 @@ class HALPoller(QObject):
         self.pin_dict = {}
         self.sig_dict = {}
 
+        # pin changes not yet delivered to the GUI thread, only the latest
+        # value of each pin is kept so each pin is updated once per delivery
+        self._pending_changes = {}
+        self._delivery_pending = False
+        self.changes_pending.connect(self._deliverChanges, Qt.QueuedConnection)
+
+        # pin writes are applied in order by a separate thread, so slow HAL
+        # access never blocks the GUI thread
+        self._write_queue = Queue.Queue()
+        self.write_finished.connect(self._onWriteFinished, Qt.QueuedConnection)
+        self.write_thread = threading.Thread(target=self.hal_write_thread)
+        self.write_thread.daemon = True
+        self.write_thread.start()
+
+        # the backend used to access HAL, created once LinuxCNC is running
+        self.backend = None
+
         # Create a thread for checking the HAL pins and sigs
         self.hal_mutex = threading.Lock()
         self.hal_thread = threading.Thread(target=self.hal_poll_thread)
         self.hal_thread.daemon = True
         self.hal_thread.start()
 
-
-    # halcmd can take 200ms or more to run, so run poll updates in a thread so as not to slow the server
+    def getBackend(self):
+        """Returns the HAL backend, reading HAL shared memory directly if the
+        `hal` module supports it, or running halcmd if not."""
+        with self.hal_mutex:
+            if self.backend is None:
+                if hal is not None and hasattr(hal, 'get_value'):
+                    try:
+                        self.backend = _HalModuleBackend()
+                    except Exception as e:
+                        log.warning("Could not attach to HAL shared memory, using halcmd", exc_info=e)
+                if self.backend is None:
+                    self.backend = _HalcmdBackend()
+                log.debug("Using '{}' HAL backend".format(self.backend.name))
+            return self.backend
+
+    def closeBackend(self):
+        with self.hal_mutex:
+            if self.backend is not None:
+                self.backend.close()
+                self.backend = None
+
+    # HAL reads can take a while, so run poll updates in a thread so as not to slow the server
     # requests for hal pins and sigs will read the results from the most recent update
     def hal_poll_thread(self):
 
@@ -321,6 +818,7 @@ class HALPoller(QObject):
                     self.sig_dict = {}
                 finally:
                     self.hal_mutex.release()
+                self.closeBackend()
                 time.sleep(self.cycle_time/1000.0)
                 continue
             else:
@@ -328,42 +826,42 @@ class HALPoller(QObject):
                     log.debug("LinuxCNC has started.")
                 self.linuxcnc_is_alive = True
 
-            self.p = subprocess.Popen( ['halcmd', '-s', 'show', 'pin'] , stderr=subprocess.PIPE, stdout=subprocess.PIPE )
-            rawtuple = self.p.communicate()
-            if len(rawtuple[0]) <= 0:
+            # only the pins that have a HALPin object are read
+            try:
+                pin_dict, sig_dict = self.getBackend().readPins(self.status_items.keys())
+            except Exception as e:
+                log.debug("Failed to read HAL pins", exc_info=e)
+                pin_dict = {}
+
+            if len(pin_dict) <= 0:
                 time.sleep(self.cycle_time/1000.0)
                 continue
-            raw = rawtuple[0].split('\n')
 
-            pins = [ filter( lambda a: a != '', [x.strip() for x in line.split(' ')] ) for line in raw ]
+            # compare each pin with its last value
+            last_values = self.pin_dict
+            changed_items = {}
+            for pin_name, value in pin_dict.iteritems():
+                if last_values.get(pin_name) != value:
+                    changed_items[pin_name] = value
+            # for item in changed_items.items():
+            #     print 'HAL pin Changed: {} => {}'.format(item[0], item[1])
 
-            # UPDATE THE DICTIONARY OF PIN INFO
             # Acquire the mutex so we don't step on other threads
             self.hal_mutex.acquire()
             try:
-                pin_dict = {}
-                sig_dict = {}
-
-                for p in pins:
-                    if len(p) > 5:
-                        # if there is a signal listed on this pin, make sure
-                        # that signal is in our signal dictionary
-                        sig_dict[ p[6] ] = p[3]
-                    if len(p) >= 5:
-                        pin_dict[ p[4] ] = p[3]
+                self.pin_dict = pin_dict
+                self.sig_dict = sig_dict
+                self._pending_changes.update(changed_items)
+                # only queue one delivery event, changes from later scans
+                # are merged into it until the GUI thread has handled it
+                notify = bool(self._pending_changes) and not self._delivery_pending
+                if notify:
+                    self._delivery_pending = True
             finally:
                 self.hal_mutex.release()
 
-            changed_items = set(pin_dict.items()) - set(self.pin_dict.items())
-            # for item in changed_items:
-            #     print 'HAL pin Changed: {} => {}'.format(item[0], item[1])
-
-            self.pin_dict = pin_dict
-            self.sig_dict = sig_dict
-
-            for changed_item in changed_items:
-                if changed_item[0] in self.status_items:
-                    self.status_items[changed_item[0]].update(changed_item[1])
+            if notify:
+                self.changes_pending.emit()
 
             # print time.time() - s
             # print json.dumps(pin_dict, indent=4, sort_keys=True)
@@ -371,23 +869,57 @@ class HALPoller(QObject):
             # before starting the next check, sleep a little so we don't use all the CPU
             time.sleep(self.cycle_time/1000.0)
 
+    @pyqtSlot()
+    def _deliverChanges(self):
+        """Updates the HALPins with the changes from the poll thread, runs
+        in the GUI thread so the HALPin signals are emitted there too."""
+        with self.hal_mutex:
+            changes = self._pending_changes
+            self._pending_changes = {}
+            self._delivery_pending = False
+
+        for pin_name, value in changes.iteritems():
+            si = self.status_items.get(pin_name)
+            if si is not None:
+                si.update(value)
+
+    def setPins(self, values, callback=None):
+        """Set several HAL pins without blocking.
+
+        The pins are set in one HAL round trip, in the order given if
+        `values` is a list of (pin_name, value) pairs or an OrderedDict.
+
+        Args:
+            values (dict):        pin names and their new values
+            callback (callable):  called in the GUI thread with the list of
+                                  pins that failed to be set, optional
+        """
+        if isinstance(values, dict):
+            values = values.items()
+        self._write_queue.put((list(values), callback))
+
+    def hal_write_thread(self):
+        while True:
+            values, callback = self._write_queue.get()
+            try:
+                failed = self.getBackend().setPins(values)
+            except Exception as e:
+                log.error("Failed to set HAL pins", exc_info=e)
+                failed = [pin_name for pin_name, value in values]
+            if callback is not None or failed:
+                self.write_finished.emit(callback, failed)
+
+    @pyqtSlot(object, object)
+    def _onWriteFinished(self, callback, failed):
+        if callback is not None:
+            callback(failed)
+
     def getHALPin(self, pin_name):
         si = self.status_items.get(pin_name)
         if si is None:
-            raw = subprocess.check_output(['halcmd', '-s', 'show', 'pin', pin_name]).strip()
-            if len(raw.split('\n')) > 1: # more than one pin name matches
-                raise ValueError("HAL pin red<{}> does not exist".format(pin_name))
-            pin_data = raw.split()
-            if len(pin_data) == 0: # no pin names match
-                raise ValueError("HAL pin red<{}> does not exist".format(pin_name))
-                return
-            if pin_name != pin_data[4]: # name is not complete, but only one pin could match
-                raise ValueError("HAL pin red<{}> does not exist, did you mean green<{}>?".format(pin_name, pin_data[4]))
-            pin_type = pin_data[1].strip()
-            pin_direction = pin_data[2].strip()
-            pin_value = pin_data[3].strip()
+            pin_type, pin_direction, pin_value = self.getBackend().getPinInfo(pin_name)
             log.debug("Adding new HALStatusItem for pin '{}'".format(pin_name))
-            si = HALPin(pin_name, pin_type, pin_direction, pin_value)
+            si = HALPin(pin_name, pin_type, pin_direction, pin_value, poller=self)
             self.status_items[pin_name] = si
         return si
 
@@ -463,10 +995,11 @@ if __name__ == '__main__':
     flood_off_pin = hal_stat.getHALPin('halui.flood.off')
     flood_is_on_pin = hal_stat.getHALPin('halui.flood.is-on')
 
-    # method to set flood ON/OFF
+    # method to set flood ON/OFF, both pins are set in one go without
+    # blocking the UI
     def setFloodOn(state):
-        flood_on_pin.setValue(state)
-        flood_off_pin.setValue(not state)
+        hal_stat.setPins([(flood_on_pin.pin_name, state),
+                          (flood_off_pin.pin_name, not state)])
 
     # check button for turning flood ON/OFF
     flood_toggle = QCheckBox("Flood ON")
@@ -22,11 +22,13 @@ from PyQt5.QtWidgets import QDialog, QLabel, QHBoxLayout, QWidget
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtBoundSignal, pyqtSlot, QTimer, QThread
 
 import os
+import math
 import time
 import linuxcnc
 
 from QtPyVCP.utilities.info import Info
 from QtPyVCP.utilities.prefs import Prefs
+from QtPyVCP.utilities.subscriptions import SubscriptionRegistry
 INFO = Info()
 PREFS = Prefs()
 
@@ -129,7 +131,6 @@ class _Status(QObject):
 
 
     stat = linuxcnc.stat()
-    timer = QTimer()
 
     # Queues
     active_queue = pyqtSignal(int)          # number of motions blending
@@ -271,6 +272,37 @@ class _Status(QObject):
     # Emitted on app shutdown
     on_shutown = pyqtSignal()
 
+    # Emitted when the status poll cycle time changes, in ms
+    poll_cycle_time = pyqtSignal(int)
+
+    # Emitted after the signals for a new status snapshot have been emitted,
+    # with the snapshot dict and the names of the attributes that changed
+    snapshot_updated = pyqtSignal(object, object)
+
+    # Default max emit rates in Hz for signals that change on almost every
+    # cycle while the machine is moving. Intermediate values are coalesced
+    # and the final value is always delivered. Signals not listed here are
+    # emitted immediately.
+    DEFAULT_MAX_SIGNAL_RATES = {
+        'position': 20,                 # DROs
+        'joint_position': 20,
+        'dtg': 20,
+        'actual_position': 30,          # backplot
+        'joint_actual_position': 30,
+        'current_vel': 30,
+    }
+
+    # Attributes the GUI thread needs besides the ones with receivers, they
+    # are always polled so they can be read from the snapshots instead of
+    # from the stat object the worker is polling.
+    SNAPSHOT_KEYS = ('position', 'actual_position', 'joint_position',
+        'joint_actual_position', 'dtg', 'g5x_offset', 'g92_offset',
+        'tool_offset', 'rotation_xy', 'homed', 'interp_state', 'call_level')
+
+    # ms between rebuilds of the subscriptions, so receivers that were
+    # destroyed are released even when no snapshots arrive
+    SUBSCRIPTION_REFRESH_INTERVAL = 2000
+
     def __init__(self):
         super(_Status, self).__init__()
 
@@ -292,6 +324,10 @@ class _Status(QObject):
             self.stat.poll()
         except:
             pass
+        self._num_joints = self.stat.joints
+
+        # Initialize Error status class
+        self.error = _Error()
 
         excluded_items = ['axes', 'axis', 'joint', 'cycle_time',
             'acceleration', 'kinematics_type',
@@ -305,6 +341,43 @@ class _Status(QObject):
                 continue
             self.old[item] = getattr(self.stat, item)
 
+        # Resolve the signals and string lookups for each stat attribute once,
+        # so the periodic loop does not have to do any lookups by name. Only
+        # the entries that have connected receivers are compared each cycle.
+        self._keys_sync_pending = False
+        self._subscriptions = SubscriptionRegistry(on_invalidated=self._scheduleKeysSync)
+        self._dispatch_table = self._buildDispatchTable()
+        self._dispatch_by_key = {}
+        for entry in self._dispatch_table:
+            key, signal, str_signal, str_dict = entry
+            signals = (signal,) if str_signal is None else (signal, str_signal)
+            self._subscriptions.register(key, self, signals, entry)
+            self._dispatch_by_key[key] = entry
+
+        # Polling and diffing is done by a worker in its own thread, the
+        # changes are delivered to `_onSnapshot` via a queued connection.
+        # The poll rate is raised while the machine is active, and dropped
+        # to the idle rate once nothing has changed for IDLE_DELAY ms.
+        self._cycle_time = self._timingPref("CYCLE_TIME", INFO.getCycleTime())
+        self._worker = _StatusWorker(self.stat, self.error.error, self._cycle_time)
+        self._worker.active_cycle_time = self._timingPref("ACTIVE_CYCLE_TIME", INFO.getActiveCycleTime())
+        self._worker.idle_cycle_time = self._timingPref("IDLE_CYCLE_TIME", INFO.getIdleCycleTime())
+        self._worker.idle_delay = self._timingPref("IDLE_DELAY", 2000)
+        self._worker_thread = QThread()
+        self._worker.moveToThread(self._worker_thread)
+        self._worker_thread.started.connect(self._worker.start)
+        self._worker.snapshot_ready.connect(self._onSnapshot)
+        self._worker.error_received.connect(self.error._processError)
+        self._worker.cycle_time_changed.connect(self._onCycleTimeChanged)
+        self._worker_keys = frozenset()
+        self._snapshot = {}
+
+        # attributes polled on behalf of other objects, see `trackKeys`
+        self._tracked_keys = {self: frozenset(self.SNAPSHOT_KEYS)}
+
+        self._refresh_timer = QTimer()
+        self._refresh_timer.timeout.connect(self._refreshSubscriptions)
+
         # These signals should all cause position updates
         self.position.connect(self.updateAxisPositions)
         self.g5x_offset.connect(self.updateAxisPositions)
@@ -324,51 +397,232 @@ class _Status(QObject):
         self.settings.connect(lambda s: self.feed.emit(s[2]))
 
         # Initialize Joint status class
-        self.joint = _Joint(self.stat)
-        # Initialize Error status class
-        self.error = _Error()
-
-        # Set up the periodic update timer
-        self._cycle_time = 75
-        self.timer.timeout.connect(self._periodic)
-
-        # Use a single shot to stat the main periodic timer, this ensures it
+        self.joint = _Joint(self.stat, self._scheduleKeysSync)
+
+        # Set up the signal rate limiting
+        self._min_intervals = {}
+        self._last_emit = {}
+        self._pending = {}
+        self._throttle_timer = QTimer()
+        self._throttle_timer.setSingleShot(True)
+        self._throttle_timer.timeout.connect(self._flushThrottled)
+        rates = PREFS.getPref("STATUS", "MAX_SIGNAL_RATES", self.DEFAULT_MAX_SIGNAL_RATES, dict)
+        for name, rate in rates.items():
+            self.setMaxSignalRate(name, rate)
+
+        # Use a single shot to stat the polling thread, this ensures it
         # starts after the main Qt event loop to prevent errors
         QTimer.singleShot(0, self.startPeriodic)
 
+    def _timingPref(self, option, default):
+        # a [STATUS] pref overrides the INI value, but the default is not
+        # written to the pref file, that would hide later INI changes
+        if PREFS.has_option("STATUS", option):
+            return PREFS.getPref("STATUS", option, default, int)
+        return default
+
     def startPeriodic(self):
-        self.timer.start(self._cycle_time)
+        self._syncWorkerKeys()
+        self._worker_thread.start()
+        self._refresh_timer.start(self.SUBSCRIPTION_REFRESH_INTERVAL)
 
-    def _periodic(self):
-        # s = time.time()
+    def stopPeriodic(self):
+        self._refresh_timer.stop()
+        self._worker_thread.quit()
+        self._worker_thread.wait()
+
+    def getPollCycleTime(self):
+        """Returns the current status poll cycle time in ms."""
+        return self._cycle_time
+
+    def getSnapshot(self):
+        """Returns the latest snapshot dict, it is never modified.
+
+        The GUI thread should read stat values from here rather than from
+        `stat`, which the worker thread polls concurrently.
+        """
+        return self._snapshot
+
+    def _snapshotValue(self, key):
+        # before the first snapshot fall back to the values from __init__
         try:
-            self.stat.poll()
-        except Exception as e:
-            log.warning("Status polling failed, is LinuxCNC running?", exc_info=e)
-            self.timer.stop()
-            return
+            return self._snapshot[key]
+        except KeyError:
+            return self.old[key]
+
+    @pyqtSlot(int)
+    def _onCycleTimeChanged(self, cycle_time):
+        self._cycle_time = cycle_time
+        log.debug("Status poll cycle time changed to {}ms".format(cycle_time))
+        self.poll_cycle_time.emit(cycle_time)
+
+    def connectNotify(self, signal):
+        # a receiver was connected, include its attribute on the next cycle
+        self._subscriptions.invalidate()
+
+    def disconnectNotify(self, signal):
+        self._subscriptions.invalidate()
+
+    def trackKeys(self, owner, keys):
+        """Poll stat attributes on behalf of another object.
+
+        The values of the attributes are included in the snapshots passed
+        to the `snapshot_updated` signal, in addition to the attributes
+        that have signal receivers. Newly tracked attributes are listed as
+        changed in the first snapshot they are in.
+
+        Args:
+            owner (object): the object the attributes are polled for.
+            keys (iterable): the names of the stat attributes to poll,
+                replaces any previously tracked by owner.
+        """
+        self._tracked_keys[owner] = frozenset(keys)
+        self._scheduleKeysSync()
+
+    def _refreshSubscriptions(self):
+        # subscriptions are otherwise only rebuilt when a snapshot arrives
+        self._subscriptions.refresh()
+        self.joint._subscriptions.refresh()
+        self._syncWorkerKeys()
+
+    def _scheduleKeysSync(self):
+        if not self._keys_sync_pending:
+            self._keys_sync_pending = True
+            QTimer.singleShot(0, self._syncWorkerKeys)
+
+    def _syncWorkerKeys(self):
+        """Tell the worker which stat attributes currently have receivers."""
+        self._keys_sync_pending = False
+        self._subscriptions.active()
+        keys = self._subscriptions.activeKeys()
+        if self.joint.hasSubscribers():
+            keys = keys | frozenset(['joint'])
+        for tracked in self._tracked_keys.values():
+            keys = keys | tracked
+        if keys != self._worker_keys:
+            self._worker_keys = keys
+            self._worker.setKeys(keys)
+
+    def _buildDispatchTable(self):
+        """Build the (key, signal, str_signal, str_dict) table for all the
+        stat attributes that have a corresponding signal."""
+        table = []
+        for key in sorted(self.old.keys()):
+            signal = getattr(self, key, None)
+            if not isinstance(signal, pyqtBoundSignal):
+                log.debug("No signal for stat attribute '{}', ignoring".format(key))
+                continue
+            str_dict = self.STATE_STRING_LOOKUP.get(key)
+            str_signal = signal[str] if str_dict is not None else None
+            table.append((key, signal, str_signal, str_dict))
+        return tuple(table)
+
+    @pyqtSlot(object, object)
+    def _onSnapshot(self, snapshot, changed):
+        """Emit the signals for the attributes that changed in a snapshot.
+
+        Args:
+            snapshot (dict): the values of the tracked stat attributes.
+            changed (tuple): the names of the attributes that changed.
+        """
+        # s = time.time()
+        self._snapshot = snapshot
 
-        for key, old_value in self.old.iteritems():
-            new_value = getattr(self.stat, key)
-            if old_value != new_value:
-                getattr(self, key).emit(new_value)
+        old = self.old
+        dispatch = self._dispatch_by_key
+        min_intervals = self._min_intervals
+        now = time.time()
+        for key in changed:
+            entry = dispatch.get(key)
+            if entry is None:
+                continue
+            new_value = snapshot[key]
+            # update old values dict
+            old[key] = new_value
+            if key in min_intervals:
+                self._throttledEmit(entry, new_value, now)
+            else:
+                self._emitEntry(entry, new_value)
 
-                str_dict = self.STATE_STRING_LOOKUP.get(key)
-                if str_dict is not None:
-                    str_val = str_dict[new_value]
-                    getattr(self, key)[str].emit(str_val)
-                    log.debug("{}: {}".format(key, str_val))
+        if 'joint' in changed or ('joint' in snapshot and self.joint._fieldsChanged()):
+            self.joint._periodic(snapshot['joint'])
 
-                # update old values dict
-                self.old[key] = new_value
+        self.snapshot_updated.emit(snapshot, changed)
 
-        self.joint._periodic()
-        self.error._periodic()
+        self._syncWorkerKeys()
         # print time.time() - s
 
+    def _emitEntry(self, entry, value):
+        key, signal, str_signal, str_dict = entry
+        signal.emit(value)
+
+        if str_signal is not None:
+            str_val = str_dict[value]
+            str_signal.emit(str_val)
+            log.debug("{}: {}".format(key, str_val))
+
+    def _throttledEmit(self, entry, value, now):
+        key = entry[0]
+        interval = self._min_intervals[key]
+        elapsed = now - self._last_emit.get(key, 0)
+        if elapsed >= interval:
+            self._pending.pop(key, None)
+            self._last_emit[key] = now
+            self._emitEntry(entry, value)
+        else:
+            # coalesce, only the most recent value gets delivered
+            self._pending[key] = (entry, value)
+            # the timer may be armed for a later key, re-arm it if this
+            # one is due sooner
+            due = int((interval - elapsed) * 1000) + 1
+            timer = self._throttle_timer
+            if not timer.isActive() or timer.remainingTime() > due:
+                timer.start(due)
+
+    def _flushThrottled(self):
+        now = time.time()
+        next_due = None
+        for key, (entry, value) in self._pending.items():
+            remaining = self._min_intervals.get(key, 0) - (now - self._last_emit.get(key, 0))
+            if remaining <= 0:
+                del self._pending[key]
+                self._last_emit[key] = now
+                self._emitEntry(entry, value)
+            elif next_due is None or remaining < next_due:
+                next_due = remaining
+        if next_due is not None:
+            self._throttle_timer.start(int(next_due * 1000) + 1)
+
+    def setMaxSignalRate(self, name, rate):
+        """Limit how often a stat attribute signal is emitted.
+
+        Args:
+            name (str): the name of the stat attribute signal, e.g. `position`.
+            rate (float): the max emit rate in Hz, 0 or None to emit immediately.
+        """
+        if rate:
+            self._min_intervals[name] = 1.0 / rate
+        else:
+            self._min_intervals.pop(name, None)
+            # deliver anything that is still waiting
+            pending = self._pending.pop(name, None)
+            if pending is not None:
+                self._emitEntry(*pending)
+
+    def getMaxSignalRate(self, name):
+        interval = self._min_intervals.get(name)
+        if interval is None:
+            return 0
+        return 1.0 / interval
+
     def forceUpdate(self):
-        for key, value in self.old.iteritems():
-                getattr(self, key).emit(value)
+        # everything is emitted now, so values waiting to be delivered are stale
+        self._pending.clear()
+        self._throttle_timer.stop()
+        for key, signal, str_signal, str_dict in self._dispatch_table:
+            value = self._snapshotValue(key)
+            self.old[key] = value
+            signal.emit(value)
 
 
 
@@ -376,7 +630,7 @@ class _Status(QObject):
 
     def _from_internal_linear_unit(self, v, unit=None):
         if unit is None:
-            unit = self.stat.linear_units
+            unit = self._snapshotValue('linear_units')
         lu = (unit or 1) * 25.4
         return v * lu
 
@@ -441,21 +695,22 @@ class _Status(QObject):
         # To allow forced updates, mostly for use by QtDesigner methods
         if pos is None:
             if self._report_actual_position:
-                pos = self.stat.actual_position
+                pos = self._snapshotValue('actual_position')
             else:
-                pos = self.stat.position
+                pos = self._snapshotValue('position')
 
-        dtg = self.stat.dtg
-        g5x_offset = self.stat.g5x_offset
-        g92_offset = self.stat.g92_offset
-        tool_offset = self.stat.tool_offset
+        dtg = self._snapshotValue('dtg')
+        g5x_offset = self._snapshotValue('g5x_offset')
+        g92_offset = self._snapshotValue('g92_offset')
+        tool_offset = self._snapshotValue('tool_offset')
+        rotation_xy = self._snapshotValue('rotation_xy')
 
         rel = [0] * 9
         for axis in INFO.AXIS_NUMBER_LIST:
             rel[axis] = pos[axis] - g5x_offset[axis] - tool_offset[axis]
 
-        if self.stat.rotation_xy != 0:
-            t = math.radians(-self.stat.rotation_xy)
+        if rotation_xy != 0:
+            t = math.radians(-rotation_xy)
             xr = rel[0] * math.cos(t) - rel[1] * math.sin(t)
             yr = rel[0] * math.sin(t) + rel[1] * math.cos(t)
             rel[0] = xr
@@ -470,14 +725,14 @@ class _Status(QObject):
         # To allow forced updates, mostly for use by QtDesigner methods
         if pos is None:
             if self._report_actual_position:
-                pos = self.stat.joint_actual_position
+                pos = self._snapshotValue('joint_actual_position')
             else:
-                pos = self.stat.joint_position
+                pos = self._snapshotValue('joint_position')
         self.joint_positions.emit(pos)
 
     def updateFileLoaded(self, file):
-        if self.stat.interp_state == linuxcnc.INTERP_IDLE \
-                and self.stat.call_level == 0:
+        if self._snapshotValue('interp_state') == linuxcnc.INTERP_IDLE \
+                and self._snapshotValue('call_level') == 0:
             self.file_loaded.emit(file)
 
     def _allHomed(self):
@@ -487,17 +742,118 @@ class _Status(QObject):
         '''Returns TRUE if all joints are homed.'''
         if self.no_force_homing:
             return True
-        for jnum in range(self.stat.joints):
-            if not self.stat.joint[jnum]['homed']:
+        homed = self._snapshotValue('homed')
+        for jnum in range(self._num_joints):
+            if not homed[jnum]:
                 return False
         return True
 
     def onShutdown(self):
         self.on_shutown.emit()
+        self.stopPeriodic()
         PREFS.setPref("STATUS", "RECENT_FILES", self.recent_files)
         PREFS.setPref("STATUS", "MAX_RECENT_FILES", self.max_recent_files)
 
 
+#==============================================================================
+# Status polling worker
+#==============================================================================
+
+class _StatusWorker(QObject):
+    """Polls `linuxcnc.stat` and diffs the tracked attributes.
+
+    Lives in its own QThread so a stall in the NML shared memory or a slow
+    slot on the GUI thread does not delay the other. Each cycle a new
+    snapshot dict of the tracked attribute values is emitted along with the
+    names of the attributes that changed. A snapshot is never modified once
+    it has been emitted.
+    """
+
+    snapshot_ready = pyqtSignal(object, object)  # snapshot dict, changed keys
+    error_received = pyqtSignal(object, object)  # kind, message
+    cycle_time_changed = pyqtSignal(int)         # new cycle time in ms
+
+    def __init__(self, stat, error_channel, cycle_time):
+        super(_StatusWorker, self).__init__()
+
+        self.stat = stat
+        self.error_channel = error_channel
+        self.timer = None
+
+        # cycle times in ms
+        self.cycle_time = cycle_time
+        self.active_cycle_time = cycle_time
+        self.idle_cycle_time = cycle_time
+        self.idle_delay = 2000
+
+        self._last_change = 0
+
+        self._keys = ()
+        self._values = {}
+
+    def setKeys(self, keys):
+        """Set the attributes to poll, safe to call from any thread."""
+        # rebinding a tuple is atomic, so no lock is needed
+        self._keys = tuple(sorted(keys))
+
+    @pyqtSlot()
+    def start(self):
+        # the timer has to be created in the worker thread
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(self.cycle_time)
+
+    @pyqtSlot()
+    def poll(self):
+        try:
+            self.stat.poll()
+        except Exception as e:
+            log.warning("Status polling failed, is LinuxCNC running?", exc_info=e)
+            self.timer.stop()
+            return
+
+        stat = self.stat
+        old = self._values
+        snapshot = {}
+        changed = []
+        for key in self._keys:
+            value = getattr(stat, key)
+            snapshot[key] = value
+            # newly tracked keys are reported as changed, so receivers
+            # connected after startup get the current value
+            if key not in old or old[key] != value:
+                changed.append(key)
+        self._values = snapshot
+
+        if changed:
+            self.snapshot_ready.emit(snapshot, tuple(changed))
+
+        error = self.error_channel.poll()
+        if error:
+            self.error_received.emit(*error)
+
+        self._adaptCycleTime(changed or error)
+
+    def _adaptCycleTime(self, changed):
+        now = time.time()
+        if changed:
+            self._last_change = now
+
+        stat = self.stat
+        # jogging and homing both clear the in position flag
+        if stat.interp_state != linuxcnc.INTERP_IDLE or not stat.inpos \
+                or stat.current_vel != 0:
+            cycle_time = self.active_cycle_time
+        elif (now - self._last_change) * 1000 < self.idle_delay:
+            cycle_time = self.cycle_time
+        else:
+            cycle_time = self.idle_cycle_time
+
+        if cycle_time != self.timer.interval():
+            self.timer.setInterval(cycle_time)
+            self.cycle_time_changed.emit(cycle_time)
+
+
 #==============================================================================
 # Joint status class
 #==============================================================================
@@ -529,30 +885,91 @@ class _Joint(QObject):
     max_position_limit = pyqtSignal(int, float)
     min_position_limit = pyqtSignal(int, float)
 
-    def __init__(self, stat):
+    # The `linuxcnc.stat.joint[n]` dict keys, each has a signal of the same name
+    FIELDS = ('jointType', 'backlash', 'enabled', 'fault', 'ferror_current',
+        'ferror_highmark', 'homed', 'homing', 'inpos', 'input', 'max_ferror',
+        'max_hard_limit', 'max_soft_limit', 'min_hard_limit', 'min_soft_limit',
+        'output', 'override_limits', 'velocity', 'units', 'min_ferror',
+        'max_position_limit', 'min_position_limit')
+
+    def __init__(self, stat, on_subscriptions_changed=None):
         super(_Joint, self).__init__()
 
         self.stat = stat
-        self.old = self.stat.joint
-
-    def _periodic(self):
+        self._num_joints = stat.joints
+        # the shared stat is polled by the status worker thread, on demand
+        # reads from the GUI thread use their own
+        self._value_stat = linuxcnc.stat()
+
+        # only the fields that have connected receivers are compared
+        self._subscriptions = SubscriptionRegistry(on_invalidated=on_subscriptions_changed)
+        for field in self.FIELDS:
+            signal = getattr(self, field)
+            self._subscriptions.register(field, self, (signal,), (field, signal))
+
+        # per joint lists of the last values of the active fields
+        self._active_fields = ()
+        self._values = []
+
+    def connectNotify(self, signal):
+        self._subscriptions.invalidate()
+
+    def disconnectNotify(self, signal):
+        self._subscriptions.invalidate()
+
+    def hasSubscribers(self):
+        """Returns True if any of the joint signals has a receiver."""
+        return len(self._subscriptions.active()) > 0
+
+    # the last value of a field that has just become active, so its value
+    # is emitted in the first cycle
+    _NO_VALUE = object()
+
+    def _fieldsChanged(self):
+        """Returns True if fields became active or inactive since the last
+        cycle, new ones are emitted even if the joints did not change."""
+        active = frozenset(field for field, signal in self._active_fields)
+        return active != self._subscriptions.activeKeys()
+
+    def _rebuildValues(self, fields, new):
+        # keep the last values of fields that were already active, so that
+        # changes in this cycle are not lost, new ones have no last value
+        previous = dict((field, i) for i, (field, signal) in enumerate(self._active_fields))
+        values = []
+        for jnum in range(len(new)):
+            old = self._values[jnum] if jnum < len(self._values) else None
+            row = []
+            for field, signal in fields:
+                i = previous.get(field)
+                if old is not None and i is not None:
+                    row.append(old[i])
+                else:
+                    row.append(self._NO_VALUE)
+            values.append(row)
+        self._active_fields = fields
+        self._values = values
+
+    def _periodic(self, new):
         # Joint updates
-        new = self.stat.joint
-        old = self.old
-        self.old = new
+        fields = self._subscriptions.active()
+        if fields is not self._active_fields:
+            self._rebuildValues(fields, new)
 
         # start = time.time()
-        for jnum in range(self.stat.joints):
-            if new[jnum] != old[jnum]:
-                # print '\nJoint {}'.format(jnum)
-                changed_items = tuple(set(new[jnum].items())-set(old[jnum].items()))
-                for item in changed_items:
-                    # print 'JOINT_{0} {1}: {2}'.format(jnum, item[0], item[1])
-                    getattr(self, item[0]).emit(jnum, item[1])
+        values = self._values
+        for jnum in range(self._num_joints):
+            joint = new[jnum]
+            row = values[jnum]
+            for i, (field, signal) in enumerate(fields):
+                value = joint[field]
+                if value != row[i]:
+                    # print 'JOINT_{0} {1}: {2}'.format(jnum, field, value)
+                    row[i] = value
+                    signal.emit(jnum, value)
 
     def getValue(self, jnum, attribute):
-        self.stat.poll()
-        return self.stat.joint[jnum][attribute]
+        self._value_stat.poll()
+        return self._value_stat.joint[jnum][attribute]
 
 
 #==============================================================================
@@ -569,13 +986,8 @@ class _Error(QObject):
     def __init__(self, parent=None):
         super(_Error, self).__init__(parent)
 
-    def _periodic(self):
-        error = self.error.poll()
-        if not error:
-            return
-
-        kind, msg = error
-
+    @pyqtSlot(object, object)
+    def _processError(self, kind, msg):
         if msg == "" or msg is None:
             msg = "Unknown error!"
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2018 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of QtPyVCP.
+#
+#   QtPyVCP is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   QtPyVCP is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with QtPyVCP.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Registry of status signals and the receivers connected to them, used
+#   by the status pollers to only compare values that someone is using.
+
+from collections import OrderedDict
+
+from QtPyVCP.utilities import logger
+log = logger.getLogger(__name__)
+
+
+class SubscriptionRegistry(object):
+    """Tracks which registered items have live consumers.
+
+    Each item is registered with a key, the QObject that owns its signals
+    and the signals that deliver its value. `active()` returns the data of
+    the items that have at least one receiver connected to any of their
+    signals. The owner should call `invalidate()` from its `connectNotify`
+    and `disconnectNotify` methods so changes are picked up on the next
+    cycle. Qt does not notify the sender when a connection is dropped
+    because the receiver was destroyed, so the active set is also rebuilt
+    every `refresh_ticks` cycles.
+
+    Args:
+        on_activated (callable, optional): called with the key and data of
+            each item that becomes active, used to resync cached values.
+        on_invalidated (callable, optional): called when `invalidate()` is
+            called, used to schedule a refresh of the active set.
+        refresh_ticks (int, optional): number of cycles between forced
+            rebuilds of the active set.
+    """
+
+    def __init__(self, on_activated=None, on_invalidated=None, refresh_ticks=40):
+        self.on_activated = on_activated
+        self.on_invalidated = on_invalidated
+        self.refresh_ticks = refresh_ticks
+
+        self._entries = OrderedDict()
+        self._active = ()
+        self._active_keys = frozenset()
+        self._dirty = True
+        self._ticks = 0
+
+    def register(self, key, owner, signals, data=None):
+        """Register an item.
+
+        Args:
+            key (hashable): the key identifying the item.
+            owner (QObject): the object the signals belong to.
+            signals (tuple): the bound signals that deliver the items value.
+            data (optional): returned by `active()` for the item, defaults to key.
+        """
+        self._entries[key] = (owner, tuple(signals), key if data is None else data)
+        self._dirty = True
+
+    def unregister(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._dirty = True
+
+    def invalidate(self):
+        self._dirty = True
+        if self.on_invalidated is not None:
+            self.on_invalidated()
+
+    def isActive(self, key):
+        return key in self._active_keys
+
+    def activeKeys(self):
+        return self._active_keys
+
+    def active(self):
+        """Returns the data of the active items, call once per cycle."""
+        self._ticks += 1
+        if self._dirty or self._ticks >= self.refresh_ticks:
+            self.refresh()
+        return self._active
+
+    def refresh(self):
+        active = []
+        active_keys = set()
+        for key, (owner, signals, data) in self._entries.iteritems():
+            for signal in signals:
+                if owner.receivers(signal) > 0:
+                    break
+            else:
+                continue
+
+            if key not in self._active_keys:
+                log.debug("Subscription to '{}' activated".format(key))
+                if self.on_activated is not None:
+                    self.on_activated(key, data)
+
+            active.append(data)
+            active_keys.add(key)
+
+        self._active = tuple(active)
+        self._active_keys = frozenset(active_keys)
+        self._dirty = False
+        self._ticks = 0
@@ -30,7 +30,7 @@ import time
 
 
 from PyQt5.QtGui import QColor
-from PyQt5.QtCore import pyqtSignal, QPoint, QSize, Qt
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QPoint, QSize, Qt, QObject, QThread, QTimer
 from PyQt5.QtWidgets import QApplication, QHBoxLayout, QSlider, QWidget
 
 # Set up logging
@@ -55,6 +55,10 @@ import linuxcnc
 from rs274 import interpret
 from QtPyVCP.lib import glnav
 from QtPyVCP.lib import glcanon
+from QtPyVCP.lib import live_trail
+from QtPyVCP.lib import toolpath
+from QtPyVCP.lib import preview_cache
+from QtPyVCP.lib import parallel_preview
 
 
 #==============================================================================
@@ -122,6 +126,10 @@ class Window(QWidget):
 #==============================================================================
 
 class StatCanon(glcanon.GLCanon, interpret.StatMixin):
+
+    # number of segments per batch when streaming the preview
+    BATCH_SIZE = 50000
+
     def __init__(self, colors, geometry, is_lathe, stat, random, line_count, progress_callback):
         glcanon.GLCanon.__init__(self, colors, geometry)
         interpret.StatMixin.__init__(self, stat, random)
@@ -131,9 +139,40 @@ class StatCanon(glcanon.GLCanon, interpret.StatMixin):
         self.total_lines = line_count
         self.previous_progress = 0
 
+        # if set, called with each batch of new segments, see flush_batch()
+        self.batch_callback = None
+        # set if batches of an earlier attempt have to be dropped
+        self.restart_stream = False
+        self._flushed = (0, 0, 0)
+        self._flushed_count = 0
+        self._batch_extents = None
+
+    def segment_count(self):
+        return len(self.traverse) + len(self.feed) + len(self.arcfeed)
+
+    def flush_batch(self):
+        """Passes the segments added since the last batch to batch_callback,
+        along with the extents of all the segments so far."""
+        stores = (('rapids', self.traverse), ('feed', self.feed), ('arcfeed', self.arcfeed))
+        batch = {}
+        for (name, store), start in zip(stores, self._flushed):
+            batch[name] = store.rows(start, len(store))
+        extents = toolpath.segments_extents(batch.values())
+        if self._batch_extents is not None:
+            extents = toolpath.merge_extents(self._batch_extents, extents)
+        self._batch_extents = batch['extents'] = extents
+        self._flushed = tuple(len(store) for name, store in stores)
+        self._flushed_count = self.segment_count()
+        batch['restart'], self.restart_stream = self.restart_stream, False
+        self.batch_callback(batch)
+
     def change_tool(self, pocket):
-        glcanon.GLCanon.change_tool(self,pocket)
+        # the tool table is updated first, so the operation gets the new tool
         interpret.StatMixin.change_tool(self,pocket)
+        glcanon.GLCanon.change_tool(self,pocket)
+
+    def tool_in_spindle(self, pocket):
+        return self.tools[0][0]
 
     def check_abort(self):
         if self.aborted:
@@ -148,6 +187,83 @@ class StatCanon(glcanon.GLCanon, interpret.StatMixin):
             self.previous_progress = progress
             self.progress_callback(progress + 1)
 
+        if self.batch_callback is not None \
+                and self.segment_count() - self._flushed_count >= self.BATCH_SIZE:
+            self.flush_batch()
+
+class StatValues(object):
+    """The values of a linuxcnc.stat a StatCanon reads.
+
+    Unlike the stat it can be pickled, to make canons in other processes.
+    """
+
+    ATTRIBUTES = ('tool_table', 'linear_units', 'angular_units', 'axis_mask',
+                  'block_delete')
+
+    def __init__(self, stat):
+        for name in self.ATTRIBUTES:
+            setattr(self, name, getattr(stat, name, 0))
+
+
+def make_preview_canon(colors, geometry, is_lathe, stat, random, line_count):
+    """Makes a StatCanon for a parallel_preview worker process."""
+    return StatCanon(colors, geometry, is_lathe, stat, random, line_count, _ignore_progress)
+
+
+def _ignore_progress(progress):
+    pass
+
+class PreviewLoader(QObject):
+    """Interprets a G-code file for the preview in a worker thread.
+
+    Only the interpreter and the canon run in the worker, the GL display
+    lists are built by the GUI thread once `loaded` has been emitted.
+    If a PreviewCache is given the preview is loaded from it when possible,
+    and stored in it after the file has been interpreted.
+    """
+    progress = pyqtSignal(int)
+    batch = pyqtSignal(object)
+    loaded = pyqtSignal(object, int, int)
+
+    def __init__(self, plot, filename, canon, unitcode, initcode, cache=None, cache_context=()):
+        super(PreviewLoader, self).__init__()
+        self.plot = plot
+        self.filename = filename
+        self.canon = canon
+        self.unitcode = unitcode
+        self.initcode = initcode
+        self.cache = cache
+        self.cache_context = cache_context
+
+    @pyqtSlot()
+    def run(self):
+        key = None
+        if self.cache is not None:
+            try:
+                key = self.cache.key(self.filename, self.unitcode, self.initcode, *self.cache_context)
+                if key is not None and self.cache.load(key, self.canon):
+                    self.loaded.emit(self.canon, 0, 0)
+                    return
+            except Exception:
+                LOG.warning("Preview cache lookup failed", exc_info=True)
+                key = None
+
+        cacheable = False
+        try:
+            result, seq = self.plot.parse_preview(self.filename, self.canon, self.unitcode, self.initcode)
+            cacheable = result <= gcode.MIN_ERROR
+        except KeyboardInterrupt:
+            result, seq = 0, 0
+        except Exception:
+            LOG.exception("Error loading preview of {}".format(self.filename))
+            result, seq = 0, 0
+        self.loaded.emit(self.canon, result, seq)
+
+        # the canon is not modified any more, so it can be saved while the
+        # GUI thread uses it
+        if cacheable and key is not None and not self.canon.aborted:
+            self.cache.store(key, self.canon)
+
 #==============================================================================
 # QtGl widget for displaying g-code toolpath backplot
 #==============================================================================
@@ -169,21 +285,34 @@ class QBackPlot(QGLWidget, glcanon.GlCanonDraw, glnav.GlNavBase):
         # requires linuxcnc running before laoding this widget
         inifile = os.environ.get('INI_FILE_NAME', '/dev/null')
         self.inifile = linuxcnc.ini(inifile)
-        self.logger = linuxcnc.positionlogger(linuxcnc.stat(),
-            C('backplotjog'),
-            C('backplottraverse'),
-            C('backplotfeed'),
-            C('backplotarc'),
-            C('backplottoolchange'),
-            C('backplotprobing'),
-            self.get_geometry()
-        )
+        colors = [C('backplotjog'), C('backplottraverse'), C('backplotfeed'),
+                  C('backplotarc'), C('backplottoolchange'), C('backplotprobing')]
+        # keep at most [DISPLAY] LIVE_PLOT_POINTS points of the live plot,
+        # the foam plot is only drawn by the positionlogger
+        if live_trail.numpy is not None and not self.inifile.find("DISPLAY", "FOAM"):
+            max_points = int(self.inifile.find("DISPLAY", "LIVE_PLOT_POINTS") or
+                             live_trail.DEFAULT_MAX_POINTS)
+            self.logger = live_trail.LiveTrail(linuxcnc.stat(), colors,
+                                               self.get_geometry(), max_points)
+            # resumed by showEvent
+            self.logger.pause()
+        else:
+            self.logger = linuxcnc.positionlogger(linuxcnc.stat(),
+                *(colors + [self.get_geometry()]))
         # start tracking linuxcnc position so we can plot it
         thread.start_new_thread(self.logger.start, (.01,))
         glcanon.GlCanonDraw.__init__(self, linuxcnc.stat(), self.logger)
 
         self.canon = None
 
+        # preview loading state
+        self._loader = None
+        self._loader_thread = None
+        self._loader_tmpdir = None
+        self._pending_file = None
+        # loader threads that are finishing up, e.g. storing to the cache
+        self._finishing_loaders = set()
+
         # set defaults
         self.current_view = 'p'
         self.fingerprint = ()
@@ -215,6 +344,18 @@ class QBackPlot(QGLWidget, glcanon.GlCanonDraw, glnav.GlNavBase):
         self.parameter_file = os.path.join(os.environ['CONFIG_DIR'], temp)
 
         self.foam_option = bool(self.inifile.find("DISPLAY", "FOAM"))
+
+        # cache interpreted previews if [DISPLAY] PREVIEW_CACHE = 1, in at
+        # most [DISPLAY] PREVIEW_CACHE_SIZE MB
+        self.preview_cache = None
+        if toolpath.numpy is not None and \
+                self.inifile.find("DISPLAY", "PREVIEW_CACHE") in ['1', 'True', 'true']:
+            size = self.inifile.find("DISPLAY", "PREVIEW_CACHE_SIZE")
+            max_bytes = int(size) * 1024 * 1024 if size else preview_cache.DEFAULT_MAX_BYTES
+            self.preview_cache = preview_cache.PreviewCache(max_bytes=max_bytes)
+
+        # interpret big programs with [DISPLAY] PREVIEW_PROCESSES processes,
+        self.preview_processes = parallel_preview.configuredProcesses(self.inifile)
         self.show_offsets = False
         self.show_overlay = False
         self.enable_dro = False
@@ -250,36 +391,118 @@ class QBackPlot(QGLWidget, glcanon.GlCanonDraw, glnav.GlNavBase):
             return
 
         # Needed to support special chars in path name, such as `coño.ngc`
-        filename = filename.encode('utf-8')
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+
+        if self._loader is not None:
+            # abort the running load and start this one once it has stopped
+            self._loader.canon.aborted = True
+            self._pending_file = filename
+            return
 
         td = tempfile.mkdtemp()
         self.current_file = filename
         try:
             line_count = self.count_lines(filename)
-            self.canon = StatCanon(self.colors, self.get_geometry(), self.is_lathe, s, self.random, line_count, self.report_progress_percentage)
+            canon = StatCanon(self.colors, self.get_geometry(), self.is_lathe, s, self.random, line_count, None)
             temp_parameter = os.path.join(td, os.path.basename(self.parameter_file))
             shutil.copy(self.parameter_file, temp_parameter)
-            self.canon.parameter_file = temp_parameter
+            canon.parameter_file = temp_parameter
             unitcode = "G%d" % (20 + (s.linear_units == 1))
             initcode = self.inifile.find("RS274NGC", "RS274NGC_STARTUP_CODE") or ""
-            self.report_loading_started()
-            try:
-                result, seq = self.load_preview(filename, self.canon, unitcode, initcode)
-            except KeyboardInterrupt:
-                result, seq = 0, 0
-            self.report_loading_finished()
-            if result > gcode.MIN_ERROR:
-                self.report_gcode_error(result, seq, filename)
-                # FixMe instead of just loading an empty file find a way
-                # to clear the backplot directly
-                # self.clear()
-            # else:
-            #     glcanon.GlCanonDraw.realize(self)
-
-
-        finally:
+        except:
             shutil.rmtree(td)
+            raise
+
+        # interpret the file in a worker thread, the GUI thread only has to
+        # build the display lists once it is done
+        self._loader_tmpdir = td
+        cache_context = (repr(s.tool_table), self.parameter_file, self.preview_settings(),
+                         self.subroutine_path(), self.remap_subroutines())
+        self._loader = PreviewLoader(self, filename, canon, unitcode, initcode,
+                                     self.preview_cache, cache_context)
+        canon.progress_callback = self._loader.progress.emit
+        if toolpath.numpy is not None and self.can_stream_preview():
+            # draw the program in batches while it is being interpreted
+            canon.batch_callback = self._loader.batch.emit
+            self._loader.batch.connect(self._onPreviewBatch)
+        # owned by the widget, so it is not garbage collected while running
+        self._loader_thread = QThread(self)
+        self._loader.moveToThread(self._loader_thread)
+        self._loader_thread.started.connect(self._loader.run)
+        self._loader.progress.connect(self.report_progress_percentage)
+        self._loader.loaded.connect(self._onPreviewLoaded)
+
+        self.report_loading_started()
+        self._loader_thread.start()
+
+    @pyqtSlot(object)
+    def _onPreviewBatch(self, batch):
+        if self._loader is None or self._pending_file is not None:
+            return
+        if not self.isValid():
+            # not shown yet, there is no GL context to draw with
+            return
+        self.makeCurrent()
+        self.stream_preview_batch(batch)
+        self.update()
+
+    @pyqtSlot(object, int, int)
+    def _onPreviewLoaded(self, canon, result, seq):
+        filename = self._loader.filename
+        # the loader may still be storing the preview in the cache, so it
+        # is kept around and its temp dir is only removed once its thread
+        # has finished, instead of waiting for it here
+        finishing = (self._loader, self._loader_thread)
+        tmpdir = self._loader_tmpdir
+        self._finishing_loaders.add(finishing)
+        thread = self._loader_thread
+        thread.finished.connect(lambda: shutil.rmtree(tmpdir, ignore_errors=True))
+        thread.finished.connect(self._loader.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        thread.destroyed.connect(lambda: self._finishing_loaders.discard(finishing))
+        thread.quit()
+        self.end_preview_stream()
+        self._loader = None
+        self._loader_thread = None
+        self._loader_tmpdir = None
+
+        if self._pending_file is not None:
+            filename, self._pending_file = self._pending_file, None
+            self.load(filename)
+            return
+
+        self.makeCurrent()
+        self.canon = canon
+        self.preview_loaded(canon, result)
         self.set_current_view()
+        self.report_loading_finished()
+        if result > gcode.MIN_ERROR:
+            self.report_gcode_error(result, seq, filename)
+            # FixMe instead of just loading an empty file find a way
+            # to clear the backplot directly
+            # self.clear()
+        self.update()
+
+    def interpret_preview(self, filename, canon, unitcode, initcode):
+        if self.preview_processes > 1:
+            streamed = []
+
+            def batch_callback(batch):
+                streamed.append(True)
+                canon.batch_callback(batch)
+
+            canon_factory = (make_preview_canon, (canon.colors, canon.geometry, canon.is_lathe,
+                                                  StatValues(self.stat), self.random,
+                                                  canon.total_lines))
+            parsed = parallel_preview.parse(
+                filename, canon, canon_factory, unitcode, initcode, canon.progress_callback,
+                None if canon.batch_callback is None else batch_callback)
+            if parsed is not None:
+                return parsed
+            canon.restart_stream = bool(streamed)
+
+        return glcanon.GlCanonDraw.interpret_preview(self, filename, canon, unitcode, initcode)
 
     def count_lines(self, fname):
         lines = 0
@@ -302,7 +525,8 @@ class QBackPlot(QGLWidget, glcanon.GlCanonDraw, glnav.GlNavBase):
         pass
 
     def abort(self):
-        self.canon.aborted = True
+        if self._loader is not None:
+            self._loader.canon.aborted = True
 
     def clear(self):
         path = "/home/kurt/dev/cnc/QtControl/pyqtui/lib/empty.ngc"
@@ -354,6 +578,33 @@ class QBackPlot(QGLWidget, glcanon.GlCanonDraw, glnav.GlNavBase):
             self._geometry = 'XYZ'
         return self._geometry
     def is_foam(self): return self.foam_option
+
+    # the settings the preview depends on besides the program, for the
+    # preview cache key
+    def preview_settings(self):
+        return (self.is_lathe, self.random, self.get_geometry(), self.foam_option,
+                tuple(self.inifile.findall("RS274NGC", "REMAP") or ()))
+
+    # the directories the interpreter looks for subroutine files in
+    def subroutine_path(self):
+        config_dir = os.environ.get('CONFIG_DIR', '')
+        dirs = []
+        prefix = self.inifile.find("DISPLAY", "PROGRAM_PREFIX")
+        if prefix:
+            dirs.append(prefix)
+        path = self.inifile.find("RS274NGC", "SUBROUTINE_PATH")
+        if path:
+            dirs.extend(path.split(':'))
+        return tuple(os.path.join(config_dir, os.path.expanduser(d)) for d in dirs if d)
+
+    # the subroutines called by REMAPped codes
+    def remap_subroutines(self):
+        subs = []
+        for remap in self.inifile.findall("RS274NGC", "REMAP") or ():
+            match = re.search(r'\bngc=(\S+)', remap)
+            if match:
+                subs.append(match.group(1))
+        return tuple(subs)
     def get_current_tool(self):
         for i in self.stat.tool_table:
             if i[0] == self.stat.tool_in_spindle:
@@ -370,6 +621,17 @@ class QBackPlot(QGLWidget, glcanon.GlCanonDraw, glnav.GlNavBase):
         self.logger.clear()
         self.update()
 
+    # stop sampling the live plot while it can not be seen
+    def showEvent(self, event):
+        if isinstance(self.logger, live_trail.LiveTrail):
+            self.logger.resume()
+        super(QBackPlot, self).showEvent(event)
+
+    def hideEvent(self, event):
+        if isinstance(self.logger, live_trail.LiveTrail):
+            self.logger.pause()
+        super(QBackPlot, self).hideEvent(event)
+
     def winfo_width(self):
         return self.geometry().width()
 
@@ -57,6 +57,7 @@ class  GcodeBackplot(QBackPlot):
 
         self.show_overlay = False  # no DRO or DRO overlay
         self._reload_filename = None
+        self._reload_distance = None
 
         # Add loading progress bar and abort button
         self.progressBar = QtWidgets.QProgressBar(visible=False)
@@ -94,12 +95,21 @@ class  GcodeBackplot(QBackPlot):
         self._reload_filename = fname
         self.load(fname)
 
+    @pyqtSlot()
+    def selectToolLine(self):
+        """Selects the program line nearest to the tool, the editor follows
+        the selection, e.g. to find where to run from after a crash."""
+        self.makeCurrent()
+        if self.select_tool_line() is None:
+            LOG.debug("No program line near the tool")
+        self.update()
+
     def reloadBackplot(self):
         LOG.debug('reload the display: {}'.format(self._reload_filename))
-        dist = self.get_zoom_distance()
         try:
+            # the zoom is restored once the file has been loaded
+            self._reload_distance = self.get_zoom_distance()
             self.loadBackplot(self._reload_filename)
-            self.set_zoom_distance(dist)
         except:
             LOG.warning("Problem reloading backplot file: {}".format(self._reload_filename), exc_info=True)
 
@@ -124,13 +134,15 @@ class  GcodeBackplot(QBackPlot):
         self.start = time.time()
 
     def report_progress_percentage(self, percentage):
-        QApplication.processEvents()
         self.progressBar.setValue(percentage)
 
     def report_loading_finished(self):
-        print time.time() - self.start
+        LOG.debug("Backplot loaded in {:.3f} s".format(time.time() - self.start))
         self.progressBar.hide()
         self.abortButton.hide()
+        if self._reload_distance is not None:
+            self.set_zoom_distance(self._reload_distance)
+            self._reload_distance = None
 
     # overriding functions
     def report_gcode_error(self, result, seq, filename):
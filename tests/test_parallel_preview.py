@@ -0,0 +1,269 @@
+"""
+Compares the parallel preview interpretation with gcode.parse.
+
+Needs the LinuxCNC python modules, so it only runs where LinuxCNC is
+installed, e.g. in a RIP environment.
+"""
+
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+gcode = pytest.importorskip('gcode')
+pytest.importorskip('rs274')
+qbackplot = pytest.importorskip('QtPyVCP.widgets.base_widgets.qbackplot')
+
+from QtPyVCP.lib import parallel_preview
+from QtPyVCP.lib import preview_cache
+from QtPyVCP.lib import program_scanner
+
+UNITCODE = 'G21'
+INITCODE = 'G17 G40 G49 G54 G80 G90 G94'
+
+COLORS = {'dwell': (1.0, 0.5, 0.5), 'm1xx': (0.5, 0.5, 1.0), 'selected': (0.0, 1.0, 1.0)}
+
+# the work offsets of G54, G55 and G56
+PARAMETERS = {5221: 0.0, 5222: 0.0, 5223: 0.0,
+              5241: 10.0, 5242: -5.0, 5243: 1.0,
+              5261: -20.0, 5262: 15.0, 5263: -2.0}
+
+# the fields of linuxcnc.tool
+Tool = namedtuple('Tool', 'id xoffset yoffset zoffset aoffset boffset coffset '
+                          'uoffset voffset woffset diameter frontangle backangle orientation')
+
+
+def tool(number, z=0.0, x=0.0, diameter=0.0):
+    return Tool(number, x, 0.0, z, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, diameter, 0.0, 0.0, 0)
+
+
+class Stat(object):
+    """What a StatCanon reads from linuxcnc.stat."""
+    # the tool in the spindle first, then the pockets
+    tool_table = (tool(-1), tool(1, z=10.0, diameter=6.0), tool(2, z=25.5, x=1.0),
+                  tool(3, z=-4.25, diameter=3.0))
+    linear_units = 1.0 / 25.4
+    angular_units = 1.0
+    axis_mask = 7
+    block_delete = 0
+
+
+def feed_moves(count, z=-1.0, size=20.0):
+    """Moves in a square, to give each part of a program some length."""
+    lines = []
+    for i in range(count):
+        x = size * ((i + 1) % 4 in (1, 2))
+        y = size * ((i + 1) % 4 in (2, 3))
+        lines.append('G1 X{:.3f} Y{:.3f} Z{:.3f}'.format(x, y, z))
+    return lines
+
+
+def modal_program():
+    lines = ['%', '(modal state carried across the split points)']
+    planes = [('G17', 'G2 I5 J0'), ('G18', 'G3 I5 K0'), ('G19', 'G2 J5 K0')]
+    for i in range(30):
+        lines.append('T{} M6'.format(i % 3 + 1))
+        lines.append('G43')
+        if i % 2:
+            lines.append('G20 F{}'.format(10 + i))
+            scale = 1 / 25.4
+        else:
+            lines.append('G21 F{}'.format(200 + i))
+            scale = 1.0
+        plane, arc = planes[i % 3]
+        lines.append('G0 X0 Y0 Z0')
+        lines.append(plane)
+        if i % 4 == 3:
+            # the arc centers are absolute, from the origin
+            lines.append('G90.1')
+            lines.append(arc.replace('5', '{:.4f}'.format(5 * scale)))
+            lines.append('G91.1')
+        else:
+            lines.append(arc.replace('5', '{:.4f}'.format(5 * scale)))
+        lines.append('G17')
+        lines.append('G4 P0.5')
+        lines.append('G93')
+        lines.append('G1 X{:.4f} F60'.format(3 * scale))
+        lines.append('G94 F100')
+        lines.extend(feed_moves(20, z=-i * scale))
+    lines.extend(['M2', '%'])
+    return lines
+
+
+def subroutine_program():
+    lines = [
+        '(subroutines called at the top level)',
+        'o<pocket> sub',
+        '  G0 Z5',
+        '  G0 X0 Y0',
+        '  G1 Z-2 F100',
+        '  G1 X10',
+        '  G1 Y10',
+        '  G1 X0',
+        '  G1 Y0',
+        '  G0 Z5',
+        'o<pocket> endsub',
+        'o<inch> sub',
+        '  G20',
+        '  G1 X0.5 Y0.5 F4',
+        'o<inch> endsub',
+        'G21 G0 X0 Y0 Z10',
+    ]
+    for i in range(30):
+        if i % 5 == 4:
+            lines.append('o<inch> call')
+            lines.extend(feed_moves(25, size=1.0))
+            lines.append('G21')
+        else:
+            lines.append('o<pocket> call')
+        lines.extend(feed_moves(25))
+    lines.append('M2')
+    return lines
+
+
+def tool_change_program():
+    lines = ['(tool changes with and without tool length offsets)', 'F500']
+    for i in range(30):
+        lines.append('M6 T{}'.format(i % 3 + 1))
+        if i % 3 == 0:
+            lines.append('G43')
+        elif i % 3 == 1:
+            lines.append('G43 H{}'.format((i + 1) % 3 + 1))
+        else:
+            lines.append('G49')
+        lines.append('G0 X{} Y{}'.format(i, -i))
+        lines.extend(feed_moves(25))
+    lines.append('M2')
+    return lines
+
+
+def wcs_program():
+    lines = ['(work offsets)', 'F300']
+    for i in range(30):
+        lines.append('T{} M6 G43'.format(i % 3 + 1))
+        lines.append('G{}'.format(54 + i % 3))
+        lines.append('G0 X0 Y0 Z2')
+        lines.extend(feed_moves(25))
+        if i % 4 == 1:
+            lines.append('G53 G0 Z0')
+    lines.append('M2')
+    return lines
+
+
+def g92_program():
+    lines = ['(G92 is not followed by the scanner)', 'F300']
+    for i in range(30):
+        lines.append('T{} M6 G43'.format(i % 3 + 1))
+        lines.append('G92 X{} Y{}'.format(i, 2 * i))
+        lines.append('G0 X0 Y0 Z2')
+        lines.extend(feed_moves(25))
+        lines.append('G92.1')
+    lines.append('M2')
+    return lines
+
+
+PROGRAMS = [
+    (modal_program, True),
+    (subroutine_program, True),
+    (tool_change_program, True),
+    (wcs_program, True),
+    (g92_program, False),
+]
+
+
+@pytest.fixture(scope='module')
+def helper():
+    """Starts the helper with limits small enough for the test programs,
+    it keeps the limits it was forked with."""
+    saved = (parallel_preview.MIN_PROGRAM_LINES, program_scanner.MIN_CHUNK_LINES,
+             program_scanner.MIN_BLOCK_SIZE)
+    parallel_preview.MIN_PROGRAM_LINES = 200
+    program_scanner.MIN_CHUNK_LINES = 50
+    program_scanner.MIN_BLOCK_SIZE = 4096
+    try:
+        assert parallel_preview.startHelper(2)
+        yield parallel_preview._helper
+    finally:
+        (parallel_preview.MIN_PROGRAM_LINES, program_scanner.MIN_CHUNK_LINES,
+         program_scanner.MIN_BLOCK_SIZE) = saved
+        if parallel_preview._helper is not None:
+            parallel_preview._helper.close()
+            parallel_preview._helper = None
+
+
+@pytest.fixture
+def tmpdir_path():
+    path = tempfile.mkdtemp()
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def make_canon(directory, name, line_count):
+    canon = qbackplot.make_preview_canon(COLORS, 'XYZ', False, qbackplot.StatValues(Stat()), 0,
+                                         line_count)
+    canon.parameter_file = os.path.join(directory, name + '.var')
+    with open(canon.parameter_file, 'w') as fh:
+        for number, value in sorted(PARAMETERS.items()):
+            fh.write('{}\t{:.6f}\n'.format(number, value))
+    return canon
+
+
+def assert_same_segments(expected, actual):
+    for name in preview_cache.STORES:
+        expected_arrays = getattr(expected, name).arrays()
+        actual_arrays = getattr(actual, name).arrays()
+        for field, a, b in zip(expected_arrays._fields, expected_arrays, actual_arrays):
+            if a is None:
+                assert b is None, (name, field)
+            else:
+                numpy.testing.assert_allclose(b, a, rtol=0, atol=1e-9,
+                                              err_msg='{} {}'.format(name, field))
+
+
+@pytest.mark.parametrize('program, splits', PROGRAMS, ids=[p[0].__name__ for p in PROGRAMS])
+def test_same_as_sequential(helper, tmpdir_path, program, splits):
+    lines = program()
+    filename = os.path.join(tmpdir_path, 'program.ngc')
+    with open(filename, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+    line_count = len(lines)
+
+    sequential = make_canon(tmpdir_path, 'sequential', line_count)
+    expected = gcode.parse(filename, sequential, UNITCODE, INITCODE)
+    assert expected[0] <= gcode.MIN_ERROR
+
+    parallel = make_canon(tmpdir_path, 'parallel', line_count)
+    canon_factory = (qbackplot.make_preview_canon,
+                     (COLORS, 'XYZ', False, qbackplot.StatValues(Stat()), 0, line_count))
+    parsed = parallel_preview.parse(filename, parallel, canon_factory, UNITCODE, INITCODE)
+    assert (parsed is not None) == splits
+    if parsed is None:
+        parsed = gcode.parse(filename, parallel, UNITCODE, INITCODE)
+
+    assert parsed == expected
+    assert_same_segments(sequential, parallel)
+    assert parallel.dwells == sequential.dwells
+    assert parallel.dwell_time == pytest.approx(sequential.dwell_time)
+    assert parallel.operations == sequential.operations
+
+
+def test_aborted(helper, tmpdir_path):
+    lines = tool_change_program()
+    filename = os.path.join(tmpdir_path, 'program.ngc')
+    with open(filename, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+
+    canon = make_canon(tmpdir_path, 'aborted', len(lines))
+    canon.aborted = True
+    canon_factory = (qbackplot.make_preview_canon,
+                     (COLORS, 'XYZ', False, qbackplot.StatValues(Stat()), 0, len(lines)))
+    with pytest.raises(KeyboardInterrupt):
+        parallel_preview.parse(filename, canon, canon_factory, UNITCODE, INITCODE)
+
+    # the helper is ready for the next program
+    assert not helper.busy
+    canon = make_canon(tmpdir_path, 'next', len(lines))
+    assert parallel_preview.parse(filename, canon, canon_factory, UNITCODE, INITCODE) is not None
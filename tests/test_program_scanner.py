@@ -0,0 +1,464 @@
+"""
+Tests for the program scanner that splits programs for the parallel
+preview. It is plain python, so these run without LinuxCNC.
+"""
+
+import pytest
+
+from QtPyVCP.lib import program_scanner as ps
+from QtPyVCP.lib.program_scanner import DIRTY, UNSET, TOOL_CHANGE, CALL, END
+
+
+def effect_of(*lines, **kwargs):
+    """Returns the effect of program lines, resolved from the defaults."""
+    effect = {}
+    for line in lines:
+        parsed = ps.parseLine(line, kwargs.get('in_sub', False))
+        if parsed is not None:
+            ps.applyWords(parsed[1], parsed[2], parsed[3], effect, dirty=kwargs.get('in_sub', False))
+    return ps.applied({}, effect)
+
+
+def apply_line(line, effect):
+    parsed = ps.parseLine(line)
+    return ps.applyWords(parsed[1], parsed[2], parsed[3], effect)
+
+
+def position(value, units=UNSET, wcs=UNSET, tlo=UNSET, diameter=UNSET, frame='abs'):
+    return (frame, value, units, wcs, tlo, diameter)
+
+
+# parseLine
+
+def test_parse_words():
+    assert ps.parseLine('g01 x1.5 Y-2 (move) f100 ; feed') == \
+        ('words', set(['1']), set(), {'X': '1.5', 'Y': '-2', 'F': '100'})
+
+
+def test_parse_codes_are_normalized():
+    parsed = ps.parseLine('G00 G90.1 G17 M06 M3 S1000')
+    assert parsed[1] == set(['0', '90.1', '17'])
+    assert parsed[2] == set(['6', '3'])
+    assert parsed[3] == {'S': '1000'}
+
+
+@pytest.mark.parametrize('line', ['', '   ', '(only a comment)', '; only a comment'])
+def test_parse_no_words(line):
+    assert ps.parseLine(line) is None
+
+
+def test_parse_percent():
+    assert ps.parseLine('%') == (END,)
+
+
+@pytest.mark.parametrize('line, name', [
+    ('o<drill> call', 'drill'),
+    ('O<Pocket Corner> CALL', 'pocketcorner'),
+    ('o100 call', '100'),
+    ('o0100 call [1] [2.5]', '100'),
+    ('N20 o<drill> call', 'drill'),
+])
+def test_parse_call(line, name):
+    assert ps.parseLine(line) == (CALL, name)
+
+
+@pytest.mark.parametrize('line', [
+    'G1 X#1',
+    'G1 X[1 + 2]',
+    '#<depth> = 2',
+    'o<drill> call [#1]',
+    'o100 if [1 GT 0]',
+    'o100 while [1]',
+    'o<drill> sub',
+    '/G1 X1',
+    '(AXIS,stop)',
+])
+def test_parse_unsafe(line):
+    with pytest.raises(ps.Unsafe):
+        ps.parseLine(line)
+
+
+def test_parse_sub_flow():
+    assert ps.parseLine('o100 if [#1 GT 0]', in_sub=True) is None
+    assert ps.parseLine('o100 endif', in_sub=True) is None
+    assert ps.parseLine('o<drill> return', in_sub=True) is None
+
+
+def test_parse_sub_parameters():
+    parsed = ps.parseLine('G1 X#1 Y[#<width> / 2] Z-1', in_sub=True)
+    assert parsed[3] == {'X': '#', 'Y': '[', 'Z': '-1'}
+    # local parameters may be set, global ones are not followed
+    assert ps.parseLine('#5 = 1', in_sub=True) == ('words', set(), set(), {})
+    with pytest.raises(ps.Unsafe):
+        ps.parseLine('#<_depth> = 1', in_sub=True)
+    with pytest.raises(ps.Unsafe):
+        ps.parseLine('#5070 = 1', in_sub=True)
+    with pytest.raises(ps.Unsafe):
+        ps.parseLine('G[#1]', in_sub=True)
+
+
+# applyWords
+
+@pytest.mark.parametrize('line, key, value', [
+    ('G20', 'units', '20'),
+    ('G21', 'units', '21'),
+    ('G55', 'wcs', '55'),
+    ('G59.3', 'wcs', '59.3'),
+    ('G18', 'plane', '18'),
+    ('G19.1', 'plane', '19.1'),
+    ('G90.1', 'arc_distance', '90.1'),
+    ('G93', 'feed_mode', '93'),
+    ('G7', 'diameter', '7'),
+    ('G99', 'retract', '99'),
+    ('G1', 'motion', '1'),
+    ('G80', 'motion', '80'),
+    ('G49', 'tlo', ('49',)),
+    ('G43 H2', 'tlo', ('43', '2')),
+    ('G43', 'tlo', ('43', UNSET)),
+    ('T4', 'T', '4'),
+])
+def test_modal_groups(line, key, value):
+    assert effect_of(line)[key] == value
+
+
+def test_modal_state_is_tracked_across_lines():
+    state = effect_of('G20 G18', 'G21', 'G55 G17', 'G91.1')
+    assert state['units'] == '21'
+    assert state['plane'] == '17'
+    assert state['wcs'] == '55'
+    assert state['arc_distance'] == '91.1'
+
+
+def test_block_depends_on_the_state_before_it():
+    effect = {}
+    apply_line('X1', effect)
+    assert ps.applied({'motion': '0'}, effect)['X'] == position('1')
+    assert ps.applied({'motion': '1'}, effect)['X'] == position('1')
+    # canned cycles do not end at their axis words
+    assert ps.applied({'motion': '81'}, effect)['X'] == DIRTY
+
+    effect = {}
+    apply_line('G1 X1', effect)
+    assert ps.applied({'units': '20', 'wcs': '56'}, effect)['X'] == position('1', '20', '56')
+
+
+def test_positions_keep_their_frame():
+    state = effect_of('G20 G55', 'G0 X1 Y2', 'G21', 'G53 G0 Z0')
+    assert state['X'] == position('1', '20', '55')
+    assert state['Y'] == position('2', '20', '55')
+    assert state['Z'] == position('0', '21', '55', frame='g53')
+
+
+def test_feed_keeps_its_units_and_mode():
+    assert effect_of('G20', 'G93 F2')['F'] == ('2', '20', '93')
+    assert effect_of('F500')['F'] == ('500', UNSET, UNSET)
+
+
+def test_tool_change():
+    effect = {}
+    assert apply_line('T3 M6', effect) == TOOL_CHANGE
+    state = ps.applied({}, effect)
+    assert state['T'] == '3'
+    assert state['tool'] == ('6', '3')
+    assert state['first_move'] is True
+
+    # without H the offset of the tool in the spindle is used
+    assert effect_of('T3 M6', 'G43')['tlo'] == ('43', ('6', '3'))
+    assert effect_of('M61 Q2')['tool'] == ('61', '2')
+
+
+def test_first_move():
+    assert effect_of('T1 M6', 'G0 X1')['first_move'] is True
+    assert effect_of('T1 M6', 'G0 X1', 'G1 X2 F100')['first_move'] is False
+
+
+def test_canned_cycle_positions_are_dirty():
+    state = effect_of('G0 X0 Y0 Z5', 'G81 X1 Y1 Z-1 R1 F100')
+    assert state['X'] == state['Y'] == state['Z'] == DIRTY
+
+
+@pytest.mark.parametrize('line', ['M2', 'M30', 'G0 X1 M2'])
+def test_end(line):
+    assert apply_line(line, {}) == END
+
+
+@pytest.mark.parametrize('line', [
+    'G92 X0 Y0', 'G92.1', 'G10 L2 P1 X0', 'G28', 'G30', 'G41 D1', 'G42.1 D2',
+    'G43.1 Z1', 'G52 X1', 'G91', 'G16', 'G5.2 X0 Y0', 'M70', 'M73',
+])
+def test_unsafe_codes(line):
+    with pytest.raises(ps.Unsafe):
+        effect_of(line)
+
+
+def test_polar_coordinates_off_is_safe():
+    assert effect_of('G15 G0 X1')['X'] == position('1')
+
+
+def test_sub_makes_its_changes_dirty():
+    state = effect_of('G20', 'G0 X1', 'T2 M6', 'M70', in_sub=True)
+    assert state['units'] == DIRTY
+    assert state['X'] == DIRTY
+    assert state['tool'] == DIRTY
+    assert state['plane'] == DIRTY
+    # unsafe codes are unsafe in subroutines as well
+    with pytest.raises(ps.Unsafe):
+        effect_of('G92 X0', in_sub=True)
+
+
+# Scanner
+
+def write_program(tmpdir, lines):
+    path = tmpdir.join('program.ngc')
+    path.write('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_scanner_sub_effect(tmpdir):
+    filename = write_program(tmpdir, [
+        'o<inch> sub',
+        '  G20',
+        '  o100 if [#1 GT 0]',
+        '    G1 X#1 F10',
+        '  o100 endif',
+        'o<inch> endsub',
+        'o<plane> sub',
+        '  G18',
+        '  o<inch> call',
+        'o<plane> endsub',
+        'G0 X0',
+        'M2',
+    ])
+    lines, subs, blocks, percent = ps.readProgram(filename, 2)
+    assert lines == 12
+    assert [(sub.name, sub.first_line, sub.last_line) for sub in subs] == \
+        [('inch', 1, 6), ('plane', 7, 10)]
+    assert not percent
+
+    scanner = ps.Scanner(filename, subs)
+    effect = {}
+    assert scanner.scanLine('o<plane> call', effect) == CALL
+    state = ps.applied({}, effect)
+    assert state['units'] == DIRTY
+    assert state['plane'] == DIRTY
+    assert state['X'] == DIRTY
+    assert 'wcs' not in state
+
+
+def test_scanner_unknown_sub(tmpdir):
+    filename = write_program(tmpdir, ['G0 X0', 'M2'])
+    scanner = ps.Scanner(filename, [])
+    with pytest.raises(ps.Unsafe):
+        scanner.scanLine('o<elsewhere> call', {})
+
+
+@pytest.mark.parametrize('lines', [
+    ['o<a> sub', 'o<b> sub', 'o<b> endsub', 'o<a> endsub'],
+    ['o<a> endsub'],
+    ['o<a> sub', 'G0 X0'],
+])
+def test_read_program_bad_subs(tmpdir, lines):
+    with pytest.raises(ps.Unsafe):
+        ps.readProgram(write_program(tmpdir, lines), 2)
+
+
+# preambleLines
+
+@pytest.mark.parametrize('key, value, line', [
+    ('units', '20', 'G20'),
+    ('wcs', '57', 'G57'),
+    ('diameter', '8', 'G8'),
+    ('tlo', ('49',), 'G49'),
+    ('tlo', ('43', UNSET), 'G43'),
+    ('tlo', ('43', '2'), 'G43 H2'),
+    ('tlo', ('43', ('6', '3')), 'G43 H3'),
+    ('plane', '19', 'G19'),
+    ('arc_distance', '90.1', 'G90.1'),
+    ('feed_mode', '95', 'G95'),
+    ('retract', '98', 'G98'),
+    ('T', '7', 'T7'),
+])
+def test_preamble_modal_group(key, value, line):
+    assert ps.preambleLines({key: value}, TOOL_CHANGE) == [line]
+
+
+def test_preamble_modal_order():
+    state = {'retract': '99', 'feed_mode': '93', 'arc_distance': '90.1', 'plane': '18',
+             'diameter': '7', 'tlo': ('49',), 'wcs': '55', 'units': '20'}
+    assert ps.preambleLines(state, TOOL_CHANGE) == ['G20 G55 G7 G49 G18 G90.1 G93 G99']
+
+
+def test_preamble_defaults():
+    assert ps.preambleLines({}, TOOL_CHANGE) == []
+
+
+@pytest.mark.parametrize('tool, line', [
+    (('6', '3'), 'T3 M6'),
+    (('61', '4'), 'M61 Q4'),
+])
+def test_preamble_tool(tool, line):
+    assert ps.preambleLines({'tool': tool}, TOOL_CHANGE) == [line]
+
+
+def test_preamble_positions():
+    state = {'X': position('1', '20', '55'), 'Y': position('2', '20', '55'),
+             'Z': position('5'), 'A': position('0', frame='g53')}
+    lines = ps.preambleLines(state, TOOL_CHANGE)
+    # positions set with fewer modes first, the defaults can not be selected again
+    assert lines[0] in ('G0 Z5', 'G53 G0 A0')
+    assert sorted(lines[:2]) == ['G0 Z5', 'G53 G0 A0']
+    assert lines[2] == 'G20 G55 G0 X1 Y2'
+
+
+@pytest.mark.parametrize('motion, lines', [
+    ('0', ['G91 G0 X0', 'G90']),
+    ('80', ['G80']),
+])
+def test_preamble_motion(motion, lines):
+    assert ps.preambleLines({'motion': motion}, TOOL_CHANGE) == lines
+
+
+def test_preamble_feed():
+    state = {'motion': '1', 'F': ('4', '20', '94')}
+    assert ps.preambleLines(state, TOOL_CHANGE) == ['G91 G1 X0 F1', 'G90', 'G20 G94 F4']
+    # a feed move without a known feed can not be recreated
+    assert ps.preambleLines({'motion': '1'}, TOOL_CHANGE) is None
+
+
+@pytest.mark.parametrize('motion', ['2', '3', '81', '38.2'])
+def test_preamble_other_motions(motion):
+    assert ps.preambleLines({'motion': motion}, TOOL_CHANGE) is None
+
+
+def test_preamble_dirty():
+    assert ps.preambleLines({'units': DIRTY}, TOOL_CHANGE) is None
+    assert ps.preambleLines({'X': DIRTY}, TOOL_CHANGE) is None
+    assert ps.preambleLines({'tlo': ('43', DIRTY)}, TOOL_CHANGE) is None
+    # a tool change moves again before the first move matters
+    assert ps.preambleLines({'first_move': DIRTY}, TOOL_CHANGE) == []
+    assert ps.preambleLines({'first_move': DIRTY}, CALL) is None
+    # items the chunk sets again before using them may be unknown
+    assert ps.preambleLines({'F': DIRTY, 'X': DIRTY}, TOOL_CHANGE, set(['F', 'X'])) == []
+
+
+# splitProgram
+
+@pytest.fixture
+def chunk_lines(monkeypatch):
+    monkeypatch.setattr(ps, 'MIN_CHUNK_LINES', 10)
+
+
+def scan(candidates=(), effect=None, end=None, unsafe=None):
+    return {'candidates': list(candidates), 'effect': effect or {}, 'end': end, 'unsafe': unsafe}
+
+
+def candidate(line, effect=None, kind=TOOL_CHANGE, set_again=()):
+    return (line, line * 10, kind, effect or {}, set(set_again))
+
+
+BLOCKS = [ps.Block(1, 0, 1000)]
+
+
+def test_split_boundaries(chunk_lines):
+    scans = [scan([candidate(5), candidate(30), candidate(60), candidate(95)])]
+    chunks = ps.splitProgram(scans, BLOCKS, {}, 100, 2, False)
+    # at least a quarter of the program apart, the last chunk not too short
+    assert [(c.start_line, c.end_line) for c in chunks] == [(1, 30), (30, 60), (60, 101)]
+    assert [(c.start_byte, c.end_byte) for c in chunks] == [(0, 300), (300, 600), (600, 1000)]
+    assert [c.index for c in chunks] == [0, 1, 2]
+    assert chunks[0].preamble == []
+
+
+def test_split_preamble_state(chunk_lines):
+    scans = [
+        scan([candidate(20, {'units': '20'})], effect={'units': '20', 'wcs': '55'}),
+        scan([candidate(60, {'plane': '18'})]),
+    ]
+    blocks = [ps.Block(1, 0, 400), ps.Block(41, 400, 1000)]
+    chunks = ps.splitProgram(scans, blocks, {'retract': '99'}, 100, 2, False)
+    assert [c.start_line for c in chunks] == [1, 60]
+    # the state from before the block with the split point, and the block up to it
+    assert chunks[1].preamble == ['G20 G55 G18 G99']
+
+
+def test_split_skips_candidates_without_preamble(chunk_lines):
+    scans = [scan([candidate(30, {'X': DIRTY}), candidate(40, {'motion': '2'}), candidate(50)])]
+    chunks = ps.splitProgram(scans, BLOCKS, {}, 100, 2, False)
+    assert [c.start_line for c in chunks] == [1, 50]
+
+
+def test_split_call_first_move(chunk_lines):
+    scans = [scan([candidate(30, kind=CALL), candidate(60, {'first_move': False}, kind=CALL)])]
+    chunks = ps.splitProgram(scans, BLOCKS, {}, 100, 2, False)
+    assert [c.first_move for c in chunks] == [None, True, False]
+
+
+def test_split_end(chunk_lines):
+    scans = [scan([candidate(30)], end=(51, 500, 'M2')), scan([candidate(70)])]
+    chunks = ps.splitProgram(scans, BLOCKS, {}, 100, 2, False)
+    assert [(c.start_line, c.end_line, c.end_byte) for c in chunks] == [(1, 30, 300), (30, 51, 500)]
+
+
+def test_split_percent(chunk_lines):
+    scans = [scan([candidate(30)], end=(80, 800, '%'))]
+    assert ps.splitProgram(scans, BLOCKS, {}, 100, 2, True)[-1].end_line == 80
+    # a percent sign only ends programs that start with one
+    assert ps.splitProgram(scans, BLOCKS, {}, 100, 2, False) is None
+    # and those need the closing one
+    assert ps.splitProgram([scan([candidate(30)])], BLOCKS, {}, 100, 2, True) is None
+
+
+def test_split_no_split_points(chunk_lines):
+    assert ps.splitProgram([scan([candidate(5), candidate(95)])], BLOCKS, {}, 100, 2, False) is None
+    assert ps.splitProgram([scan()], BLOCKS, {}, 100, 2, False) is None
+
+
+def test_split_unsafe(chunk_lines):
+    scans = [scan([candidate(30)]), {'unsafe': 'line 40: G92'}]
+    with pytest.raises(ps.Unsafe) as info:
+        ps.splitProgram(scans, BLOCKS, {}, 100, 2, False)
+    assert 'G92' in str(info.value)
+
+
+def split_file(tmpdir, lines, processes=2):
+    """Scans and splits a program file like the parallel preview does."""
+    filename = write_program(tmpdir, lines)
+    count, subs, blocks, percent = ps.readProgram(filename, processes)
+    scanner = ps.Scanner(filename, subs)
+    state = ps.applied({}, effect_of('G21 G17 G90'))
+    scans = [ps.scanBlock(filename, block, subs, scanner, percent) for block in blocks]
+    return ps.splitProgram(scans, blocks, state, count, processes, percent)
+
+
+def tool_changes(count, moves=20):
+    lines = ['F100']
+    for i in range(count):
+        lines.append('T{} M6 G43'.format(i % 3 + 1))
+        lines.append('G0 X0 Y0 Z1')
+        lines.extend('G1 X{} Y{} Z-1'.format(j, j % 2) for j in range(moves))
+    lines.append('M2')
+    return lines
+
+
+def test_split_file(tmpdir, chunk_lines, monkeypatch):
+    monkeypatch.setattr(ps, 'MIN_BLOCK_SIZE', 256)
+    lines = tool_changes(8)
+    chunks = split_file(tmpdir, lines)
+    assert len(chunks) > 1
+    for chunk in chunks[1:]:
+        # chunks start at the tool changes, after the tool of the one before
+        assert 'M6' in lines[chunk.start_line - 1]
+        previous = [line for line in lines[:chunk.start_line - 1] if 'M6' in line][-1]
+        assert chunk.preamble[0] == previous.split()[0] + ' M6'
+    assert chunks[-1].end_line == len(lines) + 1
+    assert [c.start_line for c in chunks[1:]] == [c.end_line for c in chunks[:-1]]
+
+
+@pytest.mark.parametrize('code', ['G92 X0 Y0', 'G16', 'G10 L20 P1 X0', 'G41 D1', 'G91', 'M70'])
+def test_split_file_unsafe(tmpdir, chunk_lines, code):
+    lines = tool_changes(8)
+    index = len(lines) // 2
+    lines.insert(index, code)
+    with pytest.raises(ps.Unsafe) as info:
+        split_file(tmpdir, lines)
+    assert str(info.value).startswith('line {}:'.format(index + 1))